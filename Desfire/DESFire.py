@@ -3,12 +3,16 @@ from __future__ import print_function
 import json
 import logging
 import time
+from collections import namedtuple
+from contextlib import contextmanager
 
 import random
 import pyDes
 from .device import Device
 from .DESFire_DEF import *
-from .util import byte_array_to_human_readable_hex
+from .util import byte_array_to_human_readable_hex, LazyHex, changedRanges
+from .metrics import Measurement
+from .parsers import parseApplicationIDs, parseKeySettings, parseFileIDs, parseValue
 
 
 _logger = logging.getLogger(__name__)
@@ -22,15 +26,88 @@ class DESFireCommunicationError(Exception):
         super(DESFireCommunicationError, self).__init__(msg)
         self.status_code = status_code
 
+class DESFireSessionState(object):
+    """What the card is known to have selected and authenticated.
+
+    ``aid`` is None when the selected application is unknown (e.g. after a transmission error), ``keyNo`` is None
+    while the session is not authenticated.
+    """
+
+    __slots__ = ('aid', 'keyNo', 'keyType', 'key')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Nothing is known about the card"""
+        self.aid = None
+        self.dropAuthentication()
+
+    def dropAuthentication(self):
+        self.keyNo = None
+        self.keyType = None
+        self.key = None
+
+    def select(self, aid):
+        self.aid = bytes(aid)
+        self.dropAuthentication()
+
+    def authenticate(self, keyNo, keyType, key):
+        self.keyNo = keyNo
+        self.keyType = keyType
+        self.key = bytes(key)
+
+    @property
+    def isAuthenticated(self):
+        return self.keyNo is not None
+
+    def isSelected(self, aid):
+        return self.aid is not None and self.aid == bytes(aid)
+
+    def isAuthenticatedWith(self, keyNo, key):
+        return self.keyNo == keyNo and self.keyType == key.GetKeyType() and self.key == bytes(key.getKey())
+
+    def __repr__(self):
+        aid = self.aid.hex() if self.aid is not None else '?'
+        return 'DESFireSessionState(aid=%s, keyNo=%s)' % (aid, self.keyNo)
+
+class DESFireWriteStats(namedtuple('DESFireWriteStats', 'size ranges bytesWritten apdus fullApdus read')):
+    """Result of :py:meth:`DESFire.updateFileData`.
+
+    ``size`` is the length of the wanted contents, ``ranges`` the written (start, end) ranges relative to the offset,
+    ``apdus`` the WriteData frames sent and ``fullApdus`` the frames rewriting everything would have needed.
+    ``read`` tells if the current contents were read from the card first.
+    """
+
+    __slots__ = ()
+
+    @property
+    def bytesSaved(self):
+        return self.size - self.bytesWritten
+
+    @property
+    def apdusSaved(self):
+        return self.fullApdus - self.apdus
+
+
 class DESFire:
-    def __init__(self, device, logger=None):
+    def __init__(self, device, logger=None, trace=None, metadataCache=None, wrapped=False, extendedLength=False, metrics=None):
         self.isAuthenticated = False
         self.sessionKey = None
         self.cmac = None
-        self.MaxFrameSize=60
+        #: Largest native frame sent to the card, see :py:func:`desfire.frames.negotiateFrameSize`
+        self.MaxFrameSize=MAX_FRAME_SIZE
+        self.MacChunkSize=512
         """
         :param device: :py:class:`desfire.device.Device` implementation
         :param logger: Python :py:class:`logging.Logger` used for logging output. Overrides the default logger. Extensively uses ``INFO`` logging level.
+        :param trace: Optional :py:class:`desfire.trace.APDUTrace` recording every exchanged frame
+        :param metadataCache: Optional :py:class:`desfire.cache.MetadataCache` for application IDs, file IDs, file and key settings
+        :param wrapped: Send every command ISO 7816-4 wrapped (``90 cmd 00 00 Lc data 00``) instead of native framing
+        :param extendedLength: The reader supports extended length APDUs, wrapped frames may carry more than 255 bytes.
+                               Says nothing about the card, frames only grow beyond 60 bytes by
+                               :py:func:`desfire.frames.negotiateFrameSize`
+        :param metrics: Optional :py:class:`desfire.metrics.Metrics` counting calls, bytes, statuses and latency per command
         """
 
         #assert isinstance(device, Device), "Not a compatible device instance: {}".format(device)
@@ -45,6 +122,27 @@ class DESFire:
         else:
             self.logger = _logger
 
+        #: Opt-in :py:class:`desfire.trace.APDUTrace`, None disables tracing
+        self.trace = trace
+
+        #: Selected application and authenticated key as far as known, see :py:meth:`ensureApplication`
+        self.state = DESFireSessionState()
+
+        #: ISO 7816-4 wrapped transport, the card answers ``data 91 status``
+        self.wrapped = wrapped
+        #: Use extended length APDUs for wrapped frames longer than 255 bytes
+        self.extendedLength = extendedLength
+
+        #: Opt-in :py:class:`desfire.cache.MetadataCache`, used once the card UID is known
+        self.metadataCache = metadataCache
+        #: UID of the card, set by :py:meth:`getCardVersion`
+        self.cardUID = None
+
+        #: Opt-in :py:class:`desfire.metrics.Metrics`, None disables metrics
+        self.metrics = metrics
+        #: :py:class:`desfire.metrics.Measurement` of the running command
+        self._measurement = None
+
 
     def decrypt_response(self, response, private_key=b"\00" * 16, session_key=None):
         """Decrypt the autheticated session answer from the card.
@@ -58,6 +156,23 @@ class DESFire:
         decrypted = [b for b in (k.decrypt(bytes(response)))]
         import pdb ; pdb.set_trace()
 
+    @contextmanager
+    def _measure(self, cmd):
+        """Collects the traffic of one command (all its frames) and records it in :py:attr:`metrics`"""
+        measurement = self._measurement = Measurement(cmd)
+        start = time.perf_counter()
+        try:
+            yield measurement
+        except DESFireCommunicationError:
+            raise
+        except Exception:
+            # No card status, e.g. transmission error or wrong CMAC
+            measurement.status = None
+            raise
+        finally:
+            self._measurement = None
+            self.metrics.record(measurement, time.perf_counter() - start)
+
     def authenticate(self, key_id, key, challenge = None):
         """Does authentication to the currently selected application with keyid (key_id)
         Authentication is NEVER needed to call this function.
@@ -71,63 +186,77 @@ class DESFire:
         Returns:
                 DESFireKey : the session key used for future communications with the card in the same session
         """
+        if self.metrics is not None and self._measurement is None:
+            # Both legs and the local crypto count as one authentication
+            if key.GetKeyType() == DESFireKeyType.DF_KEY_AES:
+                cmd = DFEV1_INS_AUTHENTICATE_AES
+            else:
+                cmd = DFEV1_INS_AUTHENTICATE_ISO
+            with self._measure(cmd):
+                return self._authenticate(key_id, key, challenge)
+        return self._authenticate(key_id, key, challenge)
+
+    def _authenticate(self, key_id, key, challenge):
         sessionKey = None
         self.logger.debug('Authenticating')
         self.isAuthenticated = False
+        self.state.dropAuthentication()
         cmd = None
         keyType = key.GetKeyType()
         if keyType == DESFireKeyType.DF_KEY_AES:
-            cmd = DESFireCommand.DFEV1_INS_AUTHENTICATE_AES.value
+            cmd = DFEV1_INS_AUTHENTICATE_AES
             params = [ key_id ]
         elif keyType == DESFireKeyType.DF_KEY_2K3DES or keyType == DESFireKeyType.DF_KEY_3K3DES:
-            cmd = DESFireCommand.DFEV1_INS_AUTHENTICATE_ISO.value
+            cmd = DFEV1_INS_AUTHENTICATE_ISO
             params = [ key_id ]
         else:
             raise Exception('Invalid key type!')
 
         raw_data = self.communicate(self.command(cmd,params),"Authenticating key {:02X}".format(key_id),True, allow_continue_fallthrough=True)
         RndB_enc = raw_data
-        self.logger.debug( 'Random B (enc):'+ byte_array_to_human_readable_hex(RndB_enc))
+        self.logger.debug('Random B (enc):%s', LazyHex(RndB_enc))
         if keyType == DESFireKeyType.DF_KEY_3K3DES or keyType == DESFireKeyType.DF_KEY_AES:
             if len(RndB_enc) != 16:
                 raise DESFireAuthException('Card expects a different key type. (enc B size is less than the blocksize of the key you specified)')
 
         key.CiperInit()
         RndB = key.Decrypt(RndB_enc)
-        self.logger.debug( 'Random B (dec): ' + byte_array_to_human_readable_hex(RndB))
-        RndB_rot = RndB[1:]+[RndB[0]]
-        self.logger.debug( 'Random B (dec, rot): ' + byte_array_to_human_readable_hex(RndB_rot))
+        self.logger.debug('Random B (dec): %s', LazyHex(RndB))
+        RndB_rot = RndB[1:]+RndB[:1]
+        self.logger.debug('Random B (dec, rot): %s', LazyHex(RndB_rot))
 
         if challenge != None:
             RndA = bytes(bytearray.fromhex(challenge))
         else:
-            RndA = Random.get_random_bytes(len(RndB))
-        self.logger.debug( 'Random A: ' + byte_array_to_human_readable_hex(RndA))
-        RndAB = list(RndA) + RndB_rot
-        self.logger.debug( 'Random AB: ' + byte_array_to_human_readable_hex(RndAB))
+            # A device may supply the challenge, see desfire.replay
+            randomBytes = getattr(self.device, 'randomBytes', None) or Random.get_random_bytes
+            RndA = randomBytes(len(RndB))
+        self.logger.debug('Random A: %s', LazyHex(RndA))
+        RndAB = RndA + RndB_rot
+        self.logger.debug('Random AB: %s', LazyHex(RndAB))
         RndAB_enc = key.Encrypt(RndAB)
-        self.logger.debug( 'Random AB (enc): ' + byte_array_to_human_readable_hex(RndAB_enc))
+        self.logger.debug('Random AB (enc): %s', LazyHex(RndAB_enc))
 
         params = RndAB_enc 
-        cmd = DESFireCommand.DF_INS_ADDITIONAL_FRAME.value
+        cmd = DF_INS_ADDITIONAL_FRAME
         raw_data = self.communicate(self.command(cmd,params),"Authenticating random {:02X}".format(key_id),True, allow_continue_fallthrough=True)
         #raw_data = hexstr2bytelist('91 3C 6D ED 84 22 1C 41')
         RndA_enc = raw_data
-        self.logger.debug('Random A (enc): ' + byte_array_to_human_readable_hex(RndA_enc))
+        self.logger.debug('Random A (enc): %s', LazyHex(RndA_enc))
         RndA_dec = key.Decrypt(RndA_enc)
-        self.logger.debug( 'Random A (dec): ' + byte_array_to_human_readable_hex(RndA_dec))
+        self.logger.debug('Random A (dec): %s', LazyHex(RndA_dec))
         RndA_dec_rot = RndA_dec[-1:] + RndA_dec[0:-1] 
-        self.logger.debug( 'Random A (dec, rot): ' + byte_array_to_human_readable_hex(RndA_dec_rot))
+        self.logger.debug('Random A (dec, rot): %s', LazyHex(RndA_dec_rot))
 
-        if bytes(RndA) != bytes(RndA_dec_rot):
+        if RndA != RndA_dec_rot:
             raise Exception('Authentication FAILED!')
 
         self.logger.debug( 'Authentication succsess!')
         self.isAuthenticated = True
         self.lastAuthKeyNo = key_id
+        self.state.authenticate(key_id, keyType, key.getKey())
 
         self.logger.debug( 'Calculating Session key')
-        RndA = list(RndA)
         sessionKeyBytes  = RndA[:4]
         sessionKeyBytes += RndB[:4]
 
@@ -145,43 +274,89 @@ class DESFire:
                 sessionKeyBytes += RndB[12:16]
 
         if keyType == DESFireKeyType.DF_KEY_2K3DES or keyType == DESFireKeyType.DF_KEY_3K3DES:
-            sessionKeyBytes = [( a & 0b11111110 ) for a in sessionKeyBytes ]    
+            sessionKeyBytes = bytes(( a & 0b11111110 ) for a in sessionKeyBytes )
         ## now we have the session key, so we reinitialize the crypto!!!
         key.GenerateCmac(sessionKeyBytes)
         self.sessionKey = key
         return self.sessionKey 
 
-    def _communicate(self, apdu_cmd, description,nativ=False, allow_continue_fallthrough=False):
+    def _communicate(self, apdu_cmd, description,nativ=False, allow_continue_fallthrough=False, additional_frames=None, rxCmac=None):
         """Communicate with a NFC tag.
         Send in outgoing request and waith for a card reply.
         TODO: Handle additional framing via 0xaf
         :param apdu_cmd: Outgoing APDU command as array of bytes
         :param description: Command description for logging purposes
+        :param nativ: True if ``apdu_cmd`` is a native frame, it is wrapped when :py:attr:`wrapped` is set.
+                      False if it is already wrapped (see :py:meth:`wrap_command`)
         :param allow_continue_fallthrough: If True 0xAF response (incoming more data, need mode data) is instantly returned to the called instead of trying to handle it internally
+        :param additional_frames: Frames (starting with 0xAF) sent one by one while the card asks for more data with 0xAF
+        :param rxCmac: Optional streaming :py:class:`CMAC` fed with the received data as the frames arrive, except the last 8 bytes (the CMAC of the card)
         :raise: :py:class:`desfire.protocol.DESFireCommunicationError` on any error
-        :return: tuple(APDU response as list of bytes, bool if additional frames are inbound)
+        :return: bytearray with the data of all received frames
         """
 
-        result = []
+        result = bytearray()
+        macced = 0
         additional_framing_needed = True
+        # Wrapped answers carry the status in SW2 after SW1 0x91
+        wrapped = self.wrapped or not nativ
+        if self.wrapped and nativ:
+            apdu_cmd = self.wrap(apdu_cmd)
 
         # TODO: Clean this up so readgwrite implementations have similar mechanisms and all continue is handled internally
         while additional_framing_needed:
 
-            self.logger.debug("Running APDU command %s, sending: %s", description, byte_array_to_human_readable_hex(apdu_cmd))
-
-            resp = self.device.transceive(apdu_cmd)
-            self.logger.debug("Received APDU response: %s", byte_array_to_human_readable_hex(resp))
-
-
-            if not nativ:
-                if resp[-2] != 0x91:
-                    raise DESFireCommunicationError("Received invalid response for command: {}".format(description), resp[-2:])
-            # Possible status words: https:g/github.com/jekkos/android-hce-desfire/blob/master/hceappletdesfire/src/main/java/net/jpeelaer/hce/desfire/DesfireStatusWord.java
+            self.logger.debug("Running APDU command %s, sending: %s", description, LazyHex(apdu_cmd))
+
+            trace = self.trace
+            measurement = self._measurement
+            try:
+                if trace is not None or measurement is not None:
+                    start = time.time()
+                    clock = time.perf_counter()
+                    resp = self.device.transceive(apdu_cmd)
+                    elapsed = time.perf_counter() - clock
+                    if trace is not None:
+                        if wrapped:
+                            trace.record(apdu_cmd, resp, start, elapsed, resp[-1] if resp else None, apdu_cmd[1])
+                        else:
+                            trace.record(apdu_cmd, resp, start, elapsed)
+                    if measurement is not None:
+                        measurement.transceive += elapsed
+                        measurement.bytesOut += len(apdu_cmd)
+                        measurement.bytesIn += len(resp)
+                else:
+                    resp = self.device.transceive(apdu_cmd)
+            except Exception:
+                # Nobody knows what the card received, the CMAC chain is lost either way
+                self.isAuthenticated = False
+                self.cmac = None
+                self.state.reset()
+                raise
+            self.logger.debug("Received APDU response: %s", LazyHex(resp))
+
+
+            # Copy the frame into our own buffer, so no memoryview of the device
+            # buffer escapes (there seems to be some pyjnius bug corrupting it)
+            if isinstance(resp, list):
+                resp = bytes(resp)
+            if wrapped:
+                # Possible status words: https:g/github.com/jekkos/android-hce-desfire/blob/master/hceappletdesfire/src/main/java/net/jpeelaer/hce/desfire/DesfireStatusWord.java
+                if len(resp) < 2 or resp[-2] != 0x91:
+                    self.isAuthenticated = False
+                    self.state.dropAuthentication()
+                    sw = int.from_bytes(resp[-2:], 'big')
+                    if measurement is not None:
+                        measurement.status = sw
+                    raise DESFireCommunicationError("Received invalid response for command {}: SW {:04X}".format(description, sw), sw)
                 status = resp[-1]
-                unframed = list(resp[0:-2]) 
+                data = memoryview(resp)[:-2]
+            else:
+                status = resp[0]
+                data = memoryview(resp)[1:]
+            if measurement is not None:
+                measurement.status = status
 
-            status = resp[0] 
             # Check for known error interpretation
             if status == 0xaf:
                 if allow_continue_fallthrough:
@@ -189,28 +364,50 @@ class DESFire:
                 else:
                     # Need to loop more cycles to fill in receive buffer
                     additional_framing_needed = True
-                    apdu_cmd = self.command(0xaf)  # Continue
+                    if additional_frames:
+                        apdu_cmd = additional_frames.pop(0)
+                    else:
+                        apdu_cmd = self.command(0xaf)  # Continue
+                    if wrapped:
+                        apdu_cmd = self.wrap(apdu_cmd)
             elif status != 0x00:
-                raise DESFireCommunicationError(DESFire_STATUS(status).name, status)
+                # Every error ends the authenticated session on the card
+                self.isAuthenticated = False
+                self.state.dropAuthentication()
+                raise DESFireCommunicationError(STATUS_NAMES[status], status)
             else:
                 additional_framing_needed = False
 
-            # This will un-memoryview this object as there seems to be some pyjnius
-            # bug getting this corrupted down along the line
-            unframed = list(resp[1:])
-            result += unframed
+            result += data
+
+            # Feed the CMAC in chunks of a few frames, every call into the cipher has a fixed cost
+            if rxCmac is not None and len(result) - 8 - macced >= self.MacChunkSize:
+                with memoryview(result) as view:
+                    rxCmac.update(view[macced:-8])
+                macced = len(result) - 8
+
+        if rxCmac is not None and len(result) - 8 > macced:
+            with memoryview(result) as view:
+                rxCmac.update(view[macced:-8])
 
         return result
 
-    def communicate(self, apdu_cmd,description, nativ=False, allow_continue_fallthrough=False, isEncryptedComm = False, withTXCMAC = False, withCRC=False,withRXCMAC=True, encryptBegin=1):
+    def communicate(self, apdu_cmd,description, nativ=False, allow_continue_fallthrough=False, isEncryptedComm = False, withTXCMAC = False, withCRC=False,withRXCMAC=True, encryptBegin=1, txChaining=False):
         """
         cmd : the DESFire instruction byte (in hex format)
         data: optional parameters (in hex format)
         isEncryptedComm: bool indicates if the communication should be sent encrypted
         withTXCMAC: bool indicates if CMAC should be calculated
         autorecieve: bool indicates if the receptions should implement paging in case there is more deata to be sent by the card back then the max message size
+        txChaining: bool indicates if a command longer than MaxFrameSize is sent in additional frames (0xAF). The CMAC covers the whole command
+        Returns a bytearray with the response data (without status byte and CMAC)
         """
-        result = []
+        if self.metrics is not None and self._measurement is None:
+            with self._measure(apdu_cmd[0] if nativ else apdu_cmd[1]):
+                return self._command(apdu_cmd, description, nativ, allow_continue_fallthrough, isEncryptedComm, withTXCMAC, withCRC, withRXCMAC, encryptBegin, txChaining)
+        return self._command(apdu_cmd, description, nativ, allow_continue_fallthrough, isEncryptedComm, withTXCMAC, withCRC, withRXCMAC, encryptBegin, txChaining)
+
+    def _command(self, apdu_cmd, description, nativ, allow_continue_fallthrough, isEncryptedComm, withTXCMAC, withCRC, withRXCMAC, encryptBegin, txChaining):
 
         #sanity check
         if withTXCMAC or isEncryptedComm:
@@ -224,56 +421,104 @@ class DESFire:
             #calculate cmac for outgoing message
         if withTXCMAC:
             TXCMAC = self.sessionKey.CalculateCmac(apdu_cmd)
-            self.logger.debug("TXCMAC      : " + byte_array_to_human_readable_hex(TXCMAC))
-        response = self._communicate(apdu_cmd,description,nativ, allow_continue_fallthrough)
+            self.logger.debug("TXCMAC      : %s", LazyHex(TXCMAC))
+        additional_frames = None
+        if txChaining and len(apdu_cmd) > self.MaxFrameSize:
+            cmd = DF_INS_ADDITIONAL_FRAME
+            with memoryview(apdu_cmd) as view:
+                additional_frames = [self.command(cmd, view[i:i+self.MaxFrameSize-1]) for i in range(self.MaxFrameSize, len(apdu_cmd), self.MaxFrameSize-1)]
+                apdu_cmd = view[:self.MaxFrameSize].tobytes()
+        # The received data is MACed frame by frame while it arrives
+        rxCmac = self.sessionKey.cmac if self.isAuthenticated and withRXCMAC else None
+        response = self._communicate(apdu_cmd,description,nativ, allow_continue_fallthrough, additional_frames, rxCmac)
         
         if self.isAuthenticated and len(response) >= 8 and withRXCMAC:
             #after authentication, there is always an 8 bytes long CMAC coming from the card, to ensure message integrity
-            #todo: verify CMAC
-            if len(response) == 8:
-                #if self.sessionKey.keyType == DESFireKeyType.DF_KEY_3DES or self.sessionKey.keyType == DESFireKeyType.DF_KEY_2K3DES or self.sessionKey.keyType == DESFireKeyType.DF_KEY_3K3DES:
-                RXCMAC = response
-                response = []
-                #else:
-                #    #there is no CMAC
-                #    return response
-            else:
-                RXCMAC = response[-8:]
-                response = response[:-8]
-
-            #if response == "":
-            #    response = []
-            cmacdata = response + [0x00]
-            RXCMAC_CALC = self.sessionKey.CalculateCmac(cmacdata)
-            self.logger.debug("RXCMAC      : " + byte_array_to_human_readable_hex(RXCMAC))
-            self.logger.debug("RXCMAC_CALC: " + byte_array_to_human_readable_hex(RXCMAC_CALC))
+            RXCMAC = bytes(response[-8:])
+            del response[-8:]
+
+            # The CMAC is calculated over the data and the status byte
+            RXCMAC_CALC = rxCmac.update(b'\x00').digest()
+            self.logger.debug("RXCMAC      : %s", LazyHex(RXCMAC))
+            self.logger.debug("RXCMAC_CALC: %s", LazyHex(RXCMAC_CALC))
             self.cmac=RXCMAC_CALC
-            if bytes(RXCMAC) != bytes(RXCMAC_CALC[0:len(RXCMAC)]):
+            if RXCMAC != RXCMAC_CALC[0:len(RXCMAC)]:
                 raise Exception("RXCMAC not equal")
 
         return response
     @classmethod
-    def wrap_command(cls, command, parameters=None):
-        """Wrap a command to native DES framing.
+    def wrap_command(cls, command, parameters=None, extended=False):
+        """Wrap a command to ISO 7816-4 framing (``90 cmd 00 00 Lc parameters 00``).
         :param command: Command byte
-        :param parameters: Command parameters as list of bytes
+        :param parameters: Command parameters as bytes-like object or list of bytes
+        :param extended: Use extended length (3 byte Lc, 2 byte Le), needed for more than 255 bytes of parameters
         https:g/github.com/greenbird/workshops/blob/master/mobile/Android/Near%20Field%20Communications/HelloWorldNFC%20Desfire%20Base/src/com/desfire/nfc/DesfireReader.java#L129
+        :return: bytearray with the APDU
         """
-        if parameters:
-            return [0x90, command, 0x00, 0x00, len(parameters)] + parameters + [0x00]
+        l=bytearray((0x90, command, 0x00, 0x00))
+        if not parameters:
+            l += b'\x00\x00\x00' if extended else b'\x00'
+        elif extended:
+            l += b'\x00' + len(parameters).to_bytes(2, 'big')
+            l.extend(parameters)
+            l += b'\x00\x00'
+        elif len(parameters) > 255:
+            raise Exception('%d bytes of parameters need an extended length APDU' % (len(parameters),))
         else:
-            return [0x90,command,0x00,0x00,0x00]
+            l.append(len(parameters))
+            l.extend(parameters)
+            l.append(0x00)
+        return l
+
+    def wrap(self, frame):
+        """Wraps a native frame (command byte and parameters) for the ISO 7816-4 transport"""
+        with memoryview(frame) as view:
+            return self.wrap_command(view[0], view[1:], self.extendedLength and len(view) > 256)
 
     @classmethod
     def command(cls,command,parameters=None):
+        """Builds a native command.
+        :param command: Command byte
+        :param parameters: Command parameters as bytes-like object or list of bytes
+        :return: bytearray with the command
+        """
+        l=bytearray((command,))
         if parameters:
-            l=[command]
-            l=l+parameters
-            return l 
-        else:
-            return [command]
+            l.extend(parameters)
+        return l
+
 
 
+    def _cachedQuery(self, key, apdu_cmd, description):
+        """Sends a metadata query unless :py:attr:`metadataCache` has the answer for the selected application of this card.
+        Only the raw answer is cached, so every call parses fresh objects.
+        """
+        cache = self.metadataCache
+        if cache is None or self.cardUID is None or self.state.aid is None:
+            return self.communicate(apdu_cmd, description, nativ=True, withTXCMAC=self.isAuthenticated)
+        raw_data = cache.get(self.cardUID, self.state.aid, key)
+        if raw_data is None:
+            raw_data = bytes(self.communicate(apdu_cmd, description, nativ=True, withTXCMAC=self.isAuthenticated))
+            cache.put(self.cardUID, self.state.aid, key, raw_data)
+        return raw_data
+
+    def _invalidateMetadata(self, key=None, aid=None, allApplications=False):
+        """Drops cached metadata before a command changes it.
+        ``aid`` defaults to the selected application, if that is unknown everything of the card is dropped.
+        """
+        cache = self.metadataCache
+        if cache is None or self.cardUID is None:
+            return
+        if aid is None:
+            aid = self.state.aid
+        if allApplications or aid is None:
+            cache.invalidate(self.cardUID)
+        else:
+            cache.invalidate(self.cardUID, aid, key)
+
+    def _invalidateFile(self, fileId):
+        self._invalidateMetadata(('fileIDs',))
+        self._invalidateMetadata(('fileSettings', getInt(fileId,'big')))
 
     def getApplicationIDs(self):
         """Lists all application on the card
@@ -284,27 +529,25 @@ class DESFire:
                 list: A list of application IDs, in a 4 byte hex form
         """
         self.logger.debug("GetApplicationIDs")
-        appids = []
-        cmd = DESFireCommand.DF_INS_GET_APPLICATION_IDS.value
-        raw_data = self.communicate([cmd], 'Get Application IDs',nativ=True, withTXCMAC=self.isAuthenticated)
-
-        pointer = 0
-        apps = []
-        while pointer < len(raw_data):
-                appid = [raw_data[pointer+2]] + [raw_data[pointer+1]] + [raw_data[pointer]]
-                self.logger.debug("Reading %s", byte_array_to_human_readable_hex(appid))
-                apps.append(appid)
-                pointer += 3
+        cmd = DF_INS_GET_APPLICATION_IDS
+        raw_data = self._cachedQuery(('applicationIDs',), self.command(cmd), 'Get Application IDs')
+        self.logger.debug("Application IDs (LSB first): %s", LazyHex(raw_data))
+        return parseApplicationIDs(raw_data)
 
-        return apps
 
+    def getKeySettingRaw(self):
+        """Gets the key settings of the selected application as sent by the card
+        Returns:
+            bytes: key settings byte, key count ORed with the key type
+        """
+        return bytes(self._cachedQuery(('keySettings',), self.command(DF_INS_GET_KEY_SETTINGS), "get key settings"))
 
     def getKeySetting(self):
         ret=DESFireKey()
         parameters=[]
         #apdu_command = self.command(DESFire_DEF.DF_INS_GET_KEY_SETTINGS.value)
-        resp=self.communicate([DESFireCommand.DF_INS_GET_KEY_SETTINGS.value], "get key settings", nativ=True, withTXCMAC=self.isAuthenticated)
-        ret.setKeySettings(resp[1] & 0x0f,DESFireKeyType(resp[1] & 0xf0),resp[0] & 0x07)
+        settings, keyCount, keyType = parseKeySettings(self.getKeySettingRaw())
+        ret.setKeySettings(keyCount,KEY_TYPE_TABLE[keyType],settings & 0x07)
         return ret
 
     def getCardVersion(self):
@@ -318,9 +561,12 @@ class DESFire:
                 DESFireCardVersion: Object containing all card version info parsed
         """
         self.logger.debug('Getting card version info')
-        cmd = DESFireCommand.DF_INS_GET_VERSION.value
-        raw_data = self.communicate([cmd], 'GetCardVersion',nativ=True, withTXCMAC=self.isAuthenticated) 
-        return DESFireCardVersion(raw_data)
+        cmd = DF_INS_GET_VERSION
+        raw_data = self.communicate(self.command(cmd), 'GetCardVersion',nativ=True, withTXCMAC=self.isAuthenticated) 
+        version = DESFireCardVersion(list(raw_data))
+        # a random UID changes on every call, so the metadata cache simply misses for such cards
+        self.cardUID = bytes(version.UID)
+        return version
 
 
 
@@ -334,8 +580,9 @@ class DESFire:
             None
         """
         self.logger.debug('Formatting card')
-        cmd = DESFireCommand.DF_INS_FORMAT_PICC.value
-        self.communicate([cmd], 'Format Card',nativ=True, withTXCMAC=self.isAuthenticated)
+        cmd = DF_INS_FORMAT_PICC
+        self._invalidateMetadata(allApplications=True)
+        self.communicate(self.command(cmd), 'Format Card',nativ=True, withTXCMAC=self.isAuthenticated)
 
 
     ###### Application related
@@ -350,16 +597,67 @@ class DESFire:
             None
         """
         appid = getList(appid,3,'big')
-        self.logger.debug('Selecting application with AppID %s' % (byte_array_to_human_readable_hex(appid),))
+        self.logger.debug('Selecting application with AppID %s', LazyHex(appid))
         
         parameters =  [ appid[2], appid[1], appid[0] ]
         
 
-        cmd = DESFireCommand.DF_INS_SELECT_APPLICATION.value
+        cmd = DF_INS_SELECT_APPLICATION
+        self.state.reset()
         self.communicate(self.command(cmd, parameters),'select Application',nativ=True)
         #if new application is selected, authentication needs to be carried out again
         self.isAuthenticated = False
         self.lastSelectedApplication = appid
+        self.state.select(appid)
+
+    def ensureApplication(self, appid):
+        """Selects the application unless it is already selected (see :py:attr:`state`).
+        Args:
+            appid (int): The application ID of the app to be selected
+        Returns:
+            bool: True if SelectApplication was sent
+        """
+        if self.state.isSelected(getBytes(appid,3)):
+            return False
+        self.selectApplication(appid)
+        return True
+
+    def ensureAuthenticated(self, key_id, key, challenge = None):
+        """Authenticates with the key unless the session is already authenticated with it (see :py:attr:`state`).
+        Args:
+            key_id  (int)         : Key number
+            key (DESFireKey)      : The key used for authentication
+        Returns:
+            bool: True if the authentication was carried out
+        """
+        if self.isAuthenticated and self.state.isAuthenticatedWith(key_id, key):
+            return False
+        self.authenticate(key_id, key, challenge)
+        return True
+
+    def withSession(self, appid, key_id, key, operation, *args, **kwargs):
+        """Runs ``operation(*args, **kwargs)`` in the application, authenticated with the key.
+        Select and authentication are only sent if needed. If the card answers ST_AuthentError (e.g. it lost the
+        session), the application is selected and authenticated again and the operation is retried once.
+        Args:
+            appid (int)           : The application ID
+            key_id  (int)         : Key number, None to run unauthenticated
+            key (DESFireKey)      : The key used for authentication
+            operation (callable)  : Typically a bound method of this object, e.g. ``desfire.readFileData``
+        Returns:
+            The result of the operation
+        """
+        for attempt in (0, 1):
+            self.ensureApplication(appid)
+            if key_id is not None:
+                self.ensureAuthenticated(key_id, key)
+            try:
+                return operation(*args, **kwargs)
+            except DESFireCommunicationError as e:
+                if attempt or e.status_code != ST_AuthentError:
+                    raise
+                self.logger.debug('Card lost the session, authenticating again')
+                self.state.reset()
 
     def createApplication(self, appid, keysettings, keycount, type):
         """Creates application on the card with the specified settings
@@ -373,11 +671,13 @@ class DESFire:
             None
         """
         appid = getList(appid,3,'big')
-        self.logger.debug('Creating application with appid: %s, ' %(byte_array_to_human_readable_hex(appid)))
+        self.logger.debug('Creating application with appid: %s, ', LazyHex(appid))
         appid = [appid[2],appid[1],appid[0]]
         keycount=getInt(keycount,'big')
         params = appid + [calc_key_settings(keysettings)] + [keycount|type.value]
-        cmd = DESFireCommand.DF_INS_CREATE_APPLICATION.value
+        cmd = DF_INS_CREATE_APPLICATION
+        self._invalidateMetadata(('applicationIDs',))
+        self._invalidateMetadata(aid=bytes(appid[::-1]))
         self.communicate(self.command(cmd, params),'cereate application',nativ=True, withTXCMAC=self.isAuthenticated)
 
     def deleteApplication(self, appid):
@@ -389,13 +689,17 @@ class DESFire:
             None
         """
         appid = getList(appid,3,'big')
-        self.logger.debug('Deleting application for AppID %s', byte_array_to_human_readable_hex(appid))
+        self.logger.debug('Deleting application for AppID %s', LazyHex(appid))
 
         appid = [ appid[2], appid[1], appid[0] ]
 
         params = appid
-        cmd = DESFireCommand.DF_INS_DELETE_APPLICATION.value
+        cmd = DF_INS_DELETE_APPLICATION
+        self._invalidateMetadata(('applicationIDs',))
+        self._invalidateMetadata(aid=bytes(appid[::-1]))
         self.communicate(self.command(cmd, params),'delete Application',nativ=True, withTXCMAC=self.isAuthenticated)
+        if self.state.isSelected(appid[::-1]):
+            self.state.reset()
 
 ###################################################################################################################
 ### This Function is not refecored 
@@ -412,17 +716,14 @@ class DESFire:
             list: A list of file IDs, in a 4 byte hex form
         """
         self.logger.debug('Enumerating all files for the selected application')
-        fileIDs = []
 
-        cmd = DESFireCommand.DF_INS_GET_FILE_IDS.value
-        raw_data = self.communicate([cmd], 'get File ID\'s',nativ=True, withTXCMAC=self.isAuthenticated)
+        cmd = DF_INS_GET_FILE_IDS
+        raw_data = self._cachedQuery(('fileIDs',), self.command(cmd), 'get File ID\'s')
         if len(raw_data) == 0:
             self.logger.debug("No files found")
         else:
-            for byte in raw_data:
-                fileIDs.append(byte)
-            self.logger.debug("File ids: %s" % (''.join([byte_array_to_human_readable_hex(bytearray([id])) for id in fileIDs]),))
-        return fileIDs
+            self.logger.debug("File ids: %s", LazyHex(raw_data))
+        return parseFileIDs(raw_data)
 
     def getFileSettings(self, fileid):
         """Gets file settings for the File identified by fileid.(SelectApplication needs to be called first)
@@ -433,64 +734,164 @@ class DESFire:
         Returns:
             DESFireFileSettings: An object describing all settings for the file
         """
-        fileid=getList(fileid,1,'big')
-        self.logger.debug('Getting file settings for file %s' % (byte_array_to_human_readable_hex(fileid),))
-
-        cmd = DESFireCommand.DF_INS_GET_FILE_SETTINGS.value
-        raw_data = raw_data = self.communicate(self.command(cmd, fileid),'Get File Settings',nativ=True, withTXCMAC=self.isAuthenticated)
-
         file_settings = DESFireFileSettings()
-        file_settings.parse(raw_data)
+        file_settings.parse(self.getFileSettingsRaw(fileid))
         return file_settings
 
-    def readFileData(self,fileId,offset,length):
+    def getFileSettingsRaw(self, fileid):
+        """Gets the file settings for the File identified by fileid as sent by the card (see :py:meth:`getFileSettings`)
+        Args:
+            fileid (int): FileID to get the settings for
+
+        Returns:
+            bytes: file type, communication mode, access rights and the type specific settings
+        """
+        fileid=getBytes(fileid,1)
+        self.logger.debug('Getting file settings for file %s', LazyHex(fileid))
+
+        cmd = DF_INS_GET_FILE_SETTINGS
+        return bytes(self._cachedQuery(('fileSettings', fileid[0]), self.command(cmd, fileid),'Get File Settings'))
+
+    def readFileData(self,fileId,offset,length,chained=False):
         """Read file data for fileID (SelectApplication needs to be called first)
         Authentication is NOT ALWAYS needed to call this function. Depends on the application/card settings.
         Args:
             fileid (int): FileID to get the settings for
+            offset (int): Offset of the first byte to read
+            length (int): Number of bytes to read. With ``chained`` 0 reads up to the end of the file
+            chained (bool): Read everything with one ReadData command. The card sends the data in
+                            additional frames (0xAF) and one CMAC over the whole response is verified
+        Returns:
+            list: the file data bytes, :py:meth:`readFileBytes` returns them without conversion
+        """
+        return list(self.readFileBytes(fileId,offset,length,chained))
+
+    def readFileBytes(self,fileId,offset,length,chained=False):
+        """Like :py:meth:`readFileData`, but returns the receive buffer as it is
         Returns:
-            str: the file data bytes
+            bytearray: the file data bytes
         """
-        fileId=getList(fileId,1)
+        fileId=getBytes(fileId,1)
         offset=getInt(offset,'big')
         length=getInt(length,'big')
         ioffset=0
-        ret=[]
-        
+        ret=bytearray()
+
+        if chained:
+            cmd=DF_INS_READ_DATA
+            params=fileId+offset.to_bytes(3,'little')+length.to_bytes(3,'little')
+            ret=self.communicate(self.command(cmd, params),'Read file data', nativ=True, withTXCMAC=self.isAuthenticated)
+            if length and len(ret) != length:
+                raise Exception('Received %d bytes, expected %d' % (len(ret), length))
+            return ret
+
         while (length > 0):
-            count=min(length, 48)
-            cmd=DESFireCommand.DF_INS_READ_DATA.value
-            params=fileId+getList(offset+ioffset,3,'little')+getList(count,3,'little')
+            count=min(length, self._readChunk())
+            cmd=DF_INS_READ_DATA
+            params=fileId+(offset+ioffset).to_bytes(3,'little')+count.to_bytes(3,'little')
             ret+=self.communicate(self.command(cmd, params),'Read file data', nativ=True, withTXCMAC=self.isAuthenticated)
             ioffset+=count
             length-=count
         
         return ret
 
-    def writeFileData(self,fileId,offset,length,data):
-        fileId=getList(fileId,1)
+    def writeFileData(self,fileId,offset,length,data,chained=False):
+        """Write file data for fileID (SelectApplication needs to be called first)
+        Authentication is NOT ALWAYS needed to call this function. Depends on the application/card settings.
+        Args:
+            fileid (int): FileID to write to
+            offset (int): Offset of the first byte to write
+            length (int): Number of bytes to write
+            data (bytes): The data bytes (bytes-like, list of bytes or hex string)
+            chained (bool): Write everything with one WriteData command, the data that does not fit
+                            into the first frame is sent in additional frames (0xAF)
+        """
+        fileId=getBytes(fileId,1)
         offset=getInt(offset,'big')
         length=getInt(length,'big')
-        data=getList(data)
+        data=memoryview(getBytes(data))
         ioffset=0
-        
+
+        if chained:
+            cmd=self.command(DF_INS_WRITE_DATA, fileId+offset.to_bytes(3,'little')+length.to_bytes(3,'little'))
+            cmd+=data[:length]
+            self.communicate(cmd,'write file data', nativ=True, withTXCMAC=self.isAuthenticated, txChaining=True)
+            return
+
         while (length > 0):
             count=min(length, self.MaxFrameSize-8)
-            cmd=DESFireCommand.DF_INS_WRITE_DATA.value
-            params=fileId+getList(offset+ioffset,3,'little')+getList(count,3,'little')+data[ioffset:(ioffset+count)]
-            self.communicate(self.command(cmd, params),'write file data', nativ=True, withTXCMAC=self.isAuthenticated)
+            cmd=self.command(DF_INS_WRITE_DATA, fileId+(offset+ioffset).to_bytes(3,'little')+count.to_bytes(3,'little'))
+            cmd+=data[ioffset:(ioffset+count)]
+            self.communicate(cmd,'write file data', nativ=True, withTXCMAC=self.isAuthenticated)
             ioffset+=count
             length-=count
 
+    def _readChunk(self):
+        """Bytes read per ReadData without chaining: the answer (status, data, CMAC) fits into one frame,
+        in whole cipher blocks"""
+        size = self.MaxFrameSize - 1 - 8
+        return size & ~15 or size
+
+    def _writeFrames(self, length, chained):
+        """Number of frames :py:meth:`writeFileData` sends for ``length`` bytes"""
+        if chained:
+            excess = 8 + length - self.MaxFrameSize
+            return 1 + max(0, -(-excess // (self.MaxFrameSize-1)))
+        return -(-length // (self.MaxFrameSize-8))
+
+    def updateFileData(self,fileId,data,previous=None,offset=0,chained=False,mergeGap=None):
+        """Writes only the bytes of ``data`` that differ from the file contents (SelectApplication needs to be called first)
+        Changed ranges closer than ``mergeGap`` bytes are written with one command, as resending the unchanged
+        bytes in between costs less than the header and response of another WriteData.
+        Args:
+            fileId (int): FileID to write to
+            data (bytes): The wanted contents starting at ``offset``
+            previous (bytes): The known current contents starting at ``offset`` (e.g. from a card image),
+                              None reads them from the card
+            offset (int): Offset of the first byte of ``data`` in the file
+            chained (bool): Passed to :py:meth:`writeFileData` and :py:meth:`readFileBytes` when reading the contents
+            mergeGap (int): Largest gap of unchanged bytes written over, by default the size of the command
+                            header plus status byte and CMAC of the answer
+        Returns:
+            DESFireWriteStats: the written ranges and the bytes and frames saved
+        """
+        offset=getInt(offset,'big')
+        data=getBytes(data)
+        if not data:
+            # a length of 0 would read the whole file
+            return DESFireWriteStats(0, [], 0, 0, 0, False)
+        read = previous is None
+        if read:
+            previous=self.readFileBytes(fileId,offset,len(data),chained=chained)
+        if mergeGap is None:
+            mergeGap = 8 + 1 + (8 if self.isAuthenticated else 0)
+
+        ranges=[]
+        for start, end in changedRanges(previous, data):
+            if ranges and start - ranges[-1][1] <= mergeGap:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+
+        apdus=0
+        with memoryview(data) as view:
+            for start, end in ranges:
+                self.writeFileData(fileId,offset+start,end-start,view[start:end],chained)
+                apdus+=self._writeFrames(end-start,chained)
+        return DESFireWriteStats(len(data), ranges, sum(end-start for start, end in ranges), apdus,
+                                 self._writeFrames(len(data),chained), read)
+
     def deleteFile(self,fileId):
-         return self.communicate(self.command(DESFireCommand.DF_INS_DELETE_FILE.value, getList(fileId,1,'little')),'Delete File', nativ=True, withTXCMAC=self.isAuthenticated)
+         self._invalidateFile(fileId)
+         return self.communicate(self.command(DF_INS_DELETE_FILE, getList(fileId,1,'little')),'Delete File', nativ=True, withTXCMAC=self.isAuthenticated)
 
     def createStdDataFile(self, fileId, filePermissions, fileSize):
          params=getList(fileId,1,'big')
          params+=[0x00]
          params+=getList(filePermissions.pack(),2,'big')
          params+=getList(getInt(fileSize,'big'),3, 'little')
-         apdu_command=self.command(DESFireCommand.DF_INS_CREATE_STD_DATA_FILE.value,params)
+         apdu_command=self.command(DF_INS_CREATE_STD_DATA_FILE,params)
+         self._invalidateFile(fileId)
          self.communicate(apdu_command,'createStdDataFile', nativ=True, withTXCMAC=self.isAuthenticated)
          return
 
@@ -504,11 +905,10 @@ class DESFire:
             fileId (int):  FileID to prepare the debit
             amount (int): The debit amount
         """
-        fileId=getList(fileId,1)
+        fileId=getBytes(fileId,1)
 
-        cmd=DESFireCommand.DF_INS_DEBIT.value
-        params=fileId
-        params+=getList(amount,4, 'little')
+        cmd=DF_INS_DEBIT
+        params=fileId+getBytes(amount,4,'little')
         self.communicate(self.command(cmd, params),'Debit Card', nativ=True, withTXCMAC=self.isAuthenticated)
 
     def credit(self,fileId,amount):
@@ -519,23 +919,22 @@ class DESFire:
             fileId (int): FileID to prepare the credit
             amount (int): The credit amount
         """
-        fileId=getList(fileId,1)
+        fileId=getBytes(fileId,1)
 
-        cmd=DESFireCommand.DF_INS_CREDIT.value
-        params=fileId
-        params+=getList(amount,4, 'little')
+        cmd=DF_INS_CREDIT
+        params=fileId+getBytes(amount,4,'little')
         self.communicate(self.command(cmd, params),'Debit Card', nativ=True, withTXCMAC=self.isAuthenticated)
     
     def commitTransaction(self):
         """Commit the prepared transaction
         """
-        cmd=DESFireCommand.DF_COMMIT_TRANSACTION.value
+        cmd=DF_COMMIT_TRANSACTION
         self.communicate(self.command(cmd),'Commit Transactions', nativ=True, withTXCMAC=self.isAuthenticated)
 
     def abortTransaction(self):
         """Abort the prepared transaction
         """
-        cmd=DESFireCommand.DF_INS_ABORT_TRANSACTION.value
+        cmd=DF_INS_ABORT_TRANSACTION
         self.communicate(self.command(cmd),'Commit Transactions', nativ=True, withTXCMAC=self.isAuthenticated)
 
 
@@ -548,12 +947,10 @@ class DESFire:
         Returns:
             int: The current value
         """
-        fileId=getList(fileId,1)
-        
-        cmd=DESFireCommand.DF_INS_GET_VALUE.value
-        params=getList(fileId)
+        cmd=DF_INS_GET_VALUE
+        params=getBytes(fileId,1)
         ret = self.communicate(self.command(cmd, params),'Read value', nativ=True, withTXCMAC=self.isAuthenticated)    
-        return int.from_bytes(ret, "little")
+        return parseValue(ret)
 
     def createValueFile(self, fileId, filePermissions, lowerLimit=0, upperLimit=10_000, value=0):
         """Creates an file to manage transactions
@@ -572,7 +969,8 @@ class DESFire:
         params+=getList(getInt(upperLimit,'big'),4, 'little')
         params+=getList(getInt(value,'big'),4, 'little')
         params+=getList(0x00,1)
-        apdu_command=self.command(DESFireCommand.DF_INS_CREATE_VALUE_FILE.value,params)
+        apdu_command=self.command(DF_INS_CREATE_VALUE_FILE,params)
+        self._invalidateFile(fileId)
         self.communicate(apdu_command,'createValueFile', nativ=True, withTXCMAC=self.isAuthenticated)
         return
     
@@ -587,15 +985,15 @@ class DESFire:
         Args:
             keyNo (int) : The key number
         Returns:
-            str: key version byte
+            list: the key version byte
         """
-        self.logger.debug('Getting key version for keyid %x' %(keyNo,))
+        self.logger.debug('Getting key version for keyid %x', keyNo)
 
         params = getList(keyNo,1,'big')
-        cmd = DESFireCommand.DF_INS_GET_KEY_VERSION.value
+        cmd = DF_INS_GET_KEY_VERSION
         raw_data = self.communicate(self.command(cmd, params),'get key version',nativ=True, withTXCMAC=self.isAuthenticated)
-        self.logger.debug('Got key version 0x%s for keyid %x' + str(keyNo))
-        return raw_data
+        self.logger.debug('Got key version 0x%s for keyid %x', LazyHex(raw_data), keyNo)
+        return list(raw_data)
 
     def changeKeySettings(self, newKeySettings):
         """Changes key settings for the key that was used to authenticate with in the current session.
@@ -608,7 +1006,8 @@ class DESFire:
         """
         #self.logger.debug('Changing key settings to %s' %('|'.join(a.name for a in newKeySettings),))
         params = [calc_key_settings(newKeySettings)]
-        cmd = DESFireCommand.DF_INS_CHANGE_KEY_SETTINGS.value
+        cmd = DF_INS_CHANGE_KEY_SETTINGS
+        self._invalidateMetadata(('keySettings',))
         raw_data = self.communicate(self.command(cmd,params),'change key settings', nativ=True, isEncryptedComm=True, withCRC=True)
 
 
@@ -630,8 +1029,8 @@ class DESFire:
         if not self.isAuthenticated:
             raise Exception('Not authenticated!')
 
-        self.logger.debug('curKey : ' +  byte_array_to_human_readable_hex(curKey.getKey()))
-        self.logger.debug('newKey : ' +  byte_array_to_human_readable_hex(newKey.getKey()))
+        self.logger.debug('curKey : %s', LazyHex(curKey.getKey()))
+        self.logger.debug('newKey : %s', LazyHex(newKey.getKey()))
 
         isSameKey = (keyNo == self.lastAuthKeyNo)
         #self.logger.debug('isSameKey : ' + str(isSameKey))
@@ -639,10 +1038,12 @@ class DESFire:
 
         # The type of key can only be changed for the PICC master key.
         # Applications must define their key type in CreateApplication().
-        if self.lastSelectedApplication == 0x00:
+        if self.lastSelectedApplication == [0x00, 0x00, 0x00]:
             keyNo = keyNo | newKey.keyType.value
         
-        cryptogram = self.command(DESFireCommand.DF_INS_CHANGE_KEY.value, [keyNo])
+        # GetKeySettings reports the key type, which changes with the PICC master key
+        self._invalidateMetadata(('keySettings',))
+        cryptogram = self.command(DF_INS_CHANGE_KEY, [keyNo])
         #The following if() applies only to application keys.
         #For the PICC master key b_SameKey is always true because there is only ONE key (#0) at the PICC level.
         if not isSameKey:
@@ -653,23 +1054,24 @@ class DESFire:
                  keyData_xor = bytearray(strxor(bytes(newKey.getKey()), bytes(curKey.getKey())))
             cryptogram += keyData_xor
         else:
-            cryptogram += newKey.getKey()
+            cryptogram.extend(newKey.getKey())
          
         if newKey.keyType == DESFireKeyType.DF_KEY_AES:
-            cryptogram += [newKey.keyVersion]
+            cryptogram.append(newKey.keyVersion)
 
 
-        cryptogram += bytearray(CRC32(cryptogram).to_bytes(4, byteorder='little'))
+        cryptogram += Crc32(cryptogram).digest()
         if not isSameKey:
-            cryptogram += bytearray(CRC32(newKey.getKey()).to_bytes(4, byteorder='little'))
+            cryptogram += Crc32(newKey.getKey()).digest()
 
-        #self.logger.debug( (int2hex(DESFireCommand.DF_INS_CHANGE_KEY.value) + int2hex(keyNo) + cryptogram).encode('hex'))
+        #self.logger.debug( (int2hex(DF_INS_CHANGE_KEY) + int2hex(keyNo) + cryptogram).encode('hex'))
         raw_data = self.communicate(cryptogram,'change key',nativ=True, isEncryptedComm = True, withRXCMAC = not isSameKey, withTXCMAC = False, withCRC= False, encryptBegin=2)
 
         #If we changed the currently active key, then re-auth is needed!
         if isSameKey:
             self.isAuthenticated = False
             self.sessionKey = None
+            self.state.dropAuthentication()
 
         return
 
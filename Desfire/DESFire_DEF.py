@@ -1,9 +1,14 @@
 from enum import Enum
+import hashlib
+import os
 import struct
+import threading
+from collections import OrderedDict
 from Crypto.Cipher import DES, DES3, AES
 from Crypto import Random
 from Crypto.Util.strxor import strxor
 from .util import *
+from .parsers import parseVersion, parseFileSettings
 
 def chunks(data, n):
     i = 0
@@ -93,7 +98,8 @@ class DESFire_STATUS(Enum):
     ST_CardIntegrityError    = 0xC1
     ST_CommandAborted        = 0xCA
     ST_CardDisabled          = 0xCD
-    ST_InvalidApp            = 0xCE
+    ST_CountError            = 0xCE # no more applications (28) or files (32) can be created
+    ST_InvalidApp            = 0xCE # former name of ST_CountError
     ST_DuplicateAidFiles     = 0xDE
     ST_EepromError           = 0xEE
     ST_FileNotFound          = 0xF0
@@ -180,6 +186,38 @@ class DESFireFileEncryption(Enum):
     CM_PLAIN   = 0x00
     CM_MAC     = 0x01   # not implemented (Plain data transfer with additional MAC)
     CM_ENCRYPT = 0x03   # not implemented (Does not make data stored on the card more secure. Only encrypts the transfer between Teensy and the card)
+
+# ------------ Constant tables generated from the enums above, for the hot paths ------------
+# Accessing ``DESFireCommand.DF_INS_GET_VERSION.value`` or calling ``DESFire_STATUS(status)`` goes through the Enum
+# machinery every time. The enums stay the public API, these are plain ints and tuples.
+
+# Integer constants named like the members, e.g. DF_INS_GET_VERSION == DESFireCommand.DF_INS_GET_VERSION.value
+for _enum in (DESFireCommand, DESFire_STATUS, DESFireKeyType):
+    # __members__ includes aliases like ST_InvalidApp
+    for _name, _member in _enum.__members__.items():
+        globals()[_name] = _member.value
+del _enum, _name, _member
+
+def _table(pairs, default):
+    table = [default(i) for i in range(256)]
+    for value, entry in pairs:
+        table[value] = entry
+    return tuple(table)
+
+#: Status byte -> DESFire_STATUS name, '0x..' for unknown statuses
+STATUS_NAMES = _table(((s.value, s.name) for s in DESFire_STATUS), lambda i: '0x%02X' % i)
+#: Command byte -> DESFireCommand name, '0x..' for unknown commands (MAX_FRAME_SIZE is no command)
+COMMAND_NAMES = _table(((c.value, c.name) for c in DESFireCommand if c is not DESFireCommand.MAX_FRAME_SIZE), lambda i: '0x%02X' % i)
+#: Key type bits (second byte of GetKeySettings & 0xF0) -> DESFireKeyType, None for unknown types
+KEY_TYPE_TABLE = _table(((k.value, k) for k in DESFireKeyType), lambda i: None)
+#: Key settings byte -> DESFireKeySettings of every set bit, highest bit first (see calc_key_settings)
+KEY_SETTINGS_DECODE = tuple(tuple(DESFireKeySettings(1 << bit) for bit in range(7, -1, -1) if mask & (1 << bit)) for mask in range(256))
+#: Key settings byte -> names of the DESFireKeySettings of every set bit, lowest bit first (see DESFireKey.listHumanKeySettings)
+KEY_SETTINGS_NAMES = tuple(tuple(k.name for k in reversed(members)) for members in KEY_SETTINGS_DECODE)
+#: DESFireKeySettings -> its value
+KEY_SETTINGS_ENCODE = dict((k, k.value) for k in DESFireKeySettings)
+
+
 class DESFireKey():
     def __init__(self):
         self.keyType = None
@@ -197,10 +235,11 @@ class DESFireKey():
 
 
     def listHumanKeySettings(self):
-        settings=[]
-        for i in range(0,16):
+        settings=list(KEY_SETTINGS_NAMES[self.keySettings & 0xFF])
+        # bits 8..15 are no DESFireKeySettings
+        for i in range(8,16):
             if (self.keySettings & (1 << i)) != 0:
-                settings.append(DESFireKeySettings(1 << i).name)
+                settings.append('0x%04X' % (1 << i))
         return settings
 
     def ClearIV(self):
@@ -222,7 +261,7 @@ class DESFireKey():
             self.CipherBlocksize = 16
             self.ClearIV()
             self.ciphermod = AES
-            self.Cipher = AES.new(bytes(self.keyBytes), AES.MODE_CBC, bytes(self.IV))
+            self.Cipher = CBC(cipherCache.get(self.keyType, self.keyBytes, AES), self.IV)
 
         elif self.keyType == DESFireKeyType.DF_KEY_2K3DES:
         #DES is used
@@ -230,13 +269,13 @@ class DESFireKey():
                 self.CipherBlocksize = 8
                 self.ClearIV()
                 self.ciphermod = DES
-                self.Cipher = DES.new(bytes(self.keyBytes), DES.MODE_CBC, bytes(self.IV))
+                self.Cipher = CBC(cipherCache.get(self.keyType, self.keyBytes, DES), self.IV)
         #2DES is used (3DES with 2 keys only)
             elif self.keySize == 16:
                 self.CipherBlocksize = 8
                 self.ciphermod = DES3
                 self.ClearIV()
-                self.Cipher = DES3.new(bytes(self.keyBytes), DES.MODE_CBC, bytes(self.IV))
+                self.Cipher = CBC(cipherCache.get(self.keyType, self.keyBytes, DES3), self.IV)
 
             else:
                 raise Exception('Key length error!')
@@ -245,8 +284,9 @@ class DESFireKey():
             assert self.keySize == 24
             #3DES is used
             self.CipherBlocksize = 8
+            self.ciphermod = DES3
             self.ClearIV()
-            self.Cipher = DES3.new(bytes(self.keyBytes), DES.MODE_CBC, bytes(self.IV))
+            self.Cipher = CBC(cipherCache.get(self.keyType, self.keyBytes, DES3), self.IV)
 
         else:
             raise Exception('Unknown key type!')
@@ -282,28 +322,30 @@ class DESFireKey():
     def Encrypt(self, data):
         #todo assert on blocksize
         self.IV = data[-self.CipherBlocksize:]
-        return list(bytearray(self.Cipher.encrypt(bytes(data))))
+        return self.Cipher.encrypt(bytes(data))
 
     def EncryptMsg(self, data, withCRC=False, encryptBegin=1):
-            sdata=data.copy()
+            data=bytearray(data)
             if withCRC:
-                data+=bytearray(CRC32(data).to_bytes(4, byteorder='little'))
+                data+=Crc32(data).digest()
             
-            data+=[0x00] * ((-(len(data)-encryptBegin)%self.CipherBlocksize))
+            data+=bytes((-(len(data)-encryptBegin)%self.CipherBlocksize))
 
-            ret = list(bytearray(data[0:encryptBegin])+self.cmac.Encrypt(data[encryptBegin:]))
-            #self.GenerateCmac()
-            #self.CalculateCmac(bytearray(data))
-            return ret  
+            with memoryview(data) as view:
+                encrypted=self.cmac.Encrypt(view[encryptBegin:])
+            del data[encryptBegin:]
+            data+=encrypted
+            return data
 
     def Decrypt(self, dataEnc):
         #todo assert on blocksize
         block = self.Cipher.decrypt(bytes(dataEnc))
         self.IV = block[-self.CipherBlocksize:]
-        return list(bytearray(block))
+        return block
 
 
     #Generates the two subkeys mu8_Cmac1 and mu8_Cmac2 that are used for CMAC calulation with the session key
+    #Session keys are never reused, so they are not put into the cipherCache
     def GenerateCmac(self,key): 
         self.cmac=CMAC(bytes(key),ciphermod=self.ciphermod)
     #Calculate the CMAC (Cipher-based Message Authentication Code) from the given data.
@@ -328,6 +370,10 @@ class CMAC():
     digest_size = None
 
     def __init__(self, key, msg = None, ciphermod = None):
+        """
+        :param key: The key bytes
+        :param ciphermod: Cipher module (DES, DES3 or AES)
+        """
 
         if ciphermod is None:
             raise TypeError("ciphermod must be specified (try AES)")
@@ -348,62 +394,239 @@ class CMAC():
         self.digest_size = ciphermod.block_size
 
         # Compute sub-keys
-        cipher = ciphermod.new(key, ciphermod.MODE_ECB)
-        l = cipher.encrypt(bchr(0)*ciphermod.block_size)
-        if bord(l[0]) & 0x80:
-            self._k1 = shift_bytes(l, const_Rb)
-        else:
-            self._k1 = shift_bytes(l)
-        if bord(self._k1[0]) & 0x80:
-            self._k2 = shift_bytes(self._k1, const_Rb)
-        else:
-            self._k2 = shift_bytes(self._k1)
+        self._k1, self._k2 = cmacSubkeys(ciphermod.new(key, ciphermod.MODE_ECB), ciphermod.block_size)
 
         # Initialize CBC cipher with zero IV
         self._IV = bchr(0)*ciphermod.block_size
         self._mac = ciphermod.new(key, ciphermod.MODE_CBC, self._IV)
+        # Pending last block of the message passed to update()
+        self._buffer = bytearray()
+
+    def update(self, data):
+        """Feeds the next chunk of the message.
+
+        Only the last (partial or complete) block is kept back, because it is xored with a
+        subkey once :py:meth:`digest` knows the message is complete. All blocks before it are
+        encrypted right away.
+        """
+        if isinstance(data, list):
+            data = bytes(data)
+        bs = self._bs
+        with memoryview(data) as view:
+            if self._buffer and len(self._buffer) + len(view) > bs:
+                fill = bs - len(self._buffer)
+                self._buffer += view[:fill]
+                self._encrypt(bytes(self._buffer))
+                self._buffer.clear()
+                view = view[fill:]
+            if self._buffer or len(view) <= bs:
+                self._buffer += view
+                return self
+            keep = len(view) % bs or bs
+            self._encrypt(view[:len(view)-keep])
+            self._buffer += view[len(view)-keep:]
+        return self
+
+    def digest(self):
+        """Finishes the message and returns the CMAC.
+
+        The CBC chaining value carries over, the next :py:meth:`update` starts the next message
+        of the session.
+        """
+        rest = len(self._buffer)
+        if rest == self._bs:
+            last = strxor(bytes(self._buffer), self._k1)
+        else:
+            last = strxor(bytes(self._buffer) + b'\x80' + bchr(0) * (self._bs-rest-1), self._k2)
+        self._buffer.clear()
+        return self._encrypt(last)
+
+    def copy(self):
+        """Returns an independent CMAC with the same subkeys, chaining value and pending data"""
+        other = CMAC.__new__(CMAC)
+        other.__dict__.update(self.__dict__)
+        other._buffer = bytearray(self._buffer)
+        other._mac = self._factory.new(self._key, self._factory.MODE_CBC, self._IV)
+        return other
 
     def CalculateCmac(self,data):
-        ndata=data.copy()
-        if len(ndata)%self._bs:
-            ndata+= [0x80] + [0x00] * (self._bs-len(ndata)%self._bs-1)
-            ndata = bytes(ndata[0:-self._bs]) + strxor(bytes(ndata[-self._bs:]),self._k2)
-        else:
-            ndata = bytes(ndata[0:-self._bs]) + strxor(bytes(ndata[-self._bs:]),self._k1)
-        ret=self._mac.encrypt(ndata)
-        return ret[-self._bs:]
+        return self.update(data).digest()
+
+    def _encrypt(self, data):
+        out = self._mac.encrypt(data)
+        if out:
+            self._IV = out[-self._bs:]
+        return out
 
     def Encrypt(self,data):
-        return self._mac.encrypt(bytes(data))
+        if isinstance(data, list):
+            data = bytes(data)
+        return self._encrypt(data)
 
     def Decrypt(self,data):
-        return self._mac.encrypt(bytes(data))
+        if isinstance(data, list):
+            data = bytes(data)
+        return self._encrypt(data)
+
+
+def cmacSubkeys(ecb, blockSize):
+    """Derives the CMAC subkeys K1 and K2 (NIST SP 800 38B) from an ECB cipher object"""
+    const_Rb = 0x1B if blockSize == 8 else 0x87
+    l = ecb.encrypt(bchr(0)*blockSize)
+    if bord(l[0]) & 0x80:
+        k1 = shift_bytes(l, const_Rb)
+    else:
+        k1 = shift_bytes(l)
+    if bord(k1[0]) & 0x80:
+        k2 = shift_bytes(k1, const_Rb)
+    else:
+        k2 = shift_bytes(k1)
+    return k1, k2
+
+
+class KeySchedule():
+    """Expanded long-term key of a DESFire key: the ECB cipher object the CBC of :py:meth:`DESFireKey.CiperInit` runs on.
+
+    CMAC subkeys are not cached, the CMAC always uses the session key, which is new for every authentication.
+    """
+
+    def __init__(self, keyType, key, ciphermod):
+        self.keyType = keyType
+        self.ciphermod = ciphermod
+        self.blockSize = ciphermod.block_size
+        try:
+            self.ecb = ciphermod.new(bytes(key), ciphermod.MODE_ECB)
+        except ValueError:
+            # Newer crypto libraries refuse 3DES keys degenerating to single DES (K1 == K2 or K2 == K3)
+            if ciphermod is not DES3:
+                raise
+            parts = [bytes(b & 0xFE for b in key[i:i+8]) for i in range(0, len(key), 8)]
+            self.ecb = DES.new(bytes(key[16:24] if len(parts) == 3 and parts[0] == parts[1] else key[:8]), DES.MODE_ECB)
+
+    def wipe(self):
+        """Drops the cipher object.
+
+        Best effort only: the expanded key inside the crypto library's cipher object is freed, not overwritten,
+        and copies of the key held by the caller (e.g. :py:attr:`DESFireKey.keyBytes`) are untouched.
+        """
+        self.ecb = None
+
+
+class CipherCache():
+    """Bounded LRU cache of :py:class:`KeySchedule` keyed by key type and a keyed digest of the key bytes.
+
+    Repeated authentications with the same long-term key skip the key expansion of the
+    cipher. The index holds no key bytes, only a BLAKE2b digest keyed with a random per-process secret.
+    Evicted entries are wiped (best effort, see :py:meth:`KeySchedule.wipe`).
+    """
+
+    def __init__(self, maxsize=64):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._secret = os.urandom(32)
+
+    def _index(self, keyType, key):
+        return (keyType, hashlib.blake2b(bytes(key), key=self._secret, digest_size=16).digest())
+
+    def get(self, keyType, key, ciphermod):
+        """Returns the cached :py:class:`KeySchedule` for ``key``, expands and caches it on a miss"""
+        cacheKey = self._index(keyType, key)
+        with self._lock:
+            schedule = self._entries.get(cacheKey)
+            if schedule is not None and schedule.ciphermod is ciphermod:
+                self._entries.move_to_end(cacheKey)
+                self.hits += 1
+                return schedule
+            self.misses += 1
+        schedule = KeySchedule(keyType, bytes(key), ciphermod)
+        if self.maxsize <= 0:
+            return schedule
+        with self._lock:
+            old = self._entries.pop(cacheKey, None)
+            if old is not None:
+                old.wipe()
+            self._entries[cacheKey] = schedule
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)[1].wipe()
+        return schedule
+
+    def evict(self, keyType, key):
+        """Removes and wipes the schedule of ``key``, returns True if it was cached"""
+        with self._lock:
+            schedule = self._entries.pop(self._index(keyType, key), None)
+        if schedule is None:
+            return False
+        schedule.wipe()
+        return True
+
+    def clear(self):
+        """Removes and wipes all schedules"""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for schedule in entries:
+            schedule.wipe()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, item):
+        keyType, key = item
+        return self._index(keyType, key) in self._entries
+
+
+#: Process wide cache used by :py:meth:`DESFireKey.CiperInit`
+cipherCache = CipherCache()
+
+
+class CBC():
+    """CBC mode on top of the ECB cipher of a :py:class:`KeySchedule`.
+
+    Like the pycrypto cipher objects the authentication relies on, encrypt and decrypt share
+    one IV register.
+    """
+
+    def __init__(self, schedule, iv):
+        self._ecb = schedule.ecb
+        self.block_size = schedule.blockSize
+        self.IV = bytes(iv)
+
+    def encrypt(self, data):
+        bs = self.block_size
+        iv = self.IV
+        data = bytes(data)
+        out = bytearray()
+        for i in range(0, len(data), bs):
+            iv = self._ecb.encrypt(strxor(data[i:i+bs], iv))
+            out += iv
+        self.IV = iv
+        return bytes(out)
+
+    def decrypt(self, data):
+        data = bytes(data)
+        if not data:
+            return data
+        plain = strxor(self._ecb.decrypt(data), self.IV + data[:-self.block_size])
+        self.IV = data[-self.block_size:]
+        return plain
 
     
 class DESFireCardVersion():
 
     def __init__(self,data):
         self.rawBytes = data
-        self.hardwareVendorId    = data[0]
-        self.hardwareType        = data[1]
-        self.hardwareSubType     = data[2]
-        self.hardwareMajVersion  = data[3]
-        self.hardwareMinVersion  = data[4]
-        self.hardwareStorageSize = data[5]
-        self.hardwareProtocol    = data[6]
-
-        self.softwareVendorId    = data[7]
-        self.softwareType        = data[8]
-        self.softwareSubType     = data[9]
-        self.softwareMajVersion  = data[10]
-        self.softwareMinVersion  = data[11]
-        self.softwareStorageSize = data[12]
-        self.softwareProtocol    = data[13]
+        (self.hardwareVendorId, self.hardwareType, self.hardwareSubType, self.hardwareMajVersion,
+         self.hardwareMinVersion, self.hardwareStorageSize, self.hardwareProtocol,
+         self.softwareVendorId, self.softwareType, self.softwareSubType, self.softwareMajVersion,
+         self.softwareMinVersion, self.softwareStorageSize, self.softwareProtocol,
+         _, _, self.cwProd, self.yearProd) = parseVersion(data if not isinstance(data, list) else bytes(data))
 
         self.UID      = data[14:21]        # The serial card number
         self.batchNo  = data[21:25]        # The batch number
-        self.cwProd   = data[26]           # The production week (BCD)
-        self.yearProd = data[27]           # The production year (BCD)
+        # cwProd: the production week (BCD), yearProd: the production year (BCD)
 
     def __repr__(self):
         temp =  "--- Desfire Card Details ---\r\n"
@@ -452,7 +675,8 @@ class DESFireFilePermissions():
         return (self.ReadAccess << 4) | (self.WriteAccess ) | (self.ReadAndWriteAccess <<  12) | (self.ChangeAccess << 8);
  
     def unpack(self, data):
-        data=int.from_bytes(getBytes(data),byteorder='big')
+        if not isinstance(data, int):
+            data=int.from_bytes(getBytes(data),byteorder='big')
         self.ReadAccess         = bool((data >>  4) & 0x0F)
         self.WriteAccess        = bool((data      ) & 0x0F)
         self.ReadAndWriteAccess = bool((data >> 12) & 0x0F)
@@ -512,37 +736,30 @@ class DESFireFileSettings:
         self.CurrentNumberRecords = None        #uint32_t
 
     def parse(self, data):
-        self.FileType   = DESFireFileType(data[0])
-        self.Encryption = DESFireFileEncryption(data[1])
-        self.Permissions.unpack(struct.unpack('>H',bytes(data[2:4]))[0])
-        
-        if self.FileType == DESFireFileType.MDFT_LINEAR_RECORD_FILE_WITH_BACKUP:
-            self.RecordSize = struct.unpack('<I', bytes(data[4:6] + [0x00,0x00]))[0]  
-            self.MaxNumberRecords = struct.unpack('<I', bytes(data[6:8] + [0x00,0x00]))[0]
-            self.CurrentNumberRecords = struct.unpack('<I', bytes(data[8:10] + [0x00,0x00]))[0]
-
-        elif self.FileType == DESFireFileType.MDFT_STANDARD_DATA_FILE:
-            self.FileSize = self.FileSize = struct.unpack('<I', bytes(data[4:6] + [0x00,0x00]))[0]
-
-
-        else:
-            # TODO: We can still access common attributes
-            # raise NotImplementedError("Please fill in logic for file type {:02X}".format(resp[0]))
-            pass
+        (fileType, encryption, access,
+         self.FileSize,
+         self.LowerLimit, self.UpperLimit, self.LimitedCreditValue, self.LimitedCreditEnabled,
+         self.RecordSize, self.MaxNumberRecords, self.CurrentNumberRecords) = parseFileSettings(data if not isinstance(data, list) else bytes(data))
+        self.FileType   = DESFireFileType(fileType)
+        self.Encryption = DESFireFileEncryption(encryption)
+        self.Permissions.unpack(access)
 
     def __repr__(self):
         temp = ' ----- DESFireFileSettings ----\r\n'
         temp += 'File type: %s\r\n' % (self.FileType.name)
         temp += 'Encryption: %s\r\n' % (self.Encryption.name)
         temp += 'Permissions: %s\r\n' % (repr(self.Permissions))
-        if self.FileType == DESFireFileType.MDFT_LINEAR_RECORD_FILE_WITH_BACKUP:
+        if self.RecordSize is not None:
             temp += 'RecordSize: %d\r\n' % (self.RecordSize)
             temp += 'MaxNumberRecords: %d\r\n' % (self.MaxNumberRecords)
             temp += 'CurrentNumberRecords: %d\r\n' % (self.CurrentNumberRecords)
 
-        elif self.FileType == DESFireFileType.MDFT_STANDARD_DATA_FILE:
+        elif self.FileSize is not None:
             temp += 'File size: %d\r\n' % (self.FileSize)
 
+        elif self.LowerLimit is not None:
+            temp += 'Limits: %d..%d\r\n' % (self.LowerLimit, self.UpperLimit)
+
         return temp
 
     def toDict(self):
@@ -554,11 +771,11 @@ class DESFireFileSettings:
         temp['UpperLimit'] = self.UpperLimit
         temp['LimitedCreditValue'] = self.LimitedCreditValue
         temp['LimitedCreditEnabled'] = self.LimitedCreditEnabled
-        if self.FileType == DESFireFileType.MDFT_LINEAR_RECORD_FILE_WITH_BACKUP:
+        if self.RecordSize is not None:
             temp['RecordSize'] = self.RecordSize
             temp['MaxNumberRecords'] = self.MaxNumberRecords
             temp['CurrentNumberRecords'] = self.CurrentNumberRecords
-        elif self.FileType == DESFireFileType.MDFT_STANDARD_DATA_FILE:
+        elif self.FileSize is not None:
             temp['FileSize'] = self.FileSize
         return temp
 
@@ -571,12 +788,10 @@ class DESFireFileSettings:
 def calc_key_settings(mask):
     if type(mask) is list:
         #not parsing, but calculating
-        res = 0
-        for keysetting in mask:
-            res += keysetting.value
-        return res & 0xFF
-
+        return sum(map(KEY_SETTINGS_ENCODE.__getitem__, mask)) & 0xFF
 
+    if 0 <= mask <= 0xFF:
+        return list(KEY_SETTINGS_DECODE[mask])
     a=2147483648
     result = []
     while a>>1:
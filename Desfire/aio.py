@@ -0,0 +1,107 @@
+"""asyncio client API.
+
+:py:class:`AsyncDESFire` exposes the commands of :py:class:`desfire.DESFire.DESFire` as coroutines, so one event
+loop can serve many readers::
+
+    desfire = AsyncDESFire(PCSCDevice(connection))
+    await desfire.selectApplication('00 DE 16')
+    await desfire.authenticate(1, key)
+    data = await desfire.readFileData(1, 0, 32)
+
+The framing and crypto of :py:class:`desfire.DESFire.DESFire` are reused unchanged: every command runs in an
+executor thread, so blocking PC/SC transmits never stall the event loop. Devices implementing
+:py:class:`desfire.device.AsyncDevice` are awaited on the event loop instead.
+"""
+
+import asyncio
+import functools
+import threading
+
+from .DESFire import DESFire
+from .device import AsyncDevice, Device
+
+
+class _LoopDevice(Device):
+    """Blocking view of an :py:class:`AsyncDevice` for commands running in an executor thread."""
+
+    def __init__(self, device):
+        self.device = device
+        self.loop = None
+
+    def transceive(self, bytes):
+        return asyncio.run_coroutine_threadsafe(self.device.transceive(bytes), self.loop).result()
+
+
+def _coroutine(name):
+    method = getattr(DESFire, name)
+
+    @functools.wraps(method)
+    async def command(self, *args, **kwargs):
+        return await self._run(method, *args, **kwargs)
+    return command
+
+
+class AsyncDESFire(object):
+    """Coroutine version of :py:class:`desfire.DESFire.DESFire` for one card.
+
+    Commands of one instance are executed one after the other (the card session is stateful), commands of
+    different instances run concurrently.
+    """
+
+    #: Methods of :py:class:`desfire.DESFire.DESFire` exposed as coroutines
+    COMMANDS = ('authenticate', 'getApplicationIDs', 'getKeySetting', 'getCardVersion', 'formatCard',
+                'selectApplication', 'createApplication', 'deleteApplication', 'getFileIDs', 'getFileSettings',
+                'readFileData', 'readFileBytes', 'writeFileData', 'deleteFile', 'createStdDataFile', 'createValueFile',
+                'debit', 'credit', 'commitTransaction', 'abortTransaction', 'getValue', 'getKeyVersion',
+                'changeKeySettings', 'changeKey', 'ensureApplication', 'ensureAuthenticated')
+
+    def __init__(self, device, executor=None, logger=None, trace=None, metadataCache=None, metrics=None, wrapped=False,
+                 extendedLength=False):
+        """
+        :param device: :py:class:`desfire.device.Device` or :py:class:`desfire.device.AsyncDevice` implementation
+        :param executor: :py:class:`concurrent.futures.Executor` running the commands, defaults to the executor of the event loop
+        :param logger: Python :py:class:`logging.Logger` passed to :py:class:`desfire.DESFire.DESFire`
+        :param trace: Optional :py:class:`desfire.trace.APDUTrace` passed to :py:class:`desfire.DESFire.DESFire`
+        :param metadataCache: Optional :py:class:`desfire.cache.MetadataCache` passed to :py:class:`desfire.DESFire.DESFire`
+        :param metrics: Optional :py:class:`desfire.metrics.Metrics` passed to :py:class:`desfire.DESFire.DESFire`
+        :param wrapped: Send ISO 7816-4 wrapped APDUs, see :py:class:`desfire.DESFire.DESFire`
+        :param extendedLength: The reader supports extended length APDUs, see :py:class:`desfire.DESFire.DESFire`
+        """
+        self.device = device
+        self.executor = executor
+        self._bridge = _LoopDevice(device) if isinstance(device, AsyncDevice) else None
+        #: The synchronous client doing the framing and crypto
+        self.desfire = DESFire(self._bridge or device, logger, trace, metadataCache, wrapped, extendedLength, metrics)
+        self._lock = None
+        # Still held by a command whose coroutine was cancelled, until its thread finishes
+        self._threadLock = threading.Lock()
+
+    @property
+    def isAuthenticated(self):
+        return self.desfire.isAuthenticated
+
+    @property
+    def trace(self):
+        return self.desfire.trace
+
+    def createKeySetting(self, key, keyNumbers, keyType, keySettings):
+        """See :py:meth:`desfire.DESFire.DESFire.createKeySetting`, no card communication involved"""
+        return self.desfire.createKeySetting(key, keyNumbers, keyType, keySettings)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._bridge is not None:
+                self._bridge.loop = loop
+            return await loop.run_in_executor(self.executor, functools.partial(self._locked, method, *args, **kwargs))
+
+    def _locked(self, method, *args, **kwargs):
+        with self._threadLock:
+            return method(self.desfire, *args, **kwargs)
+
+
+for _name in AsyncDESFire.COMMANDS:
+    setattr(AsyncDESFire, _name, _coroutine(_name))
+del _name
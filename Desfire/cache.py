@@ -0,0 +1,85 @@
+"""Per-card metadata cache.
+
+Application lists, file IDs, file settings and key settings only change through commands like
+``createApplication`` or ``changeKeySettings``. :py:class:`MetadataCache` keeps the raw card answers keyed by card
+UID and AID, so repeated taps of the same cards skip the discovery commands::
+
+    cache = MetadataCache(maxsize=4096, ttl=600)
+    desfire = DESFire(device, metadataCache=cache)
+
+One cache can be shared by all :py:class:`desfire.DESFire.DESFire` instances of a process. The mutating commands of
+:py:class:`desfire.DESFire.DESFire` invalidate the affected entries.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class MetadataCache(object):
+    """Bounded LRU cache of card metadata per (card UID, AID) with a time to live."""
+
+    def __init__(self, maxsize=1024, ttl=300.0, clock=time.monotonic):
+        """
+        :param maxsize: Number of (card UID, AID) entries kept, the least recently used is evicted first
+        :param ttl: Seconds a value is valid, None for no expiry
+        :param clock: Time source
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uid, aid, key):
+        """Returns the cached value or None.
+
+        :param uid: Card UID as bytes
+        :param aid: AID as bytes (big endian)
+        :param key: What is cached, e.g. ``('fileSettings', 1)``
+        """
+        with self._lock:
+            values = self._entries.get((uid, aid))
+            if values is not None:
+                item = values.get(key)
+                if item is not None:
+                    value, expires = item
+                    if expires is None or expires > self.clock():
+                        self._entries.move_to_end((uid, aid))
+                        self.hits += 1
+                        return value
+                    del values[key]
+            self.misses += 1
+            return None
+
+    def put(self, uid, aid, key, value):
+        expires = self.clock() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            values = self._entries.get((uid, aid))
+            if values is None:
+                values = self._entries[(uid, aid)] = {}
+            else:
+                self._entries.move_to_end((uid, aid))
+            values[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, uid, aid=None, key=None):
+        """Drops the values of a card, of one of its applications or a single value"""
+        with self._lock:
+            if aid is None:
+                for entry in [e for e in self._entries if e[0] == uid]:
+                    del self._entries[entry]
+            elif key is None:
+                self._entries.pop((uid, aid), None)
+            else:
+                self._entries.get((uid, aid), {}).pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
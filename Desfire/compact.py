@@ -0,0 +1,244 @@
+"""Compact, immutable representations of parsed card structures.
+
+:py:class:`desfire.DESFire_DEF.DESFireCardVersion`, :py:class:`desfire.DESFire_DEF.DESFireFileSettings`,
+:py:class:`desfire.DESFire_DEF.DESFireFilePermissions` and :py:class:`desfire.DESFire_DEF.DESFireKey` keep every
+field in an instance dict. The classes here are ``bytes`` subclasses without instance dict: the object is the raw
+card answer and the fields are decoded on access. They have the same attributes, ``toDict()`` and ``__repr__`` as
+their mutable counterparts, for keeping metadata of many cards in memory::
+
+    version = CompactCardVersion(desfire.getCardVersion().rawBytes)
+    settings = CompactFileSettings(desfire.getFileSettingsRaw(1))
+    key = CompactKey.fromKey(desfire.getKeySetting())
+
+Being bytes, they compare and hash by their contents and can be stored or sent as they are.
+``python -m benchmarks --memory`` shows the bytes per object of both representations.
+"""
+
+import struct
+
+from .DESFire_DEF import (DESFireCardVersion, DESFireFilePermissions, DESFireFileSettings, DESFireFileType,
+                          DESFireFileEncryption, DESFireKey, DESFireKeyType)
+from .parsers import (VERSION, VALUE_FILE_SETTINGS, uint24, STANDARD_DATA_FILE, BACKUP_DATA_FILE, VALUE_FILE,
+                      LINEAR_RECORD_FILE, CYCLIC_RECORD_FILE)
+
+
+_KEY_HEADER = struct.Struct('<BBBB')
+_ACCESS = struct.Struct('>H')
+
+#: Key type byte of keys without type
+_NO_KEY_TYPE = 0xFF
+
+
+def _byte(index):
+    return property(lambda self: self[index])
+
+
+class CompactCardVersion(bytes):
+    """GetVersion answer (28 bytes), see :py:class:`desfire.DESFire_DEF.DESFireCardVersion`."""
+
+    __slots__ = ()
+
+    def __new__(cls, data):
+        self = bytes.__new__(cls, data)
+        if len(self) < VERSION.size:
+            raise Exception('Card version needs %d bytes, got %d' % (VERSION.size, len(self)))
+        return self
+
+    hardwareVendorId    = _byte(0)
+    hardwareType        = _byte(1)
+    hardwareSubType     = _byte(2)
+    hardwareMajVersion  = _byte(3)
+    hardwareMinVersion  = _byte(4)
+    hardwareStorageSize = _byte(5)
+    hardwareProtocol    = _byte(6)
+
+    softwareVendorId    = _byte(7)
+    softwareType        = _byte(8)
+    softwareSubType     = _byte(9)
+    softwareMajVersion  = _byte(10)
+    softwareMinVersion  = _byte(11)
+    softwareStorageSize = _byte(12)
+    softwareProtocol    = _byte(13)
+
+    cwProd   = _byte(26)           # The production week (BCD)
+    yearProd = _byte(27)           # The production year (BCD)
+
+    @property
+    def rawBytes(self):
+        return list(self)
+
+    @property
+    def UID(self):
+        """The serial card number as list of ints"""
+        return list(self[14:21])
+
+    @property
+    def batchNo(self):
+        return list(self[21:25])
+
+    @property
+    def uid(self):
+        """The serial card number as bytes"""
+        return bytes(self[14:21])
+
+    __repr__ = DESFireCardVersion.__repr__
+    toDict = DESFireCardVersion.toDict
+
+
+class CompactFilePermissions(bytes):
+    """Access rights of a file (2 bytes as in GetFileSettings), see
+    :py:class:`desfire.DESFire_DEF.DESFireFilePermissions`.
+
+    ``ReadAccess`` and the other attributes of the mutable class tell if the right is granted to a key, ``read``,
+    ``write``, ``readWrite`` and ``change`` are the key numbers (0x0E free access, 0x0F denied).
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, data):
+        self = bytes.__new__(cls, data)
+        if len(self) != 2:
+            raise Exception('File permissions need 2 bytes, got %d' % (len(self),))
+        return self
+
+    @classmethod
+    def fromPerm(cls, r, w, rw, c):
+        """Returns the permissions for the key numbers like :py:meth:`DESFireFilePermissions.setPerm`"""
+        return cls(bytes(((rw << 4) | c, (r << 4) | w)))
+
+    @classmethod
+    def fromPermissions(cls, permissions):
+        return cls(_ACCESS.pack(permissions.pack()))
+
+    read      = property(lambda self: self[1] >> 4)
+    write     = property(lambda self: self[1] & 0x0F)
+    readWrite = property(lambda self: self[0] >> 4)
+    change    = property(lambda self: self[0] & 0x0F)
+
+    ReadAccess         = property(lambda self: bool(self[1] >> 4))
+    WriteAccess        = property(lambda self: bool(self[1] & 0x0F))
+    ReadAndWriteAccess = property(lambda self: bool(self[0] >> 4))
+    ChangeAccess       = property(lambda self: bool(self[0] & 0x0F))
+
+    def pack(self):
+        return _ACCESS.unpack_from(self)[0]
+
+    __repr__ = DESFireFilePermissions.__repr__
+    toDict = DESFireFilePermissions.toDict
+
+
+class CompactFileSettings(bytes):
+    """GetFileSettings answer, see :py:class:`desfire.DESFire_DEF.DESFireFileSettings`.
+
+    Type specific attributes are None for other file types.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, data):
+        self = bytes.__new__(cls, data)
+        if len(self) < 4:
+            raise Exception('File settings need at least 4 bytes, got %d' % (len(self),))
+        return self
+
+    @property
+    def FileType(self):
+        return DESFireFileType(self[0])
+
+    @property
+    def Encryption(self):
+        return DESFireFileEncryption(self[1])
+
+    @property
+    def Permissions(self):
+        return CompactFilePermissions(self[2:4])
+
+    @property
+    def FileSize(self):
+        if self[0] != STANDARD_DATA_FILE and self[0] != BACKUP_DATA_FILE:
+            return None
+        return uint24(self, 4)
+
+    def _valueSettings(self, index):
+        if self[0] != VALUE_FILE:
+            return None
+        return VALUE_FILE_SETTINGS.unpack_from(self, 4)[index]
+
+    LowerLimit = property(lambda self: self._valueSettings(0))
+    UpperLimit = property(lambda self: self._valueSettings(1))
+    LimitedCreditValue = property(lambda self: self._valueSettings(2))
+
+    @property
+    def LimitedCreditEnabled(self):
+        enabled = self._valueSettings(3)
+        return bool(enabled & 0x01) if enabled is not None else None
+
+    def _recordSettings(self, offset):
+        if self[0] != LINEAR_RECORD_FILE and self[0] != CYCLIC_RECORD_FILE:
+            return None
+        return uint24(self, offset)
+
+    RecordSize = property(lambda self: self._recordSettings(4))
+    MaxNumberRecords = property(lambda self: self._recordSettings(7))
+    CurrentNumberRecords = property(lambda self: self._recordSettings(10))
+
+    __repr__ = DESFireFileSettings.__repr__
+    toDict = DESFireFileSettings.toDict
+
+
+class CompactKey(bytes):
+    """Key type, key number count, key settings, key version and key bytes, see
+    :py:class:`desfire.DESFire_DEF.DESFireKey`.
+
+    Only the description of the key, :py:meth:`toKey` returns a :py:class:`DESFireKey` for authentication.
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, data):
+        self = bytes.__new__(cls, data)
+        if len(self) < _KEY_HEADER.size:
+            raise Exception('Key needs at least %d bytes, got %d' % (_KEY_HEADER.size, len(self)))
+        return self
+
+    @classmethod
+    def fromKey(cls, key):
+        keyType = key.keyType.value if key.keyType is not None else _NO_KEY_TYPE
+        header = _KEY_HEADER.pack(keyType, key.keyNumbers, key.keySettings, key.keyVersion)
+        return cls(header + bytes(key.keyBytes or b''))
+
+    @property
+    def keyType(self):
+        keyType = self[0]
+        return DESFireKeyType(keyType) if keyType != _NO_KEY_TYPE else None
+
+    keyNumbers  = _byte(1)
+    keySettings = _byte(2)
+    keyVersion  = _byte(3)
+
+    @property
+    def keyBytes(self):
+        """The key, None for key settings read from the card"""
+        return self[_KEY_HEADER.size:] or None
+
+    @property
+    def keySize(self):
+        return len(self) - _KEY_HEADER.size
+
+    def GetKeyType(self):
+        return self.keyType
+
+    def getKey(self):
+        return self.keyBytes
+
+    def toKey(self):
+        """Returns a new :py:class:`DESFireKey` with these settings"""
+        key = DESFireKey()
+        key.setKeySettings(self.keyNumbers, self.keyType, self.keySettings)
+        if self.keyBytes is not None:
+            key.setKey(self.keyBytes)
+        key.keyVersion = self.keyVersion
+        return key
+
+    listHumanKeySettings = DESFireKey.listHumanKeySettings
+    __repr__ = DESFireKey.__repr__
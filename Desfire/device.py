@@ -7,3 +7,14 @@ class Device(object):
         :return: List of bytes or byte array from the device.
         """
         raise NotImplementedError("Base class must implement")
+
+
+class AsyncDevice(object):
+    """Abstract base class of devices with a coroutine based communication channel, see :py:class:`desfire.aio.AsyncDESFire`."""
+
+    async def transceive(self, bytes):
+        """Send in APDU request and wait for the response.
+        :param bytes: Outgoing bytes as list of bytes or byte array
+        :return: List of bytes or byte array from the device.
+        """
+        raise NotImplementedError("Base class must implement")
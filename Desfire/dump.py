@@ -0,0 +1,252 @@
+"""Whole-card enumeration.
+
+:py:func:`dump` walks the card (version, applications, key settings, files, contents and values) and returns a
+:py:class:`CardDump`::
+
+    snapshot = dump(desfire, keys={'00 AE 16': (1, key)})
+    for app in snapshot.applications:
+        for f in app.files:
+            print(app.aid.hex(), f.fileId, f.skipped or f.data or f.value)
+
+Every file is read with one ReadData command, the card sends the contents in additional frames (0xAF). Files whose
+access rights do not allow reading with the given keys are skipped without asking the card. :py:func:`iterDump`
+yields the same information record by record, so only one file is held in memory at a time.
+"""
+
+from collections import namedtuple
+
+from .DESFire import DESFireCommunicationError
+from .DESFire_DEF import DESFireCardVersion, DESFireFileSettings, DESFireFileType, DESFireFileEncryption
+from .util import getBytes
+
+
+PICC_AID = b'\x00\x00\x00'
+
+ACCESS_FREE = 0x0E
+
+DATA_FILES = (DESFireFileType.MDFT_STANDARD_DATA_FILE.value, DESFireFileType.MDFT_BACKUP_DATA_FILE.value)
+VALUE_FILE = DESFireFileType.MDFT_VALUE_FILE_WITH_BACKUP.value
+
+#: Reasons a file was not read
+SKIP_DENIED = 'access denied'
+SKIP_ENCIPHERED = 'enciphered communication'
+SKIP_UNSUPPORTED = 'unsupported file type'
+
+
+class CardInfo(namedtuple('CardInfo', 'version keySettings applicationIds error')):
+    """First record of a dump.
+
+    :param version: Raw GetVersion answer (28 bytes)
+    :param keySettings: Raw GetKeySettings answer of the PICC, None if it could not be read
+    :param applicationIds: AIDs (3 bytes, big endian) on the card
+    :param error: Status name if the PICC could not be listed, else None
+    """
+
+    __slots__ = ()
+
+    @property
+    def cardVersion(self):
+        return DESFireCardVersion(list(self.version))
+
+
+class ApplicationDump(namedtuple('ApplicationDump', 'aid keySettings fileIds error files')):
+    """An application. :py:func:`iterDump` yields it before its files with empty ``files``.
+
+    :param aid: AID (3 bytes, big endian)
+    :param keySettings: Raw GetKeySettings answer, None if it could not be read
+    :param fileIds: File IDs, empty if they could not be listed
+    :param error: Status name if the application could not be selected, authenticated or listed, else None
+    :param files: Tuple of :py:class:`FileDump`
+    """
+
+    __slots__ = ()
+
+
+class FileDump(namedtuple('FileDump', 'aid fileId settings data value skipped')):
+    """A file of an application.
+
+    :param aid: AID (3 bytes, big endian)
+    :param fileId: File ID
+    :param settings: Raw GetFileSettings answer, None if it could not be read
+    :param data: Contents of data files (bytes)
+    :param value: Value of value files
+    :param skipped: Reason the file was not read, else None
+    """
+
+    __slots__ = ()
+
+    @property
+    def fileSettings(self):
+        """The settings parsed as :py:class:`desfire.DESFire_DEF.DESFireFileSettings`"""
+        if self.settings is None:
+            return None
+        file_settings = DESFireFileSettings()
+        file_settings.parse(self.settings)
+        return file_settings
+
+
+class CardDump(object):
+    """Snapshot of a card, see :py:func:`dump`."""
+
+    def __init__(self, card, applications):
+        #: :py:class:`CardInfo`
+        self.card = card
+        #: List of :py:class:`ApplicationDump`
+        self.applications = applications
+
+    @property
+    def version(self):
+        return self.card.cardVersion
+
+    @property
+    def uid(self):
+        return bytes(self.card.version[14:21])
+
+    def application(self, aid):
+        """Returns the :py:class:`ApplicationDump` of the AID or None"""
+        aid = getBytes(aid, 3)
+        for app in self.applications:
+            if app.aid == aid:
+                return app
+        return None
+
+    def toDict(self):
+        """Returns the snapshot as dict with bytes as hex strings, e.g. for JSON export"""
+        def hexOrNone(data):
+            return data.hex() if data is not None else None
+        return {
+            'version': self.card.version.hex(),
+            'keySettings': hexOrNone(self.card.keySettings),
+            'error': self.card.error,
+            'applications': [{
+                'aid': app.aid.hex(),
+                'keySettings': hexOrNone(app.keySettings),
+                'error': app.error,
+                'files': [{
+                    'fileId': f.fileId,
+                    'settings': hexOrNone(f.settings),
+                    'data': hexOrNone(f.data),
+                    'value': f.value,
+                    'skipped': f.skipped,
+                } for f in app.files],
+            } for app in self.applications],
+        }
+
+
+def readable(settings, keyNo):
+    """Tells if a file can be read in a session authenticated with ``keyNo`` (None when not authenticated).
+
+    Args:
+        settings (bytes): Raw GetFileSettings answer
+        keyNo (int)     : Authenticated key number or None
+    Returns:
+        str: None if the file can be read, else the reason to skip it
+    """
+    fileType = settings[0]
+    readWrite = settings[2] >> 4
+    read = settings[3] >> 4
+    write = settings[3] & 0x0F
+    if fileType in DATA_FILES:
+        allowed = (read, readWrite)
+    elif fileType == VALUE_FILE:
+        allowed = (read, write, readWrite)
+    else:
+        return SKIP_UNSUPPORTED
+    if ACCESS_FREE in allowed:
+        return None
+    if keyNo is None or keyNo not in allowed:
+        return SKIP_DENIED
+    if settings[1] == DESFireFileEncryption.CM_ENCRYPT.value:
+        return SKIP_ENCIPHERED
+    return None
+
+
+def iterDump(desfire, keys=None, contents=True):
+    """Walks the card and yields one :py:class:`CardInfo`, then per application an :py:class:`ApplicationDump`
+    (with empty ``files``) followed by a :py:class:`FileDump` per file.
+
+    Args:
+        desfire (DESFire) : Session of the card
+        keys (dict)       : AID (hex string, int or bytes, '00 00 00' for the PICC) to (key number, DESFireKey)
+                            used to authenticate in that application
+        contents (bool)   : Read file contents and values, else only the structure
+    """
+    keys = dict((getBytes(aid, 3), entry) for aid, entry in (keys or {}).items())
+    logger = desfire.logger
+
+    version = bytes(desfire.getCardVersion().rawBytes)
+    keySettings = None
+    aids = []
+    error = None
+    try:
+        _open(desfire, PICC_AID, keys)
+        keySettings = desfire.getKeySettingRaw()
+        aids = [bytes(aid) for aid in desfire.getApplicationIDs()]
+    except DESFireCommunicationError as e:
+        logger.debug('Listing the PICC failed: %s', e)
+        error = str(e)
+    yield CardInfo(version, keySettings, aids, error)
+
+    for aid in aids:
+        keySettings = None
+        fileIds = []
+        error = None
+        try:
+            _open(desfire, aid, keys)
+            keySettings = desfire.getKeySettingRaw()
+            fileIds = desfire.getFileIDs()
+        except DESFireCommunicationError as e:
+            logger.debug('Listing application %s failed: %s', aid.hex(), e)
+            error = str(e)
+        yield ApplicationDump(aid, keySettings, fileIds, error, ())
+        for fileId in fileIds:
+            yield _dumpFile(desfire, aid, fileId, keys, contents)
+
+
+def _open(desfire, aid, keys):
+    """Selects the application and authenticates with its key if one is given. Returns the key number or None."""
+    desfire.ensureApplication(aid)
+    if aid not in keys:
+        return None
+    keyNo, key = keys[aid]
+    desfire.ensureAuthenticated(keyNo, key)
+    return keyNo
+
+
+def _dumpFile(desfire, aid, fileId, keys, contents):
+    try:
+        # an error of a previous file ended the authenticated session
+        keyNo = _open(desfire, aid, keys)
+        settings = desfire.getFileSettingsRaw(fileId)
+    except DESFireCommunicationError as e:
+        return FileDump(aid, fileId, None, None, None, str(e))
+    if not contents:
+        return FileDump(aid, fileId, settings, None, None, None)
+    skipped = readable(settings, keyNo)
+    if skipped is not None:
+        return FileDump(aid, fileId, settings, None, None, skipped)
+    try:
+        if settings[0] == VALUE_FILE:
+            return FileDump(aid, fileId, settings, None, desfire.getValue(fileId), None)
+        return FileDump(aid, fileId, settings, bytes(desfire.readFileBytes(fileId, 0, 0, chained=True)), None, None)
+    except DESFireCommunicationError as e:
+        return FileDump(aid, fileId, settings, None, None, str(e))
+
+
+def dump(desfire, keys=None, contents=True):
+    """Walks the card and returns a :py:class:`CardDump`, see :py:func:`iterDump` for the arguments."""
+    records = iterDump(desfire, keys, contents)
+    card = next(records)
+    applications = []
+    files = []
+    for record in records:
+        if isinstance(record, ApplicationDump):
+            if applications:
+                applications[-1] = applications[-1]._replace(files=tuple(files))
+            applications.append(record)
+            files = []
+        else:
+            files.append(record)
+    if applications:
+        applications[-1] = applications[-1]._replace(files=tuple(files))
+    return CardDump(card, applications)
@@ -0,0 +1,136 @@
+"""Frame size negotiation.
+
+:py:attr:`desfire.DESFire.DESFire.MaxFrameSize` limits every frame sent to the card and sizes the chunks of
+readFileData/writeFileData. It defaults to the 60 bytes every DESFire EV1 in every reader handles. Larger frames
+mean proportionally fewer round trips on bulk transfers::
+
+    negotiateFrameSize(desfire, reader='ACS ACR1252 0', ats=ats, readerMax=device.maxInput())
+
+The card limit comes from the FSCI of its ATS (ISO 14443-4), the reader limit from its capabilities (e.g.
+``SCARD_ATTR_MAXINPUT``). The result is cached per reader and card type, so it is worked out once per reader
+for every kind of card.
+"""
+
+import threading
+
+from .DESFire_DEF import DESFireCommand
+
+
+#: Frame size used when nothing is known about card and reader
+DEFAULT_FRAME_SIZE = DESFireCommand.MAX_FRAME_SIZE.value
+
+#: Frame size for FSCI 0..12 (ISO 14443-4, FSCI 9..12 since the 2016 amendment), larger values mean 4096
+FSC_TABLE = (16, 24, 32, 40, 48, 64, 96, 128, 256, 512, 1024, 2048, 4096)
+
+#: Wrapped APDU bytes around the native frame: CLA INS P1 P2 Lc ... Le, extended length adds 3 bytes
+WRAP_OVERHEAD = 5
+EXTENDED_WRAP_OVERHEAD = 8
+
+#: Parameters of a short APDU
+SHORT_APDU_DATA = 255
+
+
+def frameSizeFromATS(ats):
+    """Returns the largest native frame the card accepts according to its ATS.
+
+    The frame size FSC covers PCB, CID (when the card supports it) and the CRC besides the frame.
+
+    Args:
+        ats (bytes): ATS including the length byte TL
+    Returns:
+        int: the frame size or None if the ATS does not carry the format byte T0
+    """
+    ats = bytes(ats)
+    if len(ats) < 2:
+        return None
+    t0 = ats[1]
+    fsc = FSC_TABLE[min(t0 & 0x0F, len(FSC_TABLE) - 1)]
+    overhead = 1 + 2
+    # TC(1) follows TA(1) and TB(1) if present, bit 2 tells if the card supports CID
+    pos = 2 + bool(t0 & 0x10) + bool(t0 & 0x20)
+    if t0 & 0x40 and len(ats) > pos and ats[pos] & 0x02:
+        overhead += 1
+    return fsc - overhead
+
+
+def frameSizeFromReader(readerMax, wrapped=False, extendedLength=False):
+    """Returns the largest native frame a reader transmits in one exchange.
+
+    Args:
+        readerMax (int)      : Largest command the reader accepts in bytes, None if unknown
+        wrapped (bool)       : ISO 7816-4 wrapped transport
+        extendedLength (bool): Extended length APDUs are used
+    Returns:
+        int: the frame size or None if unknown
+    """
+    if wrapped:
+        if extendedLength:
+            return readerMax - EXTENDED_WRAP_OVERHEAD if readerMax else None
+        size = 1 + SHORT_APDU_DATA
+        return min(size, readerMax - WRAP_OVERHEAD) if readerMax else size
+    return readerMax
+
+
+class FrameSizeCache(object):
+    """Thread-safe map of (reader, card type) to the negotiated frame size."""
+
+    def __init__(self):
+        self._sizes = {}
+        self._lock = threading.Lock()
+
+    def get(self, reader, cardType):
+        with self._lock:
+            return self._sizes.get((reader, cardType))
+
+    def put(self, reader, cardType, size):
+        with self._lock:
+            self._sizes[(reader, cardType)] = size
+
+    def clear(self):
+        with self._lock:
+            self._sizes.clear()
+
+    def __len__(self):
+        return len(self._sizes)
+
+
+#: Cache used by :py:func:`negotiateFrameSize` by default
+frameSizeCache = FrameSizeCache()
+
+
+def negotiateFrameSize(desfire, reader=None, ats=None, readerMax=None, cache=frameSizeCache):
+    """Works out the usable frame size and sets :py:attr:`desfire.DESFire.DESFire.MaxFrameSize`.
+
+    The smaller of card and reader limit wins. Without ATS the card limit is the 60 byte default, without
+    reader limit only the card limit counts. The card type is the ATS if given, else the hardware part of
+    GetVersion (one more exchange).
+
+    Args:
+        desfire (DESFire) : Session of the card
+        reader (str)      : Name of the reader, the cache key
+        ats (bytes)       : ATS of the card
+        readerMax (int)   : Largest command the reader accepts, see :py:func:`frameSizeFromReader`
+        cache (FrameSizeCache): Cache of negotiated sizes, None to always negotiate
+    Returns:
+        int: the frame size
+    """
+    cardType = bytes(ats) if ats is not None else None
+    if cache is not None and cardType is None:
+        cardType = bytes(desfire.getCardVersion().rawBytes[0:7])
+    # the reader limit depends on the transport
+    reader = (reader, desfire.wrapped, desfire.extendedLength)
+    size = cache.get(reader, cardType) if cache is not None else None
+    if size is None:
+        size = frameSizeFromATS(ats) if ats is not None else None
+        if size is None:
+            size = DEFAULT_FRAME_SIZE
+        elif desfire.wrapped:
+            # the card receives the whole wrapped APDU
+            size -= EXTENDED_WRAP_OVERHEAD if desfire.extendedLength else WRAP_OVERHEAD
+        readerSize = frameSizeFromReader(readerMax, desfire.wrapped, desfire.extendedLength)
+        if readerSize is not None:
+            size = min(size, readerSize)
+        if cache is not None:
+            cache.put(reader, cardType, size)
+    desfire.MaxFrameSize = size
+    return size
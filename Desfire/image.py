@@ -0,0 +1,361 @@
+"""Binary card images.
+
+A card image stores a :py:class:`desfire.dump.CardDump` (version info, application and key settings, file settings,
+contents and values) in a compact versioned format. File contents are stored as they are, not as lists of ints::
+
+    save(dump(desfire), 'card.dfi')
+    image = CardImage.load('card.dfi')        # memory mapped, payloads are not copied
+    image.file('00 AE 16', 1).data            # memoryview into the mapping
+    for difference in diff(CardImage.load('before.dfi'), image):
+        print(difference)
+
+Layout (all integers little endian, offsets from the start of the image)::
+
+    header       magic 'DFCI', format version, flags, application count, file count
+    card         references to version, PICC key settings, error
+    applications per application: AID, references to key settings, error, file IDs, first file, file count
+    files        per file sorted by AID and file ID: AID, file ID, flags, references to settings, data, skip
+                 reason, value
+    blob         the referenced bytes
+
+A reference is an (offset, length) pair, offset 0xFFFFFFFF stands for None.
+"""
+
+import mmap
+import struct
+from collections import namedtuple
+
+from .DESFire_DEF import DESFireCardVersion, DESFireFileSettings
+from .dump import CardInfo, ApplicationDump, FileDump, CardDump
+from .util import getBytes, changedRanges
+
+
+MAGIC = b'DFCI'
+FORMAT_VERSION = 1
+
+NONE = 0xFFFFFFFF
+
+HEADER = struct.Struct('<4sHHII')
+CARD = struct.Struct('<IIIIII')
+APPLICATION = struct.Struct('<3sxIIIIIIII')
+FILE = struct.Struct('<3sBBxxxIIIIIIq')
+
+FLAG_VALUE = 0x01
+
+
+class ImageFormatError(Exception):
+    """The data is not a card image of a supported format version."""
+
+
+class _Writer(object):
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.strings = {}
+
+    def ref(self, data):
+        if data is None:
+            return NONE, 0
+        offset = len(self.blob)
+        self.blob += data
+        return offset, len(data)
+
+    def string(self, text):
+        """Error and skip reasons repeat, every distinct string is stored once"""
+        if text is None:
+            return NONE, 0
+        ref = self.strings.get(text)
+        if ref is None:
+            ref = self.strings[text] = self.ref(text.encode('utf-8'))
+        return ref
+
+
+def toBytes(snapshot):
+    """Serializes a :py:class:`desfire.dump.CardDump` to a card image.
+
+    Args:
+        snapshot (CardDump): The dump
+    Returns:
+        bytes: the image
+    """
+    writer = _Writer()
+    card = snapshot.card
+    applications = sorted(snapshot.applications, key=lambda app: app.aid)
+    appTable = []
+    fileTable = []
+    for app in applications:
+        files = sorted(app.files, key=lambda f: f.fileId)
+        appTable.append((app.aid,) + writer.ref(app.keySettings) + writer.string(app.error)
+                        + writer.ref(bytes(app.fileIds)) + (len(fileTable), len(files)))
+        for f in files:
+            fileTable.append((app.aid, f.fileId, FLAG_VALUE if f.value is not None else 0)
+                             + writer.ref(f.settings) + writer.ref(f.data) + writer.string(f.skipped)
+                             + (f.value if f.value is not None else 0,))
+    cardRow = writer.ref(card.version) + writer.ref(card.keySettings) + writer.string(card.error)
+
+    base = HEADER.size + CARD.size + APPLICATION.size * len(appTable) + FILE.size * len(fileTable)
+
+    def rebase(row, positions):
+        row = list(row)
+        for i in positions:
+            if row[i] != NONE:
+                row[i] += base
+        return row
+
+    out = bytearray(HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(appTable), len(fileTable)))
+    out += CARD.pack(*rebase(cardRow, (0, 2, 4)))
+    for row in appTable:
+        out += APPLICATION.pack(*rebase(row, (1, 3, 5)))
+    for row in fileTable:
+        out += FILE.pack(*rebase(row, (3, 5, 7)))
+    out += writer.blob
+    return bytes(out)
+
+
+def save(snapshot, path):
+    """Writes a :py:class:`desfire.dump.CardDump` as card image to ``path``"""
+    with open(path, 'wb') as f:
+        f.write(toBytes(snapshot))
+
+
+class ImageFile(namedtuple('ImageFile', 'aid fileId settings data value skipped')):
+    """A file in a :py:class:`CardImage`, ``settings`` and ``data`` are memoryviews into the image."""
+
+    __slots__ = ()
+
+    @property
+    def fileSettings(self):
+        if self.settings is None:
+            return None
+        file_settings = DESFireFileSettings()
+        file_settings.parse(bytes(self.settings))
+        return file_settings
+
+
+class ImageApplication(namedtuple('ImageApplication', 'aid keySettings fileIds error first count')):
+    """An application in a :py:class:`CardImage`, its files are ``image.files(aid)``. ``keySettings`` is bytes."""
+
+    __slots__ = ()
+
+
+class CardImage(object):
+    """Read-only view of a card image.
+
+    Only the tables are decoded when the image is opened, settings and contents are memoryviews into the buffer
+    (e.g. an :py:class:`mmap.mmap`).
+    """
+
+    def __init__(self, buffer):
+        """
+        :param buffer: bytes-like object holding the image
+        """
+        if len(buffer) < HEADER.size + CARD.size:
+            raise ImageFormatError('Image too short')
+        magic, version, flags, appCount, fileCount = HEADER.unpack_from(buffer)
+        if magic != MAGIC:
+            raise ImageFormatError('Not a card image')
+        if version != FORMAT_VERSION:
+            raise ImageFormatError('Unsupported card image version %d' % (version,))
+        if len(buffer) < HEADER.size + CARD.size + APPLICATION.size * appCount + FILE.size * fileCount:
+            raise ImageFormatError('Image truncated')
+        self.buffer = memoryview(buffer)
+        self._mmap = None
+        self._card = CARD.unpack_from(self.buffer, HEADER.size)
+
+        offset = HEADER.size + CARD.size
+        self.applications = []
+        for row in APPLICATION.iter_unpack(self.buffer[offset:offset + APPLICATION.size * appCount]):
+            aid, ksOff, ksLen, errOff, errLen, idsOff, idsLen, first, count = row
+            fileIds = list(self._ref(idsOff, idsLen)) if idsOff != NONE else []
+            self.applications.append(ImageApplication(aid, _copy(self._ref(ksOff, ksLen)), fileIds,
+                                                      self._string(errOff, errLen), first, count))
+        self._applications = dict((app.aid, app) for app in self.applications)
+
+        offset += APPLICATION.size * appCount
+        self._files = self.buffer[offset:offset + FILE.size * fileCount]
+        #: (AID, file ID) -> position in the file table
+        self.index = {}
+        for i, (aid, fileId) in enumerate(struct.iter_unpack('<3sB36x', self._files)):
+            self.index[(aid, fileId)] = i
+
+    @classmethod
+    def load(cls, path):
+        """Opens an image file memory mapped, call :py:meth:`close` or use ``with`` to unmap it"""
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            image = cls(mapping)
+        except Exception:
+            mapping.close()
+            raise
+        image._mmap = mapping
+        return image
+
+    def close(self):
+        """Releases the mapping. Raises BufferError while memoryviews taken from the image are still referenced."""
+        self._files.release()
+        self.buffer.release()
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _ref(self, offset, length):
+        if offset == NONE:
+            return None
+        if offset + length > len(self.buffer):
+            raise ImageFormatError('Reference beyond the end of the image')
+        return self.buffer[offset:offset + length]
+
+    def _string(self, offset, length):
+        data = self._ref(offset, length)
+        return str(data, 'utf-8') if data is not None else None
+
+    @property
+    def version(self):
+        """Raw GetVersion answer"""
+        return self._ref(self._card[0], self._card[1])
+
+    @property
+    def cardVersion(self):
+        return DESFireCardVersion(list(self.version))
+
+    @property
+    def uid(self):
+        return bytes(self.version[14:21])
+
+    @property
+    def keySettings(self):
+        """Raw GetKeySettings answer of the PICC"""
+        return self._ref(self._card[2], self._card[3])
+
+    @property
+    def error(self):
+        return self._string(self._card[4], self._card[5])
+
+    def application(self, aid):
+        """Returns the :py:class:`ImageApplication` or None"""
+        return self._applications.get(getBytes(aid, 3))
+
+    def _file(self, i):
+        aid, fileId, flags, sOff, sLen, dOff, dLen, kOff, kLen, value = FILE.unpack_from(self._files, i * FILE.size)
+        return ImageFile(aid, fileId, self._ref(sOff, sLen), self._ref(dOff, dLen),
+                         value if flags & FLAG_VALUE else None, self._string(kOff, kLen))
+
+    def file(self, aid, fileId):
+        """Returns the :py:class:`ImageFile` or None"""
+        i = self.index.get((getBytes(aid, 3), fileId))
+        return self._file(i) if i is not None else None
+
+    def files(self, aid=None):
+        """Returns the files of an application, or of all applications, as list of :py:class:`ImageFile`"""
+        if aid is None:
+            return [self._file(i) for i in range(len(self.index))]
+        app = self.application(aid)
+        if app is None:
+            return []
+        return [self._file(i) for i in range(app.first, app.first + app.count)]
+
+    def toDump(self):
+        """Returns a :py:class:`desfire.dump.CardDump` with copies of all bytes"""
+        def copy(data):
+            return bytes(data) if data is not None else None
+        card = CardInfo(bytes(self.version), copy(self.keySettings), [app.aid for app in self.applications], self.error)
+        applications = []
+        for app in self.applications:
+            files = tuple(FileDump(f.aid, f.fileId, copy(f.settings), copy(f.data), f.value, f.skipped)
+                          for f in self.files(app.aid))
+            applications.append(ApplicationDump(app.aid, copy(app.keySettings), list(app.fileIds), app.error, files))
+        return CardDump(card, applications)
+
+
+class Difference(namedtuple('Difference', 'kind aid fileId old new ranges')):
+    """One difference between two images.
+
+    :param kind: What differs, one of the ``DIFF_*`` constants
+    :param aid: AID or None for card level differences
+    :param fileId: File ID or None
+    :param old: Value in the first image (bytes or int)
+    :param new: Value in the second image
+    :param ranges: For ``DIFF_DATA`` the changed (start, end) byte ranges of the new contents
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        where = ' '.join(part for part in (self.aid.hex() if self.aid is not None else None,
+                                           '%02X' % self.fileId if self.fileId is not None else None) if part)
+        if self.ranges is not None:
+            return '%s %s %s' % (self.kind, where, ', '.join('%d-%d' % r for r in self.ranges))
+        return '%s %s' % (self.kind, where)
+
+
+DIFF_VERSION = 'version'
+DIFF_KEY_SETTINGS = 'key settings'
+DIFF_APPLICATION_ADDED = 'application added'
+DIFF_APPLICATION_REMOVED = 'application removed'
+DIFF_FILE_ADDED = 'file added'
+DIFF_FILE_REMOVED = 'file removed'
+DIFF_SETTINGS = 'file settings'
+DIFF_DATA = 'data'
+DIFF_VALUE = 'value'
+DIFF_SKIPPED = 'skipped'
+
+
+def _same(a, b):
+    if a is None or b is None:
+        return a is b
+    return a == b
+
+
+def diff(old, new):
+    """Compares two :py:class:`CardImage` and yields :py:class:`Difference` records.
+
+    Unchanged files are detected by comparing the memoryviews, only changed contents are searched for the changed
+    byte ranges (see :py:func:`desfire.util.changedRanges`).
+    """
+    if not _same(old.version, new.version):
+        yield Difference(DIFF_VERSION, None, None, bytes(old.version), bytes(new.version), None)
+    if not _same(old.keySettings, new.keySettings):
+        yield Difference(DIFF_KEY_SETTINGS, None, None, _copy(old.keySettings), _copy(new.keySettings), None)
+    for app in old.applications:
+        if new.application(app.aid) is None:
+            yield Difference(DIFF_APPLICATION_REMOVED, app.aid, None, None, None, None)
+    for app in new.applications:
+        before = old.application(app.aid)
+        if before is None:
+            yield Difference(DIFF_APPLICATION_ADDED, app.aid, None, None, None, None)
+            for f in new.files(app.aid):
+                yield Difference(DIFF_FILE_ADDED, app.aid, f.fileId, None, None, None)
+            continue
+        if not _same(before.keySettings, app.keySettings):
+            yield Difference(DIFF_KEY_SETTINGS, app.aid, None, _copy(before.keySettings), _copy(app.keySettings), None)
+        for f in old.files(app.aid):
+            if (app.aid, f.fileId) not in new.index:
+                yield Difference(DIFF_FILE_REMOVED, app.aid, f.fileId, None, None, None)
+        for f in new.files(app.aid):
+            was = old.file(app.aid, f.fileId)
+            if was is None:
+                yield Difference(DIFF_FILE_ADDED, app.aid, f.fileId, None, None, None)
+                continue
+            if not _same(was.settings, f.settings):
+                yield Difference(DIFF_SETTINGS, app.aid, f.fileId, _copy(was.settings), _copy(f.settings), None)
+            if was.value != f.value:
+                yield Difference(DIFF_VALUE, app.aid, f.fileId, was.value, f.value, None)
+            if was.skipped != f.skipped:
+                yield Difference(DIFF_SKIPPED, app.aid, f.fileId, was.skipped, f.skipped, None)
+            if not _same(was.data, f.data):
+                if was.data is None or f.data is None:
+                    ranges = None
+                else:
+                    ranges = changedRanges(was.data, f.data)
+                yield Difference(DIFF_DATA, app.aid, f.fileId, _copy(was.data), _copy(f.data), ranges)
+
+
+def _copy(data):
+    return bytes(data) if data is not None else None
@@ -0,0 +1,223 @@
+"""Per-command metrics.
+
+:py:class:`Metrics` counts every command sent by :py:class:`desfire.DESFire.DESFire` per command byte: calls, bytes
+sent and received, answer status and latency histograms split into transceive time (in ``Device.transceive``) and
+crypto time (everything else: CMAC, encryption, framing)::
+
+    metrics = Metrics()
+    desfire = DESFire(device, metrics=metrics)
+    ...
+    print(metrics.toDict()['DF_INS_READ_DATA']['transceive']['sum'])
+    metrics.writePrometheus('/var/lib/node_exporter/desfire.prom')
+    server = metrics.serve(9464)
+
+Without metrics (the default) a command pays a single ``is None`` check.
+"""
+
+import bisect
+import os
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .DESFire_DEF import COMMAND_NAMES, STATUS_NAMES
+
+
+#: Upper bounds of the latency buckets in seconds
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+#: Status label of commands failing without a card status (transmission errors, CMAC mismatch)
+STATUS_ERROR = 'error'
+
+
+def commandName(cmd):
+    return COMMAND_NAMES[cmd]
+
+
+def statusName(status):
+    """Returns the DESFire_STATUS name, ``SW_xxxx`` for ISO status words of wrapped APDUs"""
+    if status is None:
+        return STATUS_ERROR
+    if status > 0xFF:
+        return 'SW_%04X' % (status,)
+    return STATUS_NAMES[status]
+
+
+class Histogram(object):
+    """Cumulative latency histogram with fixed buckets."""
+
+    __slots__ = ('bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = bounds
+        #: Observations per bucket, the last one is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        """Returns (upper bound, observations up to it) pairs, the last bound is ``float('inf')``"""
+        total = 0
+        result = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def toDict(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': self.cumulative()}
+
+
+class CommandMetrics(object):
+    """Counters of one command byte."""
+
+    __slots__ = ('calls', 'bytesOut', 'bytesIn', 'statuses', 'transceive', 'crypto')
+
+    def __init__(self, buckets):
+        self.calls = 0
+        self.bytesOut = 0
+        self.bytesIn = 0
+        #: status name -> count
+        self.statuses = {}
+        self.transceive = Histogram(buckets)
+        self.crypto = Histogram(buckets)
+
+    def toDict(self):
+        return {
+            'calls': self.calls,
+            'bytesOut': self.bytesOut,
+            'bytesIn': self.bytesIn,
+            'statuses': dict(self.statuses),
+            'transceive': self.transceive.toDict(),
+            'crypto': self.crypto.toDict(),
+        }
+
+
+class Measurement(object):
+    """Traffic of one command while it runs, filled in by :py:meth:`desfire.DESFire.DESFire._communicate`."""
+
+    __slots__ = ('command', 'bytesOut', 'bytesIn', 'transceive', 'status')
+
+    def __init__(self, command):
+        self.command = command
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.transceive = 0.0
+        self.status = None
+
+
+class Metrics(object):
+    """Thread-safe metrics registry, one instance can be shared by many DESFire sessions."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix='desfire'):
+        """
+        :param buckets: Upper bounds of the latency buckets in seconds
+        :param prefix: Prefix of the Prometheus metric names
+        """
+        self.buckets = tuple(buckets)
+        self.prefix = prefix
+        #: command byte -> :py:class:`CommandMetrics`
+        self.commands = {}
+        self._lock = threading.Lock()
+
+    def record(self, measurement, elapsed):
+        """Adds a finished command, ``elapsed`` is its wall time in seconds"""
+        with self._lock:
+            m = self.commands.get(measurement.command)
+            if m is None:
+                m = self.commands[measurement.command] = CommandMetrics(self.buckets)
+            m.calls += 1
+            m.bytesOut += measurement.bytesOut
+            m.bytesIn += measurement.bytesIn
+            status = statusName(measurement.status)
+            m.statuses[status] = m.statuses.get(status, 0) + 1
+            m.transceive.observe(measurement.transceive)
+            m.crypto.observe(max(elapsed - measurement.transceive, 0.0))
+
+    def reset(self):
+        with self._lock:
+            self.commands.clear()
+
+    def toDict(self):
+        """Returns a copy of all counters as dict of command name to dict"""
+        with self._lock:
+            return dict((commandName(cmd), m.toDict()) for cmd, m in sorted(self.commands.items()))
+
+    def toPrometheus(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        p = self.prefix
+        data = self.toDict()
+        lines = []
+
+        def family(name, kind, help):
+            lines.append('# HELP %s_%s %s' % (p, name, help))
+            lines.append('# TYPE %s_%s %s' % (p, name, kind))
+
+        for name, key, help in (('commands_total', 'calls', 'Commands sent to the card'),
+                                ('bytes_sent_total', 'bytesOut', 'Bytes sent to the card'),
+                                ('bytes_received_total', 'bytesIn', 'Bytes received from the card')):
+            family(name, 'counter', help)
+            for command, m in data.items():
+                lines.append('%s_%s{command="%s"} %d' % (p, name, command, m[key]))
+
+        family('status_total', 'counter', 'Answers per command and status')
+        for command, m in data.items():
+            for status, count in sorted(m['statuses'].items()):
+                lines.append('%s_status_total{command="%s",status="%s"} %d' % (p, command, status, count))
+
+        for name, key, help in (('transceive_seconds', 'transceive', 'Time spent in Device.transceive per command'),
+                                ('crypto_seconds', 'crypto', 'Time spent outside Device.transceive per command')):
+            family(name, 'histogram', help)
+            for command, m in data.items():
+                histogram = m[key]
+                for bound, count in histogram['buckets']:
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('%s_%s_bucket{command="%s",le="%s"} %d' % (p, name, command, le, count))
+                lines.append('%s_%s_sum{command="%s"} %r' % (p, name, command, histogram['sum']))
+                lines.append('%s_%s_count{command="%s"} %d' % (p, name, command, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def writePrometheus(self, path):
+        """Writes :py:meth:`toPrometheus` to ``path`` atomically (e.g. for the node exporter textfile collector)"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.desfire-metrics')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.toPrometheus())
+            os.replace(tmp, path)
+        except Exception:
+            os.unlink(tmp)
+            raise
+
+    def serve(self, port=9464, host='127.0.0.1'):
+        """Serves :py:meth:`toPrometheus` on ``http://host:port/metrics`` from a daemon thread.
+
+        :return: The :py:class:`http.server.ThreadingHTTPServer`, call ``shutdown()`` to stop it
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.toPrometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='DESFire-metrics', daemon=True).start()
+        return server
@@ -0,0 +1,101 @@
+"""Precompiled parsers of the card answers.
+
+Every parser reads a bytes-like answer (bytes, bytearray or a memoryview of the receive buffer) with
+``struct.unpack_from`` of a precompiled :py:class:`struct.Struct`, without slicing or copying it first. They return
+plain ints and tuples, the classes of :py:mod:`desfire.DESFire_DEF` and :py:mod:`desfire.compact` are built on them.
+"""
+
+import struct
+
+
+#: GetVersion: hardware and software vendor, type, subtype, major, minor, storage size and protocol,
+#: UID (7 bytes), batch number (4 bytes), production week and year
+VERSION = struct.Struct('<14B7s4sxBB')
+
+#: GetKeySettings: key settings, key count | key type
+KEY_SETTINGS = struct.Struct('<BB')
+
+#: GetFileSettings header: file type, communication settings, access rights (read|write, read&write|change)
+FILE_SETTINGS = struct.Struct('>BBH')
+#: Data files: file size (3 bytes, little endian)
+DATA_FILE_SETTINGS = struct.Struct('<HB')
+#: Value files: lower limit, upper limit, limited credit value, limited credit enabled
+VALUE_FILE_SETTINGS = struct.Struct('<iiiB')
+#: Record files: record size, max. number of records, current number of records (3 bytes each)
+RECORD_FILE_SETTINGS = struct.Struct('<HBHBHB')
+
+#: GetValue, Credit, Debit: signed 32 bit value
+VALUE = struct.Struct('<i')
+
+#: Values of :py:class:`desfire.DESFire_DEF.DESFireFileType`
+STANDARD_DATA_FILE = 0x00
+BACKUP_DATA_FILE = 0x01
+VALUE_FILE = 0x02
+LINEAR_RECORD_FILE = 0x03
+CYCLIC_RECORD_FILE = 0x04
+
+_NO_DATA_SETTINGS = (None,)
+_NO_VALUE_SETTINGS = (None, None, None, None)
+_NO_RECORD_SETTINGS = (None, None, None)
+
+
+def parseVersion(data):
+    """Returns the fields of :py:data:`VERSION`"""
+    return VERSION.unpack_from(data)
+
+
+def parseKeySettings(data):
+    """Returns (key settings, number of keys, key type) of a GetKeySettings answer"""
+    settings, keys = KEY_SETTINGS.unpack_from(data)
+    return settings, keys & 0x0F, keys & 0xF0
+
+
+def uint24(data, offset=0):
+    """Returns the 3 byte little endian integer at ``offset``"""
+    low, high = DATA_FILE_SETTINGS.unpack_from(data, offset)
+    return low | high << 16
+
+
+def parseFileSettings(data):
+    """Parses a GetFileSettings answer of any file type.
+
+    Returns:
+        tuple: file type, communication settings, access rights, file size, lower limit, upper limit, limited credit
+               value, limited credit enabled, record size, max. number of records, current number of records.
+               Fields of other file types are None.
+    """
+    fileType, comm, access = FILE_SETTINGS.unpack_from(data)
+    if fileType == STANDARD_DATA_FILE or fileType == BACKUP_DATA_FILE:
+        dataSettings = (uint24(data, 4),)
+    else:
+        dataSettings = _NO_DATA_SETTINGS
+    if fileType == VALUE_FILE:
+        lower, upper, limitedCredit, enabled = VALUE_FILE_SETTINGS.unpack_from(data, 4)
+        valueSettings = (lower, upper, limitedCredit, bool(enabled & 0x01))
+    else:
+        valueSettings = _NO_VALUE_SETTINGS
+    if fileType == LINEAR_RECORD_FILE or fileType == CYCLIC_RECORD_FILE:
+        size0, size1, max0, max1, cur0, cur1 = RECORD_FILE_SETTINGS.unpack_from(data, 4)
+        recordSettings = (size0 | size1 << 16, max0 | max1 << 16, cur0 | cur1 << 16)
+    else:
+        recordSettings = _NO_RECORD_SETTINGS
+    return (fileType, comm, access) + dataSettings + valueSettings + recordSettings
+
+
+def parseApplicationIDs(data):
+    """Returns the AIDs of a GetApplicationIDs answer as lists of 3 ints, most significant byte first"""
+    # One reversed copy of the answer turns every AID big endian, zip groups them without a Python level loop
+    backwards = iter(data[::-1])
+    aids = list(map(list, zip(backwards, backwards, backwards)))
+    aids.reverse()
+    return aids
+
+
+def parseFileIDs(data):
+    """Returns the file IDs of a GetFileIDs answer"""
+    return list(data)
+
+
+def parseValue(data):
+    """Returns the value of a GetValue answer"""
+    return VALUE.unpack_from(data)[0]
@@ -1,39 +1,158 @@
-from smartcard.pcsc.PCSCCardConnection import translateprotocolheader
-from smartcard.scard import SCardTransmit
-from smartcard.scard import SCardGetErrorMessage
+"""pyscard based devices.
+
+:py:class:`PCSCDevice` talks to the reader through ``smartcard.scard``. The module can be replaced by a fake with the
+same functions and constants (``PCSCDevice(connection, scard=fake)``), so the PC/SC layer runs without a reader.
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+from smartcard import scard as _scard
 from smartcard.Exceptions import CardConnectionException
 
 from .device import Device
 
 
+_logger = logging.getLogger(__name__)
+
 class PCSCNotConnected(Exception):
     """Tried to transmit to non-open connection."""
 
 
 class PCSCDevice(Device):
-    """DESFire protocol wrapper for pyscard interface."""
+    """DESFire protocol wrapper for pyscard interface.
 
-    def __init__(self, card_connection):
+    The protocol header is resolved once per card handle. :py:meth:`transaction` holds the card exclusively
+    (``SCardBeginTransaction``) around several APDUs, so other processes sharing the reader can not interleave.
+    """
+
+    def __init__(self, card_connection, scard=None):
         """
         :card_connection: :py:class:`smartcard.pcsc.PCSCCardConnection.PCSCCardConnection` instance. Call ``card_connection.connect()`` before calling any DESFire APIs.
+        :scard: Module providing the ``smartcard.scard`` API, defaults to ``smartcard.scard``
         """
         self.card_connection = card_connection
+        self.scard = scard or _scard
+        self._hcard = None
+        self._header = None
+        #: Nesting depth of :py:meth:`transaction`
+        self.transactionDepth = 0
+        # Card handle the outermost transaction was started on
+        self._transactionHcard = None
+        #: Seconds spent in the last ``SCardTransmit``
+        self.lastTransmitTime = None
+        #: Number of transmits and seconds spent in ``SCardTransmit`` in total
+        self.transmits = 0
+        self.transmitTime = 0.0
+        #: Optional callable ``onTransmit(tx, rx, seconds)`` called after every transmit
+        self.onTransmit = None
 
-    def transceive(self, bytes):
-
-        if not self.card_connection.hcard:
+    def _connection(self):
+        hcard = self.card_connection.hcard
+        if not hcard:
             raise PCSCNotConnected("Tried to transit to non-open connection: {}".format(self.card_connection))
+        if hcard != self._hcard:
+            # A reconnect may have negotiated another protocol
+            self._header = self.protocolHeader(self.card_connection.getProtocol())
+            self._hcard = hcard
+        return hcard
 
-        protocol = self.card_connection.getProtocol()
-        pcscprotocolheader = translateprotocolheader(protocol)
+    def protocolHeader(self, protocol):
+        """Returns the ``SCARD_PCI_*`` header for a protocol of :py:meth:`getProtocol`"""
+        scard = self.scard
+        if protocol == scard.SCARD_PROTOCOL_T0:
+            return scard.SCARD_PCI_T0
+        if protocol == scard.SCARD_PROTOCOL_T1:
+            return scard.SCARD_PCI_T1
+        if protocol == scard.SCARD_PROTOCOL_RAW:
+            return scard.SCARD_PCI_RAW
+        raise CardConnectionException('Unsupported protocol ' + str(protocol))
+
+    def transceive(self, bytes):
+        hcard = self._connection()
 
         # http://pyscard.sourceforge.net/epydoc/smartcard.scard.scard-module.html#SCardTransmit
-        hresult, response = SCardTransmit(self.card_connection.hcard, pcscprotocolheader, bytes)
+        # pyscard only accepts lists of ints
+        tx = list(bytes)
+        start = time.perf_counter()
+        hresult, response = self.scard.SCardTransmit(hcard, self._header, tx)
+        elapsed = time.perf_counter() - start
+        self.lastTransmitTime = elapsed
+        self.transmits += 1
+        self.transmitTime += elapsed
 
         if hresult != 0:
-            raise CardConnectionException('Failed to transmit with protocol ' + str(pcscprotocolheader) + '. ' + SCardGetErrorMessage(hresult))
+            raise CardConnectionException('Failed to transmit with protocol ' + str(self._header) + '. ' + self.scard.SCardGetErrorMessage(hresult))
+        if self.onTransmit is not None:
+            self.onTransmit(tx, response, elapsed)
         return response
 
+    def beginTransaction(self):
+        """Starts an exclusive transaction, nested calls only count the depth"""
+        if self.transactionDepth == 0:
+            hcard = self._connection()
+            hresult = self.scard.SCardBeginTransaction(hcard)
+            if hresult != 0:
+                raise CardConnectionException('Failed to begin transaction. ' + self.scard.SCardGetErrorMessage(hresult))
+            self._transactionHcard = hcard
+        self.transactionDepth += 1
+
+    def endTransaction(self, reset=False):
+        """Ends the transaction started by the matching :py:meth:`beginTransaction`.
+
+        :param reset: Reset the card when the outermost transaction ends (drops the DESFire session)
+        """
+        if self.transactionDepth == 0:
+            raise CardConnectionException('No transaction to end')
+        self.transactionDepth -= 1
+        if self.transactionDepth == 0:
+            disposition = self.scard.SCARD_RESET_CARD if reset else self.scard.SCARD_LEAVE_CARD
+            hresult = self.scard.SCardEndTransaction(self._connection(), disposition)
+            if hresult != 0:
+                raise CardConnectionException('Failed to end transaction. ' + self.scard.SCardGetErrorMessage(hresult))
+
+    @contextmanager
+    def transaction(self):
+        """Holds the card exclusively while the block runs::
+
+            with device.transaction():
+                desfire.authenticate(1, key)
+                desfire.readFileData(1, 0, 32, chained=True)
+        """
+        self.beginTransaction()
+        try:
+            yield self
+        except BaseException:
+            # the error of the block matters, not the one of ending the transaction
+            try:
+                self._leaveTransaction()
+            except Exception as e:
+                _logger.warning('Failed to end the transaction of %s: %s', self.card_connection, e)
+            raise
+        self._leaveTransaction()
+
+    def _leaveTransaction(self):
+        """Ends the transaction of :py:meth:`transaction`. If the card handle is gone (disconnected or reconnected
+        in the block), the transaction ended with it and only the depth is counted down."""
+        hcard = self.card_connection.hcard
+        if hcard and hcard == self._transactionHcard:
+            self.endTransaction()
+        elif self.transactionDepth > 0:
+            self.transactionDepth -= 1
+
+    def close(self):
+        """Disconnects the card connection, e.g. when the job of a :py:class:`desfire.pool.ReaderPool` ends"""
+        self.card_connection.disconnect()
+
+    def maxInput(self):
+        """Returns the largest command the reader accepts (``SCARD_ATTR_MAXINPUT``) or None if the driver does not tell,
+        see :py:func:`desfire.frames.negotiateFrameSize`"""
+        hresult, attrib = self.scard.SCardGetAttrib(self._connection(), self.scard.SCARD_ATTR_MAXINPUT)
+        if hresult != 0 or len(attrib) < 4:
+            return None
+        return int.from_bytes(bytes(attrib[:4]), 'little') or None
+
 class DummyPCSCDevice(Device):
     """DESFire protocol wrapper for pyscard interface."""
 
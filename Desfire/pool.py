@@ -0,0 +1,276 @@
+"""Multi-reader pool.
+
+:py:class:`ReaderPool` owns one worker thread per reader. Card jobs are queued per reader and receive a
+:py:class:`desfire.DESFire.DESFire` session for the card on that reader, results are handed back as
+:py:class:`concurrent.futures.Future`::
+
+    with ReaderPool.fromPCSC() as pool:
+        future = pool.submit([('selectApplication', '00 AE 16'),
+                              ('authenticate', 1, key),
+                              ('readFileData', 1, 0, 32)])
+        print(future.result()[-1])
+
+Readers work in parallel, so the throughput grows with the number of readers.
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError
+
+from .DESFire import DESFire
+from .device import Device
+
+
+_logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class ReaderStats(object):
+    """Throughput counters of one reader."""
+
+    def __init__(self):
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.timedOut = 0
+        #: Seconds spent running jobs
+        self.busy = 0.0
+        self.started = time.perf_counter()
+
+    def toDict(self, queueDepth=0):
+        elapsed = time.perf_counter() - self.started
+        return {
+            'submitted': self.submitted,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timedOut': self.timedOut,
+            'queueDepth': queueDepth,
+            'busy': self.busy,
+            'utilization': self.busy / elapsed if elapsed else 0.0,
+            'jobsPerMinute': self.completed * 60.0 / elapsed if elapsed else 0.0,
+        }
+
+
+class _Job(object):
+    __slots__ = ('job', 'future', 'deadline')
+
+    def __init__(self, job, future, deadline):
+        self.job = job
+        self.future = future
+        self.deadline = deadline
+
+
+class _Worker(threading.Thread):
+
+    def __init__(self, pool, name, device):
+        super(_Worker, self).__init__(name='ReaderPool-%s' % (name,), daemon=True)
+        self.pool = pool
+        self.reader = name
+        self.device = device
+        self.queue = queue.Queue()
+        self.stats = ReaderStats()
+        self.lock = threading.Lock()
+        #: Queued and running jobs
+        self.pending = 0
+
+    def connect(self):
+        """Returns (device, owned), ``owned`` tells if the device was made by the factory for this job only"""
+        device = self.device
+        if not isinstance(device, Device) and callable(device):
+            return device(), True
+        return device, False
+
+    def release(self, device):
+        """Closes a device made by the factory (e.g. disconnects the PC/SC card handle)"""
+        close = getattr(device, 'close', None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            # the card is usually gone already
+            self.pool.logger.debug('Closing the device of reader %s failed: %s', self.reader, e)
+
+    def session(self, device):
+        """Returns a fresh DESFire session, so no authentication state leaks from one job (card) to the next"""
+        return DESFire(device, self.pool.logger, metadataCache=self.pool.metadataCache, wrapped=self.pool.wrapped,
+                       extendedLength=self.pool.extendedLength, metrics=self.pool.metrics)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                return
+            if not item.future.set_running_or_notify_cancel():
+                with self.lock:
+                    self.pending -= 1
+                continue
+            start = time.perf_counter()
+            try:
+                if item.deadline is not None and start > item.deadline:
+                    raise TimeoutError('Job timed out in the queue of reader %s' % (self.reader,))
+                device, owned = self.connect()
+                try:
+                    desfire = self.session(device)
+                    # devices supporting it (PCSCDevice) hold the card exclusively for the whole job
+                    transaction = getattr(device, 'transaction', None)
+                    if transaction is not None:
+                        with transaction():
+                            result = self.pool.execute(desfire, item.job, item.deadline)
+                    else:
+                        result = self.pool.execute(desfire, item.job, item.deadline)
+                finally:
+                    if owned:
+                        self.release(device)
+            except Exception as e:
+                with self.lock:
+                    if isinstance(e, TimeoutError):
+                        self.stats.timedOut += 1
+                    else:
+                        self.stats.failed += 1
+                    self.stats.busy += time.perf_counter() - start
+                    self.pending -= 1
+                self.pool.logger.debug('Job on reader %s failed: %s', self.reader, e)
+                item.future.set_exception(e)
+            else:
+                with self.lock:
+                    self.stats.completed += 1
+                    self.stats.busy += time.perf_counter() - start
+                    self.pending -= 1
+                item.future.set_result(result)
+
+
+class ReaderPool(object):
+    """Runs card jobs on several readers in parallel, one worker thread per reader.
+
+    A job is either a callable getting the :py:class:`desfire.DESFire.DESFire` session of the card, or a list of
+    operations ``(method, *args)`` / ``(method, args, kwargs)`` called on the session in order. The future of an
+    operation list gets the list of results.
+    """
+
+    def __init__(self, devices, logger=None, metadataCache=None, wrapped=False, metrics=None, extendedLength=False):
+        """
+        :param devices: dict of reader name to :py:class:`desfire.device.Device` or to a callable returning a
+                        connected device for every job (e.g. connecting to the card currently on the reader).
+                        Devices made by a callable are closed (``device.close()`` if they have it) after the job
+        :param logger: Python :py:class:`logging.Logger` used for the pool and the DESFire sessions
+        :param metadataCache: Optional :py:class:`desfire.cache.MetadataCache` shared by the sessions of all readers
+        :param wrapped: Sessions send ISO 7816-4 wrapped APDUs, see :py:class:`desfire.DESFire.DESFire`
+        :param metrics: Optional :py:class:`desfire.metrics.Metrics` shared by the sessions of all readers
+        :param extendedLength: The readers support extended length APDUs, see :py:class:`desfire.DESFire.DESFire`
+        """
+        self.logger = logger or _logger
+        self.metadataCache = metadataCache
+        self.wrapped = wrapped
+        self.extendedLength = extendedLength
+        self.metrics = metrics
+        self._workers = {}
+        self._closed = False
+        for name, device in devices.items():
+            worker = _Worker(self, name, device)
+            self._workers[name] = worker
+            worker.start()
+
+    @classmethod
+    def fromPCSC(cls, readerList=None, logger=None, metadataCache=None, wrapped=False, metrics=None, extendedLength=False):
+        """Creates a pool with a worker for every PC/SC reader.
+
+        Every job connects to the card currently on the reader and disconnects when it ends.
+
+        :param readerList: pyscard readers, defaults to ``smartcard.System.readers()``
+        Further parameters see :py:meth:`__init__`
+        """
+        from smartcard.System import readers
+        from .pcsc import PCSCDevice
+
+        def connect(reader):
+            connection = reader.createConnection()
+            connection.connect()
+            return PCSCDevice(connection.component)
+
+        return cls(dict((str(reader), lambda reader=reader: connect(reader)) for reader in (readerList or readers())),
+                   logger, metadataCache, wrapped, metrics, extendedLength)
+
+    @property
+    def readers(self):
+        return list(self._workers)
+
+    def submit(self, job, reader=None, timeout=None):
+        """Queues a card job.
+
+        :param job: Callable ``job(desfire)`` or list of operations ``(method, *args)`` / ``(method, args, kwargs)``
+        :param reader: Name of the reader, defaults to the reader with the fewest queued and running jobs
+        :param timeout: Seconds from now after which the job fails with :py:class:`concurrent.futures.TimeoutError`.
+                        It is checked before the job starts and between the operations of an operation list,
+                        a running card command is never interrupted.
+        :return: :py:class:`concurrent.futures.Future`
+        """
+        if self._closed:
+            raise RuntimeError('ReaderPool is shut down')
+        if reader is None:
+            worker = min(self._workers.values(), key=lambda w: w.pending)
+        else:
+            worker = self._workers[reader]
+        future = Future()
+        deadline = time.perf_counter() + timeout if timeout is not None else None
+        with worker.lock:
+            worker.stats.submitted += 1
+            worker.pending += 1
+        worker.queue.put(_Job(job, future, deadline))
+        return future
+
+    def map(self, jobs, timeout=None):
+        """Submits all jobs and returns their futures"""
+        return [self.submit(job, timeout=timeout) for job in jobs]
+
+    @staticmethod
+    def execute(desfire, job, deadline=None):
+        """Runs one job on a session, see :py:class:`ReaderPool`"""
+        if callable(job):
+            return job(desfire)
+        results = []
+        for op in job:
+            if deadline is not None and time.perf_counter() > deadline:
+                raise TimeoutError('Job timed out before %s' % (op[0],))
+            if len(op) == 3 and isinstance(op[1], (list, tuple)) and isinstance(op[2], dict):
+                name, args, kwargs = op
+            else:
+                name, args, kwargs = op[0], op[1:], {}
+            results.append(getattr(desfire, name)(*args, **kwargs))
+        return results
+
+    def queueDepth(self, reader):
+        """Number of jobs waiting for ``reader``"""
+        return self._workers[reader].queue.qsize()
+
+    def stats(self):
+        """Returns the counters of every reader as dict of reader name to dict, plus a ``'total'`` entry"""
+        result = {}
+        for name, worker in self._workers.items():
+            with worker.lock:
+                result[name] = worker.stats.toDict(worker.queue.qsize())
+        total = dict.fromkeys(('submitted', 'completed', 'failed', 'timedOut', 'queueDepth', 'jobsPerMinute'), 0)
+        for counters in result.values():
+            for k in total:
+                total[k] += counters[k]
+        result['total'] = total
+        return result
+
+    def shutdown(self, wait=True):
+        """Stops the workers after the queued jobs are done"""
+        if not self._closed:
+            self._closed = True
+            for worker in self._workers.values():
+                worker.queue.put(_STOP)
+        if wait:
+            for worker in self._workers.values():
+                worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
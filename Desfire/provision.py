@@ -0,0 +1,468 @@
+"""Manifest driven batch provisioning.
+
+A manifest declares the wanted card layout: applications with key type, key settings and keys, files with
+permissions and initial contents or values, and key rotations::
+
+    {
+        "picc": {"keyType": "2K3DES", "key": "00 00 00 00 00 00 00 00", "format": true},
+        "applications": [{
+            "aid": "00 AE 16", "keyType": "AES", "keyCount": 3,
+            "keySettings": ["KS_ALLOW_CHANGE_MK", "KS_LISTING_WITHOUT_MK"],
+            "keys": {"0": "00 10 20 ...", "2": "22 33 44 ..."},
+            "files": [
+                {"id": 1, "type": "std", "size": 32, "permissions": {"read": 2, "write": 2, "readWrite": 2, "change": 0},
+                 "data": "01 02 03"},
+                {"id": 2, "type": "value", "permissions": {"read": 2, "write": 2, "readWrite": 2, "change": 0},
+                 "lowerLimit": 0, "upperLimit": 10000, "value": 1000}
+            ],
+            "newKeySettings": ["KS_ALLOW_CHANGE_MK"]
+        }]
+    }
+
+``"picc"`` may also give a ``"newKey"`` (and ``"newKeyType"``), the PICC master key is changed to it at the very end.
+
+:py:func:`compilePlan` turns it into a :py:class:`Plan`: a flat list of :py:class:`Step` in an order needing as few
+selectApplication/authenticate calls as possible. :py:class:`Provisioner` runs the plan on cards and records the
+progress of every card in a :py:class:`Journal`, so a card pulled off the reader continues where it stopped.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from enum import Enum
+
+from .DESFire import DESFireCommunicationError
+from .DESFire_DEF import DESFireKeyType, DESFireKeySettings, DESFireFilePermissions, DESFire_STATUS
+
+
+_logger = logging.getLogger(__name__)
+
+PICC_AID = '00 00 00'
+
+ACCESS_FREE = 0x0E
+ACCESS_NEVER = 0x0F
+
+KEY_TYPES = {
+    'DES': DESFireKeyType.DF_KEY_2K3DES,
+    '2K3DES': DESFireKeyType.DF_KEY_2K3DES,
+    '3K3DES': DESFireKeyType.DF_KEY_3K3DES,
+    'AES': DESFireKeyType.DF_KEY_AES,
+}
+
+#: Length of the key of a freshly created application
+DEFAULT_KEY_LENGTH = {
+    DESFireKeyType.DF_KEY_2K3DES: 8,
+    DESFireKeyType.DF_KEY_3K3DES: 24,
+    DESFireKeyType.DF_KEY_AES: 16,
+}
+
+
+class ManifestError(Exception):
+    """The manifest is invalid or can not be provisioned (e.g. a key change that is frozen)."""
+
+
+#: Key used to authenticate or passed to changeKey: key number, key bytes and DESFireKeyType
+KeySpec = namedtuple('KeySpec', 'keyNo key keyType')
+
+
+class Step(namedtuple('Step', 'aid auth method args description')):
+    """One card command of a plan.
+
+    :param aid: Application the command runs in
+    :param auth: :py:class:`KeySpec` the session must be authenticated with, None if no authentication is needed
+    :param method: Name of the :py:class:`desfire.DESFire.DESFire` method
+    :param args: Arguments, :py:class:`KeySpec` arguments are turned into DESFireKey objects
+    :param description: Human readable description
+    """
+
+    __slots__ = ()
+
+    def run(self, desfire):
+        args = [desfireKey(desfire, a) if isinstance(a, KeySpec) else a for a in self.args]
+        return getattr(desfire, self.method)(*args)
+
+    def __str__(self):
+        auth = 'key %d' % self.auth.keyNo if self.auth else '-'
+        return '%s [%s] %s' % (self.aid, auth, self.description)
+
+
+def desfireKey(desfire, spec):
+    return desfire.createKeySetting(spec.key, spec.keyNo, spec.keyType, [])
+
+
+def _normalize(value):
+    """Returns ``value`` as JSON serializable data: enums as ints, bytes as hex strings, permissions packed"""
+    if isinstance(value, KeySpec):
+        return [value.keyNo, value.key.hex(), value.keyType.value]
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (bytes, bytearray)):
+        return value.hex()
+    if isinstance(value, DESFireFilePermissions):
+        return value.pack()
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def _planDigest(steps):
+    """Returns the SHA-1 of the steps, identifying a plan independently of how its manifest spelled the values"""
+    normalized = [_normalize([s.aid, s.auth, s.method, s.args]) for s in steps]
+    return hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()
+
+
+class Plan(object):
+    """Compiled manifest: the steps and the number of context switches they need."""
+
+    def __init__(self, steps, digest):
+        self.steps = steps
+        #: Identifies the plan in the :py:class:`Journal`
+        self.digest = digest
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __iter__(self):
+        return iter(self.steps)
+
+    def contextSwitches(self):
+        """Returns (selects, authentications) needed to run the whole plan on one card"""
+        selects = auths = 0
+        aid = auth = None
+        for step in self.steps:
+            if step.aid != aid:
+                selects += 1
+                aid, auth = step.aid, None
+            if step.auth is not None and step.auth != auth:
+                auths += 1
+                auth = step.auth
+            if step.method == 'changeKey' and auth is not None and step.args[0] == auth.keyNo:
+                auth = None
+        return selects, auths
+
+    def __repr__(self):
+        return '\n'.join(str(s) for s in self.steps)
+
+
+def _key(text):
+    if isinstance(text, str):
+        return bytes(bytearray.fromhex(text))
+    return bytes(text)
+
+
+def _keyType(name):
+    try:
+        return KEY_TYPES[name] if isinstance(name, str) else DESFireKeyType(name)
+    except (KeyError, ValueError):
+        raise ManifestError('Unknown key type %r' % (name,))
+
+
+def _keySettings(names):
+    settings = []
+    for name in names:
+        if isinstance(name, DESFireKeySettings):
+            settings.append(name)
+            continue
+        if not name.startswith('KS_'):
+            name = 'KS_' + name
+        try:
+            settings.append(DESFireKeySettings[name])
+        except KeyError:
+            raise ManifestError('Unknown key setting %r' % (name,))
+    return settings
+
+
+def _access(value):
+    if value in ('free', None):
+        return ACCESS_FREE
+    if value == 'never':
+        return ACCESS_NEVER
+    return int(value)
+
+
+def _changeKeySpec(keyType, key):
+    """DESFire cards expect a 16 byte key when an 8 byte DES key is set, the halves are equal"""
+    if keyType == DESFireKeyType.DF_KEY_2K3DES and len(key) == 8:
+        return key * 2
+    return key
+
+
+class _Compiler(object):
+
+    def __init__(self, manifest):
+        self.manifest = manifest
+        self.steps = []
+        # Current value of every key: (aid, keyNo) -> bytes
+        self.keys = {}
+        self.keyTypes = {}
+
+    def auth(self, aid, keyNo):
+        return KeySpec(keyNo, self.keys[(aid, keyNo)], self.keyTypes[aid])
+
+    def emit(self, aid, auth, method, args, description):
+        self.steps.append(Step(aid, auth, method, tuple(args), description))
+
+    def changeKey(self, aid, authKeyNo, keyNo, newKey, newKeyType=None):
+        """Emits a key change, ``newKeyType`` changes the key type (PICC master key only)"""
+        keyType = self.keyTypes[aid]
+        newKeyType = newKeyType or keyType
+        old = KeySpec(keyNo, self.keys[(aid, keyNo)], keyType)
+        new = KeySpec(keyNo, _changeKeySpec(newKeyType, newKey), newKeyType)
+        self.emit(aid, self.auth(aid, authKeyNo), 'changeKey', (keyNo, new, old), 'changeKey %d' % keyNo)
+        self.keys[(aid, keyNo)] = newKey
+        self.keyTypes[aid] = newKeyType
+
+    def compile(self):
+        picc = self.manifest.get('picc', {})
+        piccType = _keyType(picc.get('keyType', '2K3DES'))
+        self.keyTypes[PICC_AID] = piccType
+        self.keys[(PICC_AID, 0)] = _key(picc.get('key', '00' * DEFAULT_KEY_LENGTH[piccType]))
+
+        apps = self.manifest.get('applications', [])
+        # All applications are created in one PICC session
+        if picc.get('format'):
+            self.emit(PICC_AID, self.auth(PICC_AID, 0), 'formatCard', (), 'formatCard')
+        for app in apps:
+            aid = app['aid']
+            keyType = _keyType(app.get('keyType', 'AES'))
+            keyCount = int(app.get('keyCount', 1))
+            if not 1 <= keyCount <= 14:
+                raise ManifestError('Application %s: keyCount must be 1..14' % (aid,))
+            self.keyTypes[aid] = keyType
+            for keyNo in range(keyCount):
+                self.keys[(aid, keyNo)] = bytes(DEFAULT_KEY_LENGTH[keyType])
+            self.emit(PICC_AID, self.auth(PICC_AID, 0), 'createApplication',
+                      (aid, _keySettings(app.get('keySettings', [])), keyCount, keyType), 'createApplication %s' % aid)
+
+        for app in apps:
+            self.compileApplication(app)
+
+        if 'newKey' in picc:
+            self.changeKey(PICC_AID, 0, 0, _key(picc['newKey']), _keyType(picc.get('newKeyType', piccType)))
+        return Plan(self.steps, _planDigest(self.steps))
+
+    def compileApplication(self, app):
+        aid = app['aid']
+        keyCount = int(app.get('keyCount', 1))
+        settings = sum(s.value for s in _keySettings(app.get('keySettings', []))) & 0xFF
+
+        files = app.get('files', [])
+        for f in files:
+            perm = f.get('permissions', {})
+            filePerm = DESFireFilePermissions()
+            filePerm.setPerm(_access(perm.get('read')), _access(perm.get('write')), _access(perm.get('readWrite')), _access(perm.get('change')))
+            fileType = f.get('type', 'std')
+            if fileType == 'std':
+                self.emit(aid, self.auth(aid, 0), 'createStdDataFile', (f['id'], filePerm, int(f['size'])), 'createStdDataFile %d' % f['id'])
+            elif fileType == 'value':
+                self.emit(aid, self.auth(aid, 0), 'createValueFile',
+                          (f['id'], filePerm, int(f.get('lowerLimit', 0)), int(f.get('upperLimit', 10000)), int(f.get('value', 0))),
+                          'createValueFile %d' % f['id'])
+            else:
+                raise ManifestError('File %s/%d: unsupported file type %r' % (aid, f['id'], fileType))
+
+        # Initial contents, grouped by the key granting write access. Free access reuses the master key session.
+        writes = []
+        for f in files:
+            if f.get('type', 'std') != 'std' or not f.get('data'):
+                continue
+            data = _key(f['data'])
+            if len(data) > int(f['size']):
+                raise ManifestError('File %s/%d: data is longer than the file' % (aid, f['id']))
+            perm = f.get('permissions', {})
+            write, readWrite = _access(perm.get('write')), _access(perm.get('readWrite'))
+            if ACCESS_FREE in (write, readWrite):
+                keyNo = 0
+            elif write != ACCESS_NEVER:
+                keyNo = write
+            elif readWrite != ACCESS_NEVER:
+                keyNo = readWrite
+            else:
+                raise ManifestError('File %s/%d: data given, but the file is never writable' % (aid, f['id']))
+            writes.append((keyNo, f['id'], data))
+        for keyNo, fileId, data in sorted(writes, key=lambda w: w[0] != 0 and w[0]):
+            self.emit(aid, self.auth(aid, keyNo), 'writeFileData', (fileId, 0, len(data), data, True),
+                      'writeFileData %d (%d bytes)' % (fileId, len(data)))
+
+        # Key rotations: keys used to authorize other changes are changed last, the master key at the very end
+        rotations = dict((int(k), _key(v)) for k, v in app.get('keys', {}).items())
+        for keyNo in rotations:
+            if not 0 <= keyNo < keyCount:
+                raise ManifestError('Application %s: key %d does not exist' % (aid, keyNo))
+        changeAccess = settings >> 4
+        others = [k for k in sorted(rotations) if k != 0]
+        if others and changeAccess == 0x0F:
+            raise ManifestError('Application %s: key changes are frozen' % (aid,))
+        if changeAccess not in (0x00, 0x0E, 0x0F):
+            others.sort(key=lambda k: k == changeAccess)
+        for keyNo in others:
+            authKeyNo = keyNo if changeAccess == 0x0E else changeAccess if changeAccess != 0x0F else 0
+            self.changeKey(aid, authKeyNo, keyNo, rotations[keyNo])
+
+        newSettings = app.get('newKeySettings')
+        if newSettings is not None and not settings & DESFireKeySettings.KS_CONFIGURATION_CHANGEABLE.value:
+            raise ManifestError('Application %s: key settings are frozen' % (aid,))
+        if 0 in rotations and not settings & DESFireKeySettings.KS_ALLOW_CHANGE_MK.value:
+            raise ManifestError('Application %s: master key is frozen' % (aid,))
+        allowChangeMK = newSettings is None or DESFireKeySettings.KS_ALLOW_CHANGE_MK in _keySettings(newSettings)
+        if newSettings is not None and allowChangeMK:
+            self.emit(aid, self.auth(aid, 0), 'changeKeySettings', (_keySettings(newSettings),), 'changeKeySettings')
+        if 0 in rotations:
+            self.changeKey(aid, 0, 0, rotations[0])
+        if newSettings is not None and not allowChangeMK:
+            self.emit(aid, self.auth(aid, 0), 'changeKeySettings', (_keySettings(newSettings),), 'changeKeySettings')
+
+
+def compilePlan(manifest):
+    """Compiles a manifest (dict, see module documentation) into a :py:class:`Plan`.
+
+    :raise: :py:class:`ManifestError` if the manifest is invalid
+    """
+    return _Compiler(manifest).compile()
+
+
+def loadManifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class Journal(object):
+    """Number of completed plan steps per card UID, optionally persisted as JSON file after every step."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._progress = {}
+        if path:
+            try:
+                with open(path) as f:
+                    self._progress = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    def get(self, plan, uid):
+        return self._progress.get(plan.digest, {}).get(uid, 0)
+
+    def set(self, plan, uid, done):
+        with self._lock:
+            self._progress.setdefault(plan.digest, {})[uid] = done
+            if self.path:
+                with open(self.path, 'w') as f:
+                    json.dump(self._progress, f)
+
+
+class CardResult(namedtuple('CardResult', 'uid steps resumedAt duration')):
+    """Outcome of :py:meth:`Provisioner.provision`: steps run, step a resumed card continued at (None if new) and seconds"""
+    __slots__ = ()
+
+
+class BatchReport(object):
+    """Outcome of :py:meth:`Provisioner.run`."""
+
+    def __init__(self, results, errors, duration):
+        self.results = results
+        self.errors = errors
+        self.duration = duration
+
+    @property
+    def cards(self):
+        return len(self.results)
+
+    @property
+    def cardsPerMinute(self):
+        return self.cards * 60.0 / self.duration if self.duration else 0.0
+
+    def toDict(self):
+        return {
+            'cards': self.cards,
+            'failed': len(self.errors),
+            'resumed': sum(1 for r in self.results if r.resumedAt is not None),
+            'duration': self.duration,
+            'cardsPerMinute': self.cardsPerMinute,
+        }
+
+    def __repr__(self):
+        return 'BatchReport(%d cards, %d failed, %.1f cards/min)' % (self.cards, len(self.errors), self.cardsPerMinute)
+
+
+class Provisioner(object):
+    """Runs a :py:class:`Plan` on cards."""
+
+    def __init__(self, plan, journal=None, logger=None):
+        """
+        :param plan: :py:class:`Plan` or manifest dict
+        :param journal: :py:class:`Journal` keeping the progress of every card, defaults to an in-memory journal
+        """
+        self.plan = plan if isinstance(plan, Plan) else compilePlan(plan)
+        self.journal = journal if journal is not None else Journal()
+        self.logger = logger or _logger
+
+    def provision(self, desfire):
+        """Provisions the card of a :py:class:`desfire.DESFire.DESFire` session, continuing a partially provisioned card.
+
+        The first step of a resumed card may have been executed before the card was pulled off the reader. Such a
+        step is accepted if the card answers that the application or file already exists, or that the key was
+        already changed.
+
+        :return: :py:class:`CardResult`
+        """
+        start = time.perf_counter()
+        uid = bytes(desfire.getCardVersion().UID).hex()
+        done = self.journal.get(self.plan, uid)
+        resumedAt = done if done else None
+        steps = 0
+        for index in range(done, len(self.plan)):
+            step = self.plan.steps[index]
+            resuming = resumedAt is not None and index == done
+            try:
+                # The session state of DESFire skips selects and authentications that are not needed
+                desfire.ensureApplication(step.aid)
+                if step.auth is not None:
+                    desfire.ensureAuthenticated(step.auth.keyNo, desfireKey(desfire, step.auth))
+                step.run(desfire)
+            except DESFireCommunicationError as e:
+                if not (resuming and self._alreadyApplied(desfire, step, e.status_code)):
+                    raise
+                self.logger.info('Card %s: step %d (%s) was already applied', uid, index, step)
+            steps += 1
+            self.journal.set(self.plan, uid, index + 1)
+        return CardResult(uid, steps, resumedAt, time.perf_counter() - start)
+
+    @staticmethod
+    def _alreadyApplied(desfire, step, status):
+        if step.method in ('createApplication', 'createStdDataFile', 'createValueFile'):
+            return status == DESFire_STATUS.ST_DuplicateAidFiles.value
+        if step.method != 'changeKey':
+            return False
+        keyNo, new = step.args[0], step.args[1]
+        if status == DESFire_STATUS.ST_IntegrityError.value and keyNo != step.auth.keyNo:
+            # The card decoded the cryptogram with the already changed key
+            return True
+        if status == DESFire_STATUS.ST_AuthentError.value and keyNo == step.auth.keyNo:
+            # Changed the key used to authenticate: the new key must work now
+            key = new.key
+            if new.keyType == step.auth.keyType == DESFireKeyType.DF_KEY_2K3DES and key[:8] == key[8:]:
+                # undo the doubling of an 8 byte DES key by _changeKeySpec
+                key = key[:8]
+            desfire.ensureApplication(step.aid)
+            desfire.authenticate(keyNo, desfireKey(desfire, KeySpec(keyNo, key, new.keyType)))
+            return True
+        return False
+
+    def run(self, pool, cards, timeout=None):
+        """Provisions ``cards`` cards on a :py:class:`desfire.pool.ReaderPool`.
+
+        :return: :py:class:`BatchReport`, failed cards are listed in ``errors`` and can be resumed by running them again
+        """
+        start = time.perf_counter()
+        futures = pool.map([self.provision] * cards, timeout=timeout)
+        results, errors = [], []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(e)
+        return BatchReport(results, errors, time.perf_counter() - start)
@@ -0,0 +1,284 @@
+"""Record and replay card sessions.
+
+:py:class:`RecordingDevice` wraps a real device and records every exchanged frame with its duration, plus the random
+challenges (RndA) of the authentications. :py:class:`ReplayDevice` plays a recorded session back, so the same
+application code runs against it deterministically, at full speed or with the original timing::
+
+    recorder = RecordingDevice(PCSCDevice(connection), SessionWriter('sessions.dfr.gz'))
+    run(DESFire(recorder))
+    recorder.newSession()   # the next card
+    ...
+    recorder.close()
+
+    for session in readSessions('sessions.dfr.gz'):
+        run(DESFire(ReplayDevice(session)))
+
+:py:class:`desfire.DESFire.DESFire` takes RndA from ``device.randomBytes(n)`` when the device has it, this is how the
+challenge is recorded and pinned on replay.
+
+File format (little endian, optionally gzip compressed when the path ends with ``.gz``): the header ``DFRS`` +
+uint16 version, followed by events of ``kind (uint8), length1 (uint32), length2 (uint32), microseconds (uint32)``
+and their bytes. A session starts with a session event, a frame event carries TX and RX, a challenge event the
+random bytes.
+"""
+
+import gzip
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from Crypto import Random
+
+from .device import Device
+
+
+MAGIC = b'DFRS'
+FORMAT_VERSION = 1
+
+HEADER = struct.Struct('<4sH')
+EVENT = struct.Struct('<BIII')
+
+EVENT_SESSION = 0x53
+EVENT_FRAME = 0x46
+EVENT_CHALLENGE = 0x43
+
+
+class ReplayError(Exception):
+    """The replayed code sent something else than the recorded session, or the file is broken."""
+
+
+class Frame(namedtuple('Frame', 'tx rx duration')):
+    """A recorded frame exchange.
+
+    :param tx: Sent bytes
+    :param rx: Received bytes
+    :param duration: Seconds spent in ``transceive`` of the recorded device
+    """
+
+    __slots__ = ()
+
+
+class Session(object):
+    """The frames and challenges exchanged with one card, in order."""
+
+    def __init__(self, frames=None, challenges=None):
+        #: List of :py:class:`Frame`
+        self.frames = frames if frames is not None else []
+        #: List of random challenges (bytes) handed out by :py:meth:`RecordingDevice.randomBytes`
+        self.challenges = challenges if challenges is not None else []
+
+    @property
+    def duration(self):
+        """Seconds the recorded session spent in ``transceive``"""
+        return sum(f.duration for f in self.frames)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __bool__(self):
+        return bool(self.frames or self.challenges)
+
+
+def _open(path, mode):
+    if str(path).endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _micros(seconds):
+    return min(int(round(seconds * 1e6)), 0xFFFFFFFF)
+
+
+class SessionWriter(object):
+    """Writes sessions to a file, one writer can be shared by the recording devices of many readers."""
+
+    def __init__(self, path):
+        """
+        :param path: File to create, gzip compressed if it ends with ``.gz``
+        """
+        self._file = _open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+        self._lock = threading.Lock()
+        self.sessions = 0
+
+    def write(self, session):
+        """Appends a :py:class:`Session`"""
+        # Challenges go first, replay hands them out in order independent of the frames
+        chunks = [EVENT.pack(EVENT_SESSION, 0, 0, 0)]
+        for challenge in session.challenges:
+            chunks.append(EVENT.pack(EVENT_CHALLENGE, len(challenge), 0, 0))
+            chunks.append(challenge)
+        for frame in session.frames:
+            chunks.append(EVENT.pack(EVENT_FRAME, len(frame.tx), len(frame.rx), _micros(frame.duration)))
+            chunks.append(frame.tx)
+            chunks.append(frame.rx)
+        with self._lock:
+            self._file.write(b''.join(chunks))
+            self.sessions += 1
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def writeSessions(path, sessions):
+    """Writes the :py:class:`Session` objects to ``path``"""
+    with SessionWriter(path) as writer:
+        for session in sessions:
+            writer.write(session)
+
+
+def readSessions(path):
+    """Yields the :py:class:`Session` objects stored in ``path`` one at a time.
+
+    :raise: :py:class:`ReplayError` if the file is no session recording or truncated
+    """
+    with _open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) != HEADER.size:
+            raise ReplayError('Not a session recording: %s' % (path,))
+        magic, version = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise ReplayError('Not a session recording: %s' % (path,))
+        if version != FORMAT_VERSION:
+            raise ReplayError('Unsupported session recording version %d' % (version,))
+
+        def read(size):
+            data = f.read(size)
+            if len(data) != size:
+                raise ReplayError('Truncated session recording: %s' % (path,))
+            return data
+
+        session = None
+        while True:
+            event = f.read(EVENT.size)
+            if not event:
+                break
+            if len(event) != EVENT.size:
+                raise ReplayError('Truncated session recording: %s' % (path,))
+            kind, length1, length2, micros = EVENT.unpack(event)
+            if kind == EVENT_SESSION:
+                if session is not None:
+                    yield session
+                session = Session()
+            elif session is None:
+                raise ReplayError('Event outside of a session')
+            elif kind == EVENT_FRAME:
+                session.frames.append(Frame(read(length1), read(length2), micros / 1e6))
+            elif kind == EVENT_CHALLENGE:
+                session.challenges.append(read(length1))
+            else:
+                raise ReplayError('Unknown event 0x%02X' % (kind,))
+        if session is not None:
+            yield session
+
+
+class RecordingDevice(Device):
+    """Device wrapper recording the frames exchanged with the wrapped device and the authentication challenges.
+
+    Other attributes (e.g. ``transaction`` of :py:class:`desfire.pcsc.PCSCDevice`) are taken from the wrapped device.
+    """
+
+    def __init__(self, device, writer=None, clock=time.perf_counter):
+        """
+        :param device: The :py:class:`desfire.device.Device` talking to the card
+        :param writer: Optional :py:class:`SessionWriter` getting every finished session
+        :param clock: Time source for the frame durations
+        """
+        self.device = device
+        self.writer = writer
+        self.clock = clock
+        #: The :py:class:`Session` being recorded
+        self.session = Session()
+
+    def transceive(self, bytes):
+        tx = _bytes(bytes)
+        start = self.clock()
+        rx = self.device.transceive(bytes)
+        self.session.frames.append(Frame(tx, _bytes(rx), self.clock() - start))
+        return rx
+
+    def randomBytes(self, size):
+        """Returns ``size`` random bytes and records them"""
+        challenge = Random.get_random_bytes(size)
+        self.session.challenges.append(challenge)
+        return challenge
+
+    def newSession(self):
+        """Ends the current session (passing it to the writer) and starts a new one, e.g. for the next card.
+
+        :return: The finished :py:class:`Session`
+        """
+        session, self.session = self.session, Session()
+        if self.writer is not None and session:
+            self.writer.write(session)
+        return session
+
+    def close(self):
+        """Ends the current session, the writer stays open"""
+        return self.newSession()
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+
+def _bytes(data):
+    return bytes(data) if not isinstance(data, bytes) else data
+
+
+class ReplayDevice(Device):
+    """Device answering with the frames of a recorded :py:class:`Session`, in order."""
+
+    def __init__(self, session, timing=False, strict=True, sleep=time.sleep):
+        """
+        :param session: The :py:class:`Session` to play back
+        :param timing: Take as long as the recorded device for every frame
+        :param strict: Raise :py:class:`ReplayError` when a sent frame differs from the recorded one
+        :param sleep: Used to wait for the recorded duration
+        """
+        self.session = session
+        self.timing = timing
+        self.strict = strict
+        self.sleep = sleep
+        #: Index of the next frame
+        self.position = 0
+        self._challenge = 0
+
+    def transceive(self, bytes):
+        frames = self.session.frames
+        if self.position >= len(frames):
+            raise ReplayError('Frame %d was not recorded' % (self.position,))
+        frame = frames[self.position]
+        if self.strict and _bytes(bytes) != frame.tx:
+            raise ReplayError('Frame %d differs from the recording: sent %s, recorded %s'
+                              % (self.position, _bytes(bytes).hex(), frame.tx.hex()))
+        self.position += 1
+        if self.timing and frame.duration > 0:
+            self.sleep(frame.duration)
+        return frame.rx
+
+    def randomBytes(self, size):
+        """Returns the next recorded challenge, so the authentication computes the recorded session key"""
+        challenges = self.session.challenges
+        if self._challenge >= len(challenges) or len(challenges[self._challenge]) != size:
+            raise ReplayError('Challenge %d of %d bytes was not recorded' % (self._challenge, size))
+        challenge = challenges[self._challenge]
+        self._challenge += 1
+        return challenge
+
+    @property
+    def finished(self):
+        """True when all recorded frames were sent"""
+        return self.position == len(self.session.frames)
+
+    def rewind(self):
+        """Starts over, e.g. to replay the session again in a benchmark loop"""
+        self.position = 0
+        self._challenge = 0
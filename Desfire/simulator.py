@@ -0,0 +1,806 @@
+"""In-memory DESFire EV1 card simulator.
+
+The simulator implements the PICC side of the protocol spoken by
+:py:class:`Desfire.DESFire.DESFire` so the library can be exercised,
+benchmarked and profiled without a reader attached.
+"""
+
+import os
+import random
+
+from Crypto.Cipher import DES, DES3, AES
+from Crypto.Util.strxor import strxor
+
+from .device import Device
+from .DESFire_DEF import DESFireCommand, DESFire_STATUS, DESFireKeyType, DESFireKeySettings, DESFireFileType
+from .frames import FSC_TABLE
+from .util import CRC32, shift_bytes
+
+
+ST_OK          = DESFire_STATUS.ST_Success.value
+ST_MORE        = DESFire_STATUS.ST_MoreFrames.value
+ST_ILLEGAL     = DESFire_STATUS.ST_IllegalCommand.value
+ST_INTEGRITY   = DESFire_STATUS.ST_IntegrityError.value
+ST_NO_KEY      = DESFire_STATUS.ST_KeyDoesNotExist.value
+ST_LENGTH      = DESFire_STATUS.ST_WrongCommandLen.value
+ST_PERMISSION  = DESFire_STATUS.ST_PermissionDenied.value
+ST_PARAMETER   = DESFire_STATUS.ST_IncorrectParam.value
+ST_NO_APP      = DESFire_STATUS.ST_AppNotFound.value
+ST_AUTH        = DESFire_STATUS.ST_AuthentError.value
+ST_BOUNDARY    = DESFire_STATUS.ST_LimitExceeded.value
+ST_COUNT       = DESFire_STATUS.ST_CountError.value
+ST_DUPLICATE   = DESFire_STATUS.ST_DuplicateAidFiles.value
+ST_NO_FILE     = DESFire_STATUS.ST_FileNotFound.value
+ST_MEMORY      = DESFire_STATUS.ST_OutOfMemory.value
+
+KEY_2K3DES = DESFireKeyType.DF_KEY_2K3DES.value
+KEY_3K3DES = DESFireKeyType.DF_KEY_3K3DES.value
+KEY_AES    = DESFireKeyType.DF_KEY_AES.value
+
+KEY_LENGTH = {KEY_2K3DES: 16, KEY_3K3DES: 24, KEY_AES: 16}
+
+ISO_CLA = 0x90
+ISO_SW1 = 0x91
+SW_WRONG_LENGTH = 0x6700
+SW_WRONG_P1P2   = 0x6A86
+
+ACCESS_FREE  = 0x0E
+ACCESS_NEVER = 0x0F
+
+MAX_APPLICATIONS = 28
+MAX_KEYS = 14
+MAX_FILES = 32
+
+DEFAULT_HARDWARE = bytes([0x04, 0x01, 0x01, 0x01, 0x00, 0x1A, 0x05])
+DEFAULT_SOFTWARE = bytes([0x04, 0x01, 0x01, 0x01, 0x04, 0x1A, 0x05])
+
+
+class SimulatorError(Exception):
+    """A command could not be executed, ``status`` is the DESFire status byte returned to the reader."""
+
+    def __init__(self, status):
+        super(SimulatorError, self).__init__(DESFire_STATUS(status).name)
+        self.status = status
+
+
+def cipher_for(keyType, key):
+    """Returns the cipher module and key bytes a PICC would use for ``key``.
+
+    Two and three key 3DES keys whose parts are equal degenerate to single DES, which
+    is how DESFire cards support plain DES keys. Parity bits are ignored in the comparison.
+    """
+    key = bytes(key)
+    if keyType == KEY_AES:
+        return AES, key
+    parts = [bytes(b & 0xFE for b in key[i:i+8]) for i in range(0, len(key), 8)]
+    if keyType == KEY_2K3DES:
+        if len(parts) == 1 or parts[0] == parts[1]:
+            return DES, key[:8]
+        return DES3, key[:16]
+    if parts[0] == parts[1]:
+        return DES, key[16:24]
+    if parts[1] == parts[2]:
+        return DES, key[:8]
+    return DES3, key
+
+
+class SimulatorSession(object):
+    """Authenticated session of the simulated PICC: session key, running IV and CMAC subkeys."""
+
+    def __init__(self, keyNo, ciphermod, key):
+        self.keyNo = keyNo
+        self.ciphermod = ciphermod
+        self.key = key
+        self.blockSize = ciphermod.block_size
+        self.IV = bytes(self.blockSize)
+
+        const_Rb = 0x87 if self.blockSize == 16 else 0x1B
+        l = ciphermod.new(key, ciphermod.MODE_ECB).encrypt(bytes(self.blockSize))
+        self.k1 = shift_bytes(l, const_Rb if l[0] & 0x80 else 0)
+        self.k2 = shift_bytes(self.k1, const_Rb if self.k1[0] & 0x80 else 0)
+
+    def encrypt(self, data):
+        out = self.ciphermod.new(self.key, self.ciphermod.MODE_CBC, self.IV).encrypt(data)
+        self.IV = out[-self.blockSize:]
+        return out
+
+    def decrypt(self, data):
+        out = self.ciphermod.new(self.key, self.ciphermod.MODE_CBC, self.IV).decrypt(data)
+        self.IV = bytes(data[-self.blockSize:])
+        return out
+
+    def cmac(self, data):
+        """Calculates the CMAC of ``data`` chained on the session IV and returns it."""
+        bs = self.blockSize
+        rest = len(data) % bs
+        if rest or not data:
+            data = bytes(data) + b'\x80' + bytes(bs - rest - 1)
+            subkey = self.k2
+        else:
+            data = bytes(data)
+            subkey = self.k1
+        return self.encrypt(data[:-bs] + strxor(data[-bs:], subkey))[-bs:]
+
+
+class SimulatedApplication(object):
+    """Application (or the PICC master application, AID 000000) on the simulated card."""
+
+    def __init__(self, aid, keySettings, keyCount, keyType):
+        self.aid = aid
+        self.keySettings = keySettings
+        self.keyCount = keyCount
+        self.keyType = keyType
+        self.keys = [bytes(KEY_LENGTH[keyType])] * keyCount
+        self.keyVersions = [0] * keyCount
+        self.files = {}
+
+
+class SimulatedFile(object):
+    """Data or value file. ``pending`` holds uncommitted changes of backup and value files."""
+
+    def __init__(self, fileType, comm, access):
+        self.fileType = fileType
+        self.comm = comm
+        self.access = access
+        self.data = None
+        self.size = 0
+        self.value = 0
+        self.lowerLimit = 0
+        self.upperLimit = 0
+        self.limitedCreditValue = 0
+        self.limitedCreditEnabled = 0
+        self.pending = None
+
+    @property
+    def readKey(self):
+        return self.access[1] >> 4
+
+    @property
+    def writeKey(self):
+        return self.access[1] & 0x0F
+
+    @property
+    def readWriteKey(self):
+        return self.access[0] >> 4
+
+    @property
+    def changeKey(self):
+        return self.access[0] & 0x0F
+
+    @property
+    def isBackup(self):
+        return self.fileType != DESFireFileType.MDFT_STANDARD_DATA_FILE.value
+
+    def settings(self):
+        ret = bytes([self.fileType, self.comm]) + self.access
+        if self.fileType == DESFireFileType.MDFT_VALUE_FILE_WITH_BACKUP.value:
+            ret += self.lowerLimit.to_bytes(4, 'little', signed=True)
+            ret += self.upperLimit.to_bytes(4, 'little', signed=True)
+            ret += self.limitedCreditValue.to_bytes(4, 'little', signed=True)
+            ret += bytes([self.limitedCreditEnabled])
+        else:
+            ret += self.size.to_bytes(3, 'little')
+        return ret
+
+
+class DESFireSimulator(Device):
+    """Stateful in-memory DESFire EV1 card implementing the :py:class:`Desfire.device.Device` interface.
+
+    Supported are ISO (DES, 2K3DES, 3K3DES) and AES authentication, the session CMAC
+    of EV1, applications, standard, backup and value files with transactions, key and
+    key settings changes and 0xAF framing in both directions. File data is always
+    transferred in plain communication mode (with CMAC when authenticated).
+    Native frames and ISO 7816-4 wrapped APDUs (short and extended length) are accepted.
+
+    Args:
+        frameSize (int)     : Maximum length of a native frame, command byte / status byte included
+        masterKeyType (int) : Key type of the PICC master key (DESFireKeyType value)
+        masterKey (bytes)   : PICC master key, all zero by default
+        uid (bytes)         : 7 byte UID, random by default
+        seed (int)          : Seed for RndB generation, makes sessions reproducible
+        capacity (int)      : EEPROM size in bytes available for files
+    """
+
+    def __init__(self, frameSize=60, masterKeyType=KEY_2K3DES, masterKey=None, uid=None, seed=None, capacity=8192):
+        if isinstance(masterKeyType, DESFireKeyType):
+            masterKeyType = masterKeyType.value
+        self.frameSize = frameSize
+        self.capacity = capacity
+        self._random = random.Random(seed) if seed is not None else None
+        self.uid = bytes(uid) if uid is not None else self._randomBytes(7)
+        self.batchNo = bytes(5)
+        self.cwProd = 0x12
+        self.yearProd = 0x21
+
+        self.picc = SimulatedApplication(0, DESFireKeySettings.KS_FACTORY_DEFAULT.value, 1, masterKeyType)
+        if masterKey is not None:
+            self.picc.keys[0] = bytes(masterKey)
+        if self.picc.keyType == KEY_2K3DES and len(self.picc.keys[0]) == 8:
+            self.picc.keys[0] *= 2
+        self.applications = {}
+        self.selected = None
+        self.reset()
+
+    @property
+    def ats(self):
+        """ATS of a DESFire EV1 (TA, TB, TC with CID support) with the largest FSCI whose frames fit ``frameSize``"""
+        fsci = 0
+        while fsci < len(FSC_TABLE) - 1 and FSC_TABLE[fsci + 1] - 4 <= self.frameSize:
+            fsci += 1
+        return bytes([0x06, 0x70 | fsci, 0x77, 0x81, 0x02, 0x80])
+
+    def reset(self):
+        """Simulates removing the card from the field: drops session, selection, chaining and uncommitted transactions."""
+        if self.selected is not None:
+            self._abortTransaction()
+        self.selected = self.picc
+        self.session = None
+        self._authState = None
+        self._pendingOut = None
+        self._pendingIn = None
+
+    def _randomBytes(self, n):
+        if self._random is None:
+            return os.urandom(n)
+        return self._random.getrandbits(8 * n).to_bytes(n, 'big')
+
+    ###### Framing
+
+    def transceive(self, apdu):
+        apdu = bytes(apdu)
+        if len(apdu) >= 5 and apdu[0] == ISO_CLA:
+            native = self._unwrap(apdu)
+            if isinstance(native, int):
+                return native.to_bytes(2, 'big')
+            resp = self._transceiveNative(native)
+            return resp[1:] + bytes([ISO_SW1, resp[0]])
+        return self._transceiveNative(apdu)
+
+    def _unwrap(self, apdu):
+        """Returns the native frame of an ISO 7816-4 wrapped APDU (short or extended length) or an ISO status word"""
+        if apdu[2] or apdu[3]:
+            return SW_WRONG_P1P2
+        if len(apdu) == 5:
+            data = b''
+        elif apdu[4]:
+            lc = apdu[4]
+            if len(apdu) not in (5 + lc, 6 + lc):
+                return SW_WRONG_LENGTH
+            data = apdu[5:5+lc]
+        elif len(apdu) == 7:
+            data = b''
+        else:
+            lc = int.from_bytes(apdu[5:7], 'big')
+            if len(apdu) not in (7 + lc, 9 + lc):
+                return SW_WRONG_LENGTH
+            data = apdu[7:7+lc]
+        return bytes([apdu[1]]) + data
+
+    def _transceiveNative(self, apdu):
+        if not apdu:
+            return bytes([ST_LENGTH])
+        if len(apdu) > self.frameSize:
+            return self._error(ST_LENGTH)
+
+        cmd = apdu[0]
+        if cmd == DESFireCommand.DF_INS_ADDITIONAL_FRAME.value:
+            return self._additionalFrame(apdu)
+
+        self._authState = None
+        self._pendingOut = None
+        self._pendingIn = None
+
+        handler = self._handlers.get(cmd)
+        if handler is None:
+            return self._error(ST_ILLEGAL)
+        if cmd in self._chainedIn:
+            expected = self._chainedIn[cmd](self, apdu)
+            if expected is not None and len(apdu) < expected:
+                self._pendingIn = (cmd, bytearray(apdu), expected)
+                return bytes([ST_MORE])
+        return self._execute(cmd, apdu, handler)
+
+    def _additionalFrame(self, apdu):
+        if self._authState is not None:
+            return self._execute(apdu[0], apdu, DESFireSimulator._authenticateFinish)
+        if self._pendingOut:
+            frame = self._pendingOut.pop(0)
+            if not self._pendingOut:
+                self._pendingOut = None
+            return frame
+        if self._pendingIn is not None:
+            cmd, buffer, expected = self._pendingIn
+            buffer += apdu[1:]
+            if len(buffer) < expected:
+                return bytes([ST_MORE])
+            self._pendingIn = None
+            return self._execute(cmd, bytes(buffer), self._handlers[cmd])
+        return self._error(ST_ILLEGAL)
+
+    def _execute(self, cmd, apdu, handler):
+        session = self.session
+        if session is not None and cmd not in self._noTxCmac:
+            session.cmac(apdu)
+        try:
+            data = handler(self, apdu[1:])
+        except SimulatorError as e:
+            return self._error(e.status)
+        if self._authState is not None:
+            return bytes([ST_MORE]) + data
+        if data is None:
+            data = b''
+        if self.session is not None and session is self.session and cmd not in self._noRxCmac:
+            data += self.session.cmac(data + b'\x00')[:8]
+        return self._frame(cmd, data)
+
+    def _frame(self, cmd, data):
+        maxData = self.frameSize - 1
+        splits = self._fixedFrames.get(cmd)
+        if splits is None:
+            if len(data) <= maxData:
+                return bytes([ST_OK]) + data
+            splits = range(maxData, len(data), maxData)
+        frames = []
+        start = 0
+        for end in splits:
+            frames.append(bytes([ST_MORE]) + data[start:end])
+            start = end
+        self._pendingOut = frames[1:] + [bytes([ST_OK]) + data[start:]]
+        return frames[0]
+
+    def _error(self, status):
+        self.session = None
+        self._authState = None
+        self._pendingOut = None
+        self._pendingIn = None
+        return bytes([status])
+
+    ###### Helpers
+
+    def _requireApplication(self):
+        if self.selected is self.picc:
+            raise SimulatorError(ST_PERMISSION)
+        return self.selected
+
+    def _requireMasterKey(self, settingBit=None):
+        """Raises unless authenticated with key 0 of the selected application or ``settingBit`` grants free access."""
+        if settingBit is not None and self.selected.keySettings & settingBit:
+            return
+        if self.session is None or self.session.keyNo != 0:
+            raise SimulatorError(ST_AUTH)
+
+    def _requireAccess(self, *keys):
+        if ACCESS_FREE in keys:
+            return
+        if self.session is not None and self.session.keyNo in keys:
+            return
+        if all(key == ACCESS_NEVER for key in keys):
+            raise SimulatorError(ST_PERMISSION)
+        raise SimulatorError(ST_AUTH)
+
+    def _getFile(self, params, fileType=None):
+        app = self._requireApplication()
+        if not params:
+            raise SimulatorError(ST_LENGTH)
+        f = app.files.get(params[0])
+        if f is None:
+            raise SimulatorError(ST_NO_FILE)
+        if fileType is not None and (f.fileType == DESFireFileType.MDFT_VALUE_FILE_WITH_BACKUP.value) != fileType:
+            raise SimulatorError(ST_PARAMETER)
+        return f
+
+    def _usedMemory(self):
+        used = 0
+        for app in self.applications.values():
+            for f in app.files.values():
+                used += (max(f.size, 4) + 31) & ~31
+        return used
+
+    def _abortTransaction(self):
+        for f in self.selected.files.values():
+            f.pending = None
+
+    def _decryptCryptogram(self, data):
+        if len(data) == 0 or len(data) % self.session.blockSize:
+            raise SimulatorError(ST_LENGTH)
+        return self.session.decrypt(data)
+
+    ###### Authentication
+
+    def _authenticate(self, params, aes):
+        if len(params) != 1:
+            raise SimulatorError(ST_LENGTH)
+        app = self.selected
+        keyNo = params[0]
+        self.session = None
+        if keyNo >= app.keyCount:
+            raise SimulatorError(ST_NO_KEY)
+        if (app.keyType == KEY_AES) != aes:
+            raise SimulatorError(ST_AUTH)
+        ciphermod, key = cipher_for(app.keyType, app.keys[keyNo])
+        RndB = self._randomBytes(8 if app.keyType == KEY_2K3DES else 16)
+        RndB_enc = ciphermod.new(key, ciphermod.MODE_CBC, bytes(ciphermod.block_size)).encrypt(RndB)
+        self._authState = (keyNo, ciphermod, key, RndB, RndB_enc[-ciphermod.block_size:])
+        return RndB_enc
+
+    def _authenticateISO(self, params):
+        return self._authenticate(params, False)
+
+    def _authenticateAES(self, params):
+        return self._authenticate(params, True)
+
+    def _authenticateFinish(self, params):
+        keyNo, ciphermod, key, RndB, IV = self._authState
+        self._authState = None
+        if len(params) != 2 * len(RndB):
+            raise SimulatorError(ST_LENGTH)
+        RndAB = ciphermod.new(key, ciphermod.MODE_CBC, IV).decrypt(params)
+        RndA = RndAB[:len(RndB)]
+        if RndAB[len(RndB):] != RndB[1:] + RndB[:1]:
+            raise SimulatorError(ST_AUTH)
+        ret = ciphermod.new(key, ciphermod.MODE_CBC, params[-ciphermod.block_size:]).encrypt(RndA[1:] + RndA[:1])
+
+        keyType = self.selected.keyType
+        sessionKey = RndA[:4] + RndB[:4]
+        if keyType == KEY_2K3DES:
+            if ciphermod is DES3:
+                sessionKey += RndA[4:8] + RndB[4:8]
+        elif keyType == KEY_3K3DES:
+            sessionKey += RndA[6:10] + RndB[6:10] + RndA[12:16] + RndB[12:16]
+        else:
+            sessionKey += RndA[12:16] + RndB[12:16]
+        if keyType == KEY_AES:
+            sessionmod = AES
+        else:
+            sessionKey = bytes(b & 0xFE for b in sessionKey)
+            sessionmod = DES if len(sessionKey) == 8 else DES3
+        self.session = SimulatorSession(keyNo, sessionmod, sessionKey)
+        return ret
+
+    ###### PICC and application commands
+
+    def _getVersion(self, params):
+        return (DEFAULT_HARDWARE + DEFAULT_SOFTWARE + self.uid + self.batchNo
+                + bytes([self.cwProd, self.yearProd]))
+
+    def _freeMemory(self, params):
+        return max(self.capacity - self._usedMemory(), 0).to_bytes(3, 'little')
+
+    def _getKeySettings(self, params):
+        self._requireMasterKey(DESFireKeySettings.KS_LISTING_WITHOUT_MK.value)
+        app = self.selected
+        return bytes([app.keySettings, app.keyCount | app.keyType])
+
+    def _getKeyVersion(self, params):
+        if len(params) != 1:
+            raise SimulatorError(ST_LENGTH)
+        if params[0] >= self.selected.keyCount:
+            raise SimulatorError(ST_NO_KEY)
+        return bytes([self.selected.keyVersions[params[0]]])
+
+    def _changeKeySettings(self, params):
+        if self.session is None or self.session.keyNo != 0:
+            raise SimulatorError(ST_AUTH)
+        app = self.selected
+        plain = self._decryptCryptogram(params)
+        if CRC32([DESFireCommand.DF_INS_CHANGE_KEY_SETTINGS.value, plain[0]]) != int.from_bytes(plain[1:5], 'little'):
+            raise SimulatorError(ST_INTEGRITY)
+        if not app.keySettings & DESFireKeySettings.KS_CONFIGURATION_CHANGEABLE.value:
+            raise SimulatorError(ST_PERMISSION)
+        app.keySettings = plain[0]
+
+    def _changeKey(self, params):
+        if self.session is None:
+            raise SimulatorError(ST_AUTH)
+        if len(params) < 2:
+            raise SimulatorError(ST_LENGTH)
+        app = self.selected
+        keyNo = params[0] & 0x0F
+        keyType = app.keyType
+        if app is self.picc:
+            keyType = params[0] & 0xC0
+            if keyType not in KEY_LENGTH:
+                raise SimulatorError(ST_PARAMETER)
+        if keyNo >= app.keyCount:
+            raise SimulatorError(ST_NO_KEY)
+
+        changeAccess = app.keySettings >> 4
+        authKey = self.session.keyNo
+        if keyNo == 0 or app is self.picc:
+            allowed = authKey == 0 and app.keySettings & DESFireKeySettings.KS_ALLOW_CHANGE_MK.value
+        elif changeAccess == 0x0F:
+            allowed = False
+        elif changeAccess == 0x0E:
+            allowed = authKey in (0, keyNo)
+        else:
+            allowed = authKey in (0, changeAccess)
+        if not allowed:
+            raise SimulatorError(ST_PERMISSION)
+
+        keyLength = KEY_LENGTH[keyType]
+        plain = self._decryptCryptogram(params[1:])
+        end = keyLength + (1 if keyType == KEY_AES else 0)
+        if len(plain) < end + 4:
+            raise SimulatorError(ST_LENGTH)
+        keyData = plain[:keyLength]
+        version = plain[keyLength] if keyType == KEY_AES else 0
+        if CRC32(bytes([DESFireCommand.DF_INS_CHANGE_KEY.value, params[0]]) + plain[:end]) != int.from_bytes(plain[end:end+4], 'little'):
+            raise SimulatorError(ST_INTEGRITY)
+
+        isSameKey = keyNo == authKey
+        if not isSameKey:
+            if len(plain) < end + 8:
+                raise SimulatorError(ST_LENGTH)
+            keyData = strxor(keyData, app.keys[keyNo][:keyLength].ljust(keyLength, b'\x00'))
+            if CRC32(keyData) != int.from_bytes(plain[end+4:end+8], 'little'):
+                raise SimulatorError(ST_INTEGRITY)
+
+        if app is self.picc:
+            app.keyType = keyType
+        app.keys[keyNo] = bytes(keyData)
+        app.keyVersions[keyNo] = version
+        if isSameKey:
+            self.session = None
+
+    def _getApplicationIDs(self, params):
+        if self.selected is not self.picc:
+            raise SimulatorError(ST_PERMISSION)
+        self._requireMasterKey(DESFireKeySettings.KS_LISTING_WITHOUT_MK.value)
+        return b''.join(aid.to_bytes(3, 'little') for aid in self.applications)
+
+    def _selectApplication(self, params):
+        if len(params) != 3:
+            raise SimulatorError(ST_LENGTH)
+        aid = int.from_bytes(params, 'little')
+        app = self.picc if aid == 0 else self.applications.get(aid)
+        if app is None:
+            raise SimulatorError(ST_NO_APP)
+        self._abortTransaction()
+        self.session = None
+        self.selected = app
+
+    def _createApplication(self, params):
+        if len(params) != 5:
+            raise SimulatorError(ST_LENGTH)
+        if self.selected is not self.picc:
+            raise SimulatorError(ST_PERMISSION)
+        self._requireMasterKey(DESFireKeySettings.KS_CREATE_DELETE_WITHOUT_MK.value)
+        aid = int.from_bytes(params[0:3], 'little')
+        keyCount = params[4] & 0x0F
+        keyType = params[4] & 0xC0
+        if aid == 0 or keyCount == 0 or keyCount > MAX_KEYS or keyType not in KEY_LENGTH:
+            raise SimulatorError(ST_PARAMETER)
+        if aid in self.applications:
+            raise SimulatorError(ST_DUPLICATE)
+        if len(self.applications) >= MAX_APPLICATIONS:
+            raise SimulatorError(ST_COUNT)
+        self.applications[aid] = SimulatedApplication(aid, params[3], keyCount, keyType)
+
+    def _deleteApplication(self, params):
+        if len(params) != 3:
+            raise SimulatorError(ST_LENGTH)
+        aid = int.from_bytes(params, 'little')
+        app = self.applications.get(aid)
+        if app is None:
+            raise SimulatorError(ST_NO_APP)
+        if self.session is None or self.session.keyNo != 0 or self.selected not in (self.picc, app):
+            raise SimulatorError(ST_AUTH)
+        del self.applications[aid]
+        if self.selected is app:
+            self.selected = self.picc
+
+    def _formatPICC(self, params):
+        if self.selected is not self.picc:
+            raise SimulatorError(ST_PERMISSION)
+        self._requireMasterKey()
+        self.applications.clear()
+
+    ###### File commands
+
+    def _getFileIDs(self, params):
+        app = self._requireApplication()
+        self._requireMasterKey(DESFireKeySettings.KS_LISTING_WITHOUT_MK.value)
+        return bytes(sorted(app.files))
+
+    def _getFileSettings(self, params):
+        self._requireMasterKey(DESFireKeySettings.KS_LISTING_WITHOUT_MK.value)
+        return self._getFile(params).settings()
+
+    def _createFile(self, params, fileType, length):
+        app = self._requireApplication()
+        self._requireMasterKey(DESFireKeySettings.KS_CREATE_DELETE_WITHOUT_MK.value)
+        if len(params) != length:
+            raise SimulatorError(ST_LENGTH)
+        if params[0] >= MAX_FILES or params[1] not in (0x00, 0x01, 0x03):
+            raise SimulatorError(ST_PARAMETER)
+        if params[0] in app.files:
+            raise SimulatorError(ST_DUPLICATE)
+        f = SimulatedFile(fileType.value, params[1], bytes(params[2:4]))
+        return app, f
+
+    def _createDataFile(self, params, fileType):
+        app, f = self._createFile(params, fileType, 7)
+        f.size = int.from_bytes(params[4:7], 'little')
+        if f.size == 0:
+            raise SimulatorError(ST_PARAMETER)
+        if self._usedMemory() + ((f.size + 31) & ~31) > self.capacity:
+            raise SimulatorError(ST_MEMORY)
+        f.data = bytearray(f.size)
+        app.files[params[0]] = f
+
+    def _createStdDataFile(self, params):
+        return self._createDataFile(params, DESFireFileType.MDFT_STANDARD_DATA_FILE)
+
+    def _createBackupDataFile(self, params):
+        return self._createDataFile(params, DESFireFileType.MDFT_BACKUP_DATA_FILE)
+
+    def _createValueFile(self, params):
+        app, f = self._createFile(params, DESFireFileType.MDFT_VALUE_FILE_WITH_BACKUP, 17)
+        f.lowerLimit = int.from_bytes(params[4:8], 'little', signed=True)
+        f.upperLimit = int.from_bytes(params[8:12], 'little', signed=True)
+        f.value = int.from_bytes(params[12:16], 'little', signed=True)
+        f.limitedCreditEnabled = params[16]
+        if not f.lowerLimit <= f.value <= f.upperLimit:
+            raise SimulatorError(ST_BOUNDARY)
+        if self._usedMemory() + 32 > self.capacity:
+            raise SimulatorError(ST_MEMORY)
+        app.files[params[0]] = f
+
+    def _deleteFile(self, params):
+        app = self._requireApplication()
+        self._requireMasterKey(DESFireKeySettings.KS_CREATE_DELETE_WITHOUT_MK.value)
+        if len(params) != 1:
+            raise SimulatorError(ST_LENGTH)
+        if app.files.pop(params[0], None) is None:
+            raise SimulatorError(ST_NO_FILE)
+
+    def _fileRange(self, f, params):
+        if len(params) < 7:
+            raise SimulatorError(ST_LENGTH)
+        offset = int.from_bytes(params[1:4], 'little')
+        length = int.from_bytes(params[4:7], 'little')
+        if offset >= f.size or offset + length > f.size:
+            raise SimulatorError(ST_BOUNDARY)
+        return offset, length
+
+    def _readData(self, params):
+        f = self._getFile(params, False)
+        self._requireAccess(f.readKey, f.readWriteKey)
+        if len(params) != 7:
+            raise SimulatorError(ST_LENGTH)
+        offset, length = self._fileRange(f, params)
+        if length == 0:
+            length = f.size - offset
+        return bytes(f.data[offset:offset+length])
+
+    def _writeDataLength(self, apdu):
+        if len(apdu) < 8:
+            return None
+        return 8 + int.from_bytes(apdu[5:8], 'little')
+
+    def _writeData(self, params):
+        f = self._getFile(params, False)
+        self._requireAccess(f.writeKey, f.readWriteKey)
+        offset, length = self._fileRange(f, params)
+        if length == 0 or len(params) != 7 + length:
+            raise SimulatorError(ST_LENGTH)
+        if f.isBackup:
+            if f.pending is None:
+                f.pending = bytearray(f.data)
+            f.pending[offset:offset+length] = params[7:]
+        else:
+            f.data[offset:offset+length] = params[7:]
+
+    ###### Value file and transaction commands
+
+    def _currentValue(self, f):
+        return f.value if f.pending is None else f.pending
+
+    def _amount(self, params):
+        if len(params) != 5:
+            raise SimulatorError(ST_LENGTH)
+        amount = int.from_bytes(params[1:5], 'little', signed=True)
+        if amount < 0:
+            raise SimulatorError(ST_PARAMETER)
+        return amount
+
+    def _getValue(self, params):
+        f = self._getFile(params, True)
+        self._requireAccess(f.readKey, f.writeKey, f.readWriteKey)
+        return f.value.to_bytes(4, 'little', signed=True)
+
+    def _credit(self, params):
+        f = self._getFile(params, True)
+        self._requireAccess(f.readWriteKey)
+        value = self._currentValue(f) + self._amount(params)
+        if value > f.upperLimit:
+            raise SimulatorError(ST_BOUNDARY)
+        f.pending = value
+
+    def _limitedCredit(self, params):
+        f = self._getFile(params, True)
+        self._requireAccess(f.writeKey, f.readWriteKey)
+        if not f.limitedCreditEnabled:
+            raise SimulatorError(ST_PERMISSION)
+        value = self._currentValue(f) + self._amount(params)
+        if value > f.upperLimit:
+            raise SimulatorError(ST_BOUNDARY)
+        f.pending = value
+
+    def _debit(self, params):
+        f = self._getFile(params, True)
+        self._requireAccess(f.readKey, f.writeKey, f.readWriteKey)
+        value = self._currentValue(f) - self._amount(params)
+        if value < f.lowerLimit:
+            raise SimulatorError(ST_BOUNDARY)
+        f.pending = value
+
+    def _commitTransaction(self, params):
+        for f in self.selected.files.values():
+            if f.pending is None:
+                continue
+            if f.fileType == DESFireFileType.MDFT_VALUE_FILE_WITH_BACKUP.value:
+                f.value = f.pending
+            else:
+                f.data = f.pending
+            f.pending = None
+
+    def _abortTransactionCommand(self, params):
+        self._abortTransaction()
+
+    _handlers = {
+        DESFireCommand.DFEV1_INS_AUTHENTICATE_ISO.value:   _authenticateISO,
+        DESFireCommand.DFEV1_INS_AUTHENTICATE_AES.value:   _authenticateAES,
+        DESFireCommand.DF_INS_GET_VERSION.value:           _getVersion,
+        DESFireCommand.DFEV1_INS_FREE_MEM.value:           _freeMemory,
+        DESFireCommand.DF_INS_GET_KEY_SETTINGS.value:      _getKeySettings,
+        DESFireCommand.DF_INS_GET_KEY_VERSION.value:       _getKeyVersion,
+        DESFireCommand.DF_INS_CHANGE_KEY_SETTINGS.value:   _changeKeySettings,
+        DESFireCommand.DF_INS_CHANGE_KEY.value:            _changeKey,
+        DESFireCommand.DF_INS_GET_APPLICATION_IDS.value:   _getApplicationIDs,
+        DESFireCommand.DF_INS_SELECT_APPLICATION.value:    _selectApplication,
+        DESFireCommand.DF_INS_CREATE_APPLICATION.value:    _createApplication,
+        DESFireCommand.DF_INS_DELETE_APPLICATION.value:    _deleteApplication,
+        DESFireCommand.DF_INS_FORMAT_PICC.value:           _formatPICC,
+        DESFireCommand.DF_INS_GET_FILE_IDS.value:          _getFileIDs,
+        DESFireCommand.DF_INS_GET_FILE_SETTINGS.value:     _getFileSettings,
+        DESFireCommand.DF_INS_CREATE_STD_DATA_FILE.value:  _createStdDataFile,
+        DESFireCommand.DF_INS_CREATE_BACKUP_DATA_FILE.value: _createBackupDataFile,
+        DESFireCommand.DF_INS_CREATE_VALUE_FILE.value:     _createValueFile,
+        DESFireCommand.DF_INS_DELETE_FILE.value:           _deleteFile,
+        DESFireCommand.DF_INS_READ_DATA.value:             _readData,
+        DESFireCommand.DF_INS_WRITE_DATA.value:            _writeData,
+        DESFireCommand.DF_INS_GET_VALUE.value:             _getValue,
+        DESFireCommand.DF_INS_CREDIT.value:                _credit,
+        DESFireCommand.DF_INS_LIMITED_CREDIT.value:        _limitedCredit,
+        DESFireCommand.DF_INS_DEBIT.value:                 _debit,
+        DESFireCommand.DF_COMMIT_TRANSACTION.value:        _commitTransaction,
+        DESFireCommand.DF_INS_ABORT_TRANSACTION.value:     _abortTransactionCommand,
+    }
+
+    # Commands whose data may be sent in several frames: returns the total command length
+    _chainedIn = {
+        DESFireCommand.DF_INS_WRITE_DATA.value: _writeDataLength,
+    }
+
+    # Commands that are not covered by the command CMAC (they are encrypted or (re)start a session)
+    _noTxCmac = frozenset([
+        DESFireCommand.DFEV1_INS_AUTHENTICATE_ISO.value,
+        DESFireCommand.DFEV1_INS_AUTHENTICATE_AES.value,
+        DESFireCommand.DF_INS_ADDITIONAL_FRAME.value,
+        DESFireCommand.DF_INS_SELECT_APPLICATION.value,
+        DESFireCommand.DF_INS_CHANGE_KEY_SETTINGS.value,
+        DESFireCommand.DF_INS_CHANGE_KEY.value,
+    ])
+
+    _noRxCmac = frozenset([
+        DESFireCommand.DFEV1_INS_AUTHENTICATE_ISO.value,
+        DESFireCommand.DFEV1_INS_AUTHENTICATE_AES.value,
+        DESFireCommand.DF_INS_ADDITIONAL_FRAME.value,
+        DESFireCommand.DF_INS_SELECT_APPLICATION.value,
+    ])
+
+    # GetVersion answers in three frames independent of the frame size
+    _fixedFrames = {
+        DESFireCommand.DF_INS_GET_VERSION.value: (7, 14),
+    }
@@ -0,0 +1,79 @@
+"""Structured APDU trace tap.
+
+Records every frame exchanged with the card into a bounded ring buffer without any formatting,
+so traffic can be inspected in production::
+
+    desfire.trace = APDUTrace(256)
+    ...
+    for record in desfire.trace:
+        print(record)
+"""
+
+from collections import deque, namedtuple
+
+from .util import byte_array_to_human_readable_hex
+
+
+class TraceRecord(namedtuple('TraceRecord', 'timestamp command tx rx status duration')):
+    """One frame exchange.
+
+    :param timestamp: ``time.time()`` when the frame was sent
+    :param command: Instruction byte of the sent frame (0xAF for additional frames), INS of wrapped APDUs
+    :param tx: Sent bytes
+    :param rx: Received bytes
+    :param status: DESFire status byte of the response (None if the response was empty)
+    :param duration: Seconds spent in ``Device.transceive``
+    """
+
+    __slots__ = ()
+
+    def __str__(self):
+        return '%.6f %02X %8.3f ms  TX: %s RX: %s' % (self.timestamp, self.command, self.duration * 1e3,
+                                                      byte_array_to_human_readable_hex(self.tx),
+                                                      byte_array_to_human_readable_hex(self.rx))
+
+
+class APDUTrace(object):
+    """Bounded ring buffer of :py:class:`TraceRecord`, the oldest records are dropped first."""
+
+    def __init__(self, maxlen=1024):
+        """
+        :param maxlen: Number of records kept
+        """
+        self.records = deque(maxlen=maxlen)
+
+    def record(self, tx, rx, start, duration, status=None, command=None):
+        """Appends a frame exchange.
+
+        :param tx: Sent frame
+        :param rx: Received frame
+        :param start: ``time.time()`` when the frame was sent
+        :param duration: Seconds spent in ``Device.transceive``
+        :param status: Status byte, defaults to the first received byte
+        :param command: Instruction byte, defaults to the first sent byte (pass the INS of wrapped APDUs)
+        """
+        if status is None and rx:
+            status = rx[0]
+        if command is None and tx:
+            command = tx[0]
+        self.records.append(TraceRecord(start, command, bytes(tx), bytes(rx), status, duration))
+
+    def clear(self):
+        self.records.clear()
+
+    @property
+    def maxlen(self):
+        return self.records.maxlen
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(list(self.records))
+
+    def __getitem__(self, index):
+        return self.records[index]
+
+    def toList(self):
+        """Returns the records as list of dicts (bytes as hex strings), e.g. for JSON export"""
+        return [dict(r._asdict(), tx=r.tx.hex(), rx=r.rx.hex()) for r in self.records]
@@ -1,8 +1,9 @@
 """Misc. utility functions."""
 
 
+import re
 import sys
-import crcmod.predefined
+import zlib
 
 if sys.version_info[0] == 2 and sys.version_info[1] == 1:
     from Crypto.Util.py21compat import *
@@ -17,6 +18,20 @@ from Crypto.Util.number import long_to_bytes, bytes_to_long
 def byte_array_to_human_readable_hex(bytes):
     return "".join("%02X " % b for b in bytes)
 
+class LazyHex(object):
+    """Defers :py:func:`byte_array_to_human_readable_hex` until the log record is emitted::
+
+        logger.debug('Sending: %s', LazyHex(apdu))
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return byte_array_to_human_readable_hex(self.data)
+
 def getInt(data,byteorder='big'):
     if isinstance(data,int):
         return data
@@ -38,20 +53,78 @@ def getList(data,byteSize=2,byteorder='big'):
     return data
      
 
-def getBytes(data,byteSize=2):
+def getBytes(data,byteSize=2,byteorder='big'):
     if isinstance(data, str):
         return bytes(bytearray.fromhex(data))
     elif isinstance(data, bytearray):
         return bytes(data)
     elif isinstance(data, int):
-        return data.to_bytes(byteSize, byteorder='big')
+        return data.to_bytes(byteSize, byteorder=byteorder)
+    elif isinstance(data, (list, tuple)):
+        return bytes(data)
     return data
 
 
+class Crc32(object):
+    """Incremental CRC32 as used by DESFire EV1 (JAMCRC: reflected, init 0xFFFFFFFF, no final xor).
+
+    The table driven CRC of zlib is used, its tables are built once when the module is loaded.
+    Data can be fed in chunks of bytes, bytearray, memoryview or lists of ints::
+
+        crc = Crc32(header)
+        crc.update(chunk)
+        cryptogram += crc.digest()
+    """
+
+    __slots__ = ('_crc',)
+
+    def __init__(self, data=None):
+        self._crc = 0
+        if data is not None:
+            self.update(data)
+
+    def update(self, data):
+        if isinstance(data, (list, tuple)):
+            data = bytes(data)
+        self._crc = zlib.crc32(data, self._crc)
+        return self
+
+    @property
+    def value(self):
+        """The CRC as integer"""
+        return self._crc ^ 0xFFFFFFFF
+
+    def digest(self):
+        """The CRC as the 4 little endian bytes appended to DESFire cryptograms"""
+        return self.value.to_bytes(4, byteorder='little')
+
+    def copy(self):
+        other = Crc32()
+        other._crc = self._crc
+        return other
+
+
+_NONZERO = re.compile(b'[^\\x00]+')
+
+def changedRanges(old, new):
+    """Returns the byte ranges where ``new`` differs from ``old`` as list of (start, end) tuples.
+    Bytes of ``new`` beyond the end of ``old`` count as changed, the comparison runs at C speed
+    (xor of both as big integers, the non zero runs are found by a regex).
+    """
+    common = min(len(old), len(new))
+    ranges = []
+    if bytes(old[:common]) != bytes(new[:common]):
+        xor = (int.from_bytes(old[:common], 'little') ^ int.from_bytes(new[:common], 'little')).to_bytes(common, 'little')
+        ranges = [m.span() for m in _NONZERO.finditer(xor)]
+    if len(new) > common:
+        if ranges and ranges[-1][1] == common:
+            ranges[-1] = (ranges[-1][0], len(new))
+        else:
+            ranges.append((common, len(new)))
+    return ranges
+
 def CRC32(data):
-    crc=[0xff,0xff,0xff,0xff]
-    crc32_func = crcmod.predefined.mkCrcFun('jamcrc')
-    return crc32_func(bytes(data))
+    return Crc32(data).value
 
 def shift_bytes(bs, xor_lsb=0):
     num = (bytes_to_long(bs)<<1) ^ xor_lsb
@@ -0,0 +1,8 @@
+"""Reproducible benchmarks for the DESFire command hot paths.
+
+The suite drives :py:class:`Desfire.DESFire.DESFire` against the in-memory
+:py:class:`Desfire.simulator.DESFireSimulator`, so the numbers only contain the
+Python overhead of the library (framing, crypto, conversions) and no RF time.
+
+Run ``python -m benchmarks --help`` for the command line interface.
+"""
@@ -0,0 +1,48 @@
+"""Command line interface: ``python -m benchmarks [--save FILE] [--compare FILE]``."""
+
+import argparse
+import sys
+
+from . import memory, micro, runner, suite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='Benchmark the DESFire command hot paths against the card simulator.')
+    parser.add_argument('-n', '--number', type=int, default=100, help='operations per repeat (default: %(default)s)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='timed repeats (default: %(default)s)')
+    parser.add_argument('-k', '--select', help='only run benchmarks whose name contains this string')
+    parser.add_argument('--micro', action='store_true', help='run the micro benchmarks (CRC32, ...) instead of the card scenarios')
+    parser.add_argument('--memory', action='store_true', help='show the bytes per object of the parsed card structures, mutable against compact')
+    parser.add_argument('--frame-size', type=int, default=60, help='frame size of the simulated card, negotiated from its ATS (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the simulated card (default: %(default)s)')
+    parser.add_argument('--save', metavar='FILE', help='store the results as JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.10, help='relative slowdown reported as regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        for name, mutable, compact in memory.run(select=args.select):
+            print('%-32s %8.0f B mutable %8.0f B compact  x%.1f' % (name, mutable, compact, mutable / compact))
+        return 0
+
+    if args.micro:
+        results = micro.run(number=args.number, repeat=args.repeat, select=args.select)
+    else:
+        results = suite.run(seed=args.seed, number=args.number, repeat=args.repeat, select=args.select, frameSize=args.frame_size)
+    for r in results:
+        print(r)
+
+    if args.save:
+        runner.save(args.save, results, args.seed)
+
+    regressed = False
+    if args.compare:
+        print()
+        for name, before, after, ratio, slower in runner.compare(runner.load(args.compare), results, args.threshold):
+            print('%-32s %10.1f us -> %10.1f us  x%.2f%s' % (name, before * 1e6, after * 1e6, ratio, '  REGRESSION' if slower else ''))
+            regressed = regressed or slower
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
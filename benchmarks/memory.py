@@ -0,0 +1,67 @@
+"""Memory per object of the parsed card structures, mutable classes against :py:mod:`Desfire.compact`."""
+
+import gc
+import tracemalloc
+
+from Desfire.compact import CompactCardVersion, CompactFilePermissions, CompactFileSettings, CompactKey
+from Desfire.DESFire_DEF import DESFireCardVersion, DESFireFilePermissions, DESFireFileSettings, DESFireKey, DESFireKeyType
+
+
+VERSION = bytes.fromhex('04 01 01 01 00 18 05 04 01 01 01 04 18 05 04 5A 3B 12 34 56 78 BA 34 52 61 90 10 19')
+FILE_SETTINGS = bytes.fromhex('00 00 01 00 00 01 00')
+
+
+def mutableVersion():
+    return DESFireCardVersion(list(VERSION))
+
+
+def mutableFileSettings():
+    settings = DESFireFileSettings()
+    settings.parse(FILE_SETTINGS)
+    return settings
+
+
+def mutablePermissions():
+    permissions = DESFireFilePermissions()
+    permissions.unpack(FILE_SETTINGS[2:4])
+    return permissions
+
+
+def mutableKey():
+    key = DESFireKey()
+    key.setKeySettings(2, DESFireKeyType.DF_KEY_AES, 0x0B)
+    key.setKey(bytes(range(16)))
+    return key
+
+
+def cases():
+    """Yields ``(name, mutable factory, compact factory)`` triples."""
+    yield 'CardVersion', mutableVersion, lambda: CompactCardVersion(bytearray(VERSION))
+    yield 'FileSettings', mutableFileSettings, lambda: CompactFileSettings(bytearray(FILE_SETTINGS))
+    yield 'FilePermissions', mutablePermissions, lambda: CompactFilePermissions(bytearray(FILE_SETTINGS[2:4]))
+    key = mutableKey()
+    yield 'Key', mutableKey, lambda: CompactKey.fromKey(key)
+
+
+def bytesPerObject(factory, count=10000):
+    """Returns the memory ``count`` objects made by ``factory`` hold, divided by ``count``"""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        objects = [factory() for _ in range(count)]
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    # the list holding them is no part of the objects
+    return (after - before) / len(objects) - 8
+
+
+def run(count=10000, select=None):
+    """Returns ``(name, mutable bytes, compact bytes)`` per object for every case."""
+    results = []
+    for name, mutable, compact in cases():
+        if select and select not in name:
+            continue
+        results.append((name, bytesPerObject(mutable, count), bytesPerObject(compact, count)))
+    return results
@@ -0,0 +1,97 @@
+"""Micro benchmarks of building blocks that are too small to show up in the card scenarios."""
+
+from Desfire.DESFire_DEF import DESFireFileSettings, DESFireKeySettings, calc_key_settings
+from Desfire.parsers import parseApplicationIDs
+from Desfire.util import Crc32, CRC32
+
+from .runner import measure
+
+
+CRC_SIZES = (8, 32, 256, 4096)
+
+# GetApplicationIDs answers of 1, 8 and 28 (the most a card lists in one frame set) applications
+AID_COUNTS = (1, 8, 28)
+
+FILE_SETTINGS = bytes.fromhex('02 01 12 34 05 00 00 00 F4 01 00 00 0A 00 00 00 01')
+
+
+def legacyCRC32(data):
+    """The CRC32 implementation before the precomputed engine, builds the crcmod table on every call."""
+    import crcmod.predefined
+    crc32_func = crcmod.predefined.mkCrcFun('jamcrc')
+    return crc32_func(bytes(data))
+
+
+def legacyApplicationIDs(raw_data):
+    """The GetApplicationIDs decoding before the bulk parser, one AID per loop iteration."""
+    pointer = 0
+    apps = []
+    while pointer < len(raw_data):
+        appid = [raw_data[pointer+2]] + [raw_data[pointer+1]] + [raw_data[pointer]]
+        apps.append(appid)
+        pointer += 3
+    return apps
+
+
+def legacyCalcKeySettings(mask):
+    """Key settings decoding before the lookup table, one enum lookup per bit."""
+    a = 2147483648
+    result = []
+    while a >> 1:
+        a = a >> 1
+        masked = mask & a
+        if masked:
+            if DESFireKeySettings(masked):
+                result.append(DESFireKeySettings(masked))
+    return result
+
+
+def parseFileSettings(data):
+    settings = DESFireFileSettings()
+    settings.parse(data)
+    return settings
+
+
+def benchmarks():
+    """Yields ``(name, operation)`` pairs."""
+    try:
+        import crcmod.predefined
+    except ImportError:
+        legacy = False
+    else:
+        legacy = True
+
+    for size in CRC_SIZES:
+        data = bytes(i & 0xFF for i in range(size))
+        if legacy:
+            yield 'CRC32[legacy,%d]' % size, lambda data=data: legacyCRC32(data)
+        yield 'CRC32[%d]' % size, lambda data=data: CRC32(data)
+        yield 'CRC32[list,%d]' % size, lambda data=list(data): CRC32(data)
+        yield 'Crc32.update[16 byte chunks,%d]' % size, lambda view=memoryview(data): _chunked(view, 16)
+
+    for count in AID_COUNTS:
+        data = bytearray(i & 0xFF for i in range(3 * count))
+        yield 'getApplicationIDs[legacy,%d]' % count, lambda data=data: legacyApplicationIDs(data)
+        yield 'getApplicationIDs[%d]' % count, lambda data=data: parseApplicationIDs(data)
+
+    yield 'DESFireFileSettings.parse[value]', lambda: parseFileSettings(FILE_SETTINGS)
+
+    yield 'calc_key_settings[legacy]', lambda: legacyCalcKeySettings(0x2B)
+    yield 'calc_key_settings', lambda: calc_key_settings(0x2B)
+
+
+def _chunked(view, n):
+    crc = Crc32()
+    for i in range(0, len(view), n):
+        crc.update(view[i:i+n])
+    return crc.digest()
+
+
+def run(number=1000, repeat=5, select=None):
+    """Runs the micro benchmarks and returns a list of :py:class:`benchmarks.runner.Result`."""
+    results = []
+    for name, op in benchmarks():
+        if select and select not in name:
+            continue
+        results.append(measure(name, op, number, repeat))
+    return results
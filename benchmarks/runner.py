@@ -0,0 +1,139 @@
+"""Measurement, baseline storage and comparison of benchmark results."""
+
+import gc
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+
+class Result:
+    """Timing and allocation figures of one benchmark, all values per operation."""
+
+    def __init__(self, name, iterations, wall, cpu, device, allocBlocks, peakBytes):
+        self.name = name
+        self.iterations = iterations
+        self.wall = wall                # list of seconds per operation, one entry per repeat
+        self.cpu = cpu                  # list of CPU seconds per operation, one entry per repeat
+        self.device = device            # list of seconds per operation spent in the device, one entry per repeat
+        self.allocBlocks = allocBlocks  # net memory blocks allocated per operation
+        self.peakBytes = peakBytes      # peak traced memory of one operation
+
+    @property
+    def wallMedian(self):
+        return statistics.median(self.wall)
+
+    @property
+    def cpuMedian(self):
+        return statistics.median(self.cpu)
+
+    @property
+    def deviceMedian(self):
+        return statistics.median(self.device)
+
+    def toDict(self):
+        temp = {}
+        temp['iterations']  = self.iterations
+        temp['wallMedian']  = self.wallMedian
+        temp['wallMin']     = min(self.wall)
+        temp['wallMax']     = max(self.wall)
+        temp['cpuMedian']   = self.cpuMedian
+        temp['deviceMedian'] = self.deviceMedian
+        temp['allocBlocks'] = self.allocBlocks
+        temp['peakBytes']   = self.peakBytes
+        return temp
+
+    def __repr__(self):
+        return '%-32s %10.1f us wall %10.1f us cpu %10.1f us device %8.1f blocks %9d B peak' % (
+            self.name, self.wallMedian * 1e6, self.cpuMedian * 1e6, self.deviceMedian * 1e6, self.allocBlocks, self.peakBytes)
+
+
+def measure(name, op, number=100, repeat=5, deviceClock=None):
+    """Runs ``op()`` ``number`` times per repeat and returns a :py:class:`Result`.
+
+    ``deviceClock()`` returns the seconds spent so far inside the device (see
+    :py:class:`benchmarks.suite.TimedDevice`), the library overhead is wall minus device time.
+
+    The garbage collector is disabled while timing. ``allocBlocks`` is the net number of
+    memory blocks still allocated after each operation (CPython does not count total
+    allocations), ``peakBytes`` the tracemalloc peak of a single operation. The peak is
+    measured in a separate pass as tracemalloc slows down every allocation considerably.
+    """
+    op()  # warm up caches and lazy imports
+
+    wall = []
+    cpu = []
+    device = []
+    if deviceClock is None:
+        deviceClock = lambda: 0.0
+    gcEnabled = gc.isenabled()
+    gc.collect()
+    gc.disable()
+    try:
+        blocksStart = sys.getallocatedblocks()
+        for _ in range(repeat):
+            deviceStart = deviceClock()
+            cpuStart = time.process_time()
+            wallStart = time.perf_counter()
+            for _ in range(number):
+                op()
+            wall.append((time.perf_counter() - wallStart) / number)
+            cpu.append((time.process_time() - cpuStart) / number)
+            device.append((deviceClock() - deviceStart) / number)
+        allocBlocks = (sys.getallocatedblocks() - blocksStart) / (number * repeat)
+    finally:
+        if gcEnabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        op()
+        peakBytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return Result(name, number * repeat, wall, cpu, device, allocBlocks, peakBytes)
+
+
+def environment():
+    temp = {}
+    temp['python']         = sys.version.split()[0]
+    temp['implementation'] = platform.python_implementation()
+    temp['machine']        = platform.machine()
+    temp['platform']       = platform.platform()
+    temp['time']           = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return temp
+
+
+def save(path, results, seed):
+    """Stores ``results`` as JSON baseline."""
+    temp = {}
+    temp['environment'] = environment()
+    temp['seed']        = seed
+    temp['results']     = dict((r.name, r.toDict()) for r in results)
+    with open(path, 'w') as f:
+        json.dump(temp, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, results, threshold=0.10):
+    """Compares ``results`` against a loaded baseline.
+
+    Returns:
+        list: tuples (name, baseline wall, current wall, ratio, regressed) for every benchmark in both runs
+    """
+    ret = []
+    old = baseline['results']
+    for r in results:
+        if r.name not in old:
+            continue
+        before = old[r.name]['wallMedian']
+        ratio = r.wallMedian / before if before else float('inf')
+        ret.append((r.name, before, r.wallMedian, ratio, ratio > 1 + threshold))
+    return ret
@@ -0,0 +1,164 @@
+"""Benchmark scenarios for the DESFire command hot paths."""
+
+import itertools
+import time
+
+from Desfire.DESFire import DESFire
+from Desfire.DESFire_DEF import DESFireKeyType, DESFireKeySettings, DESFireFilePermissions
+from Desfire.frames import negotiateFrameSize
+from Desfire.simulator import DESFireSimulator
+
+from .runner import measure
+
+
+FILE_SIZES = (32, 256, 1024, 4096)
+
+KEY_SETTINGS = [DESFireKeySettings.KS_ALLOW_CHANGE_MK, DESFireKeySettings.KS_LISTING_WITHOUT_MK,
+                DESFireKeySettings.KS_CONFIGURATION_CHANGEABLE]
+
+# (name, AID, key type, application key)
+KEYS = (
+    ('DES',    'BE 00 01', DESFireKeyType.DF_KEY_2K3DES, '00 11 22 33 44 55 66 77'),
+    ('2K3DES', 'BE 00 02', DESFireKeyType.DF_KEY_2K3DES, '00 11 22 33 44 55 66 77 88 99 AA BB CC DD EE FF'),
+    ('3K3DES', 'BE 00 03', DESFireKeyType.DF_KEY_3K3DES, '00 11 22 33 44 55 66 77 88 99 AA BB CC DD EE FF 01 23 45 67 89 AB CD EF'),
+    ('AES',    'BE 00 04', DESFireKeyType.DF_KEY_AES,    '00 11 22 33 44 55 66 77 88 99 AA BB CC DD EE FF'),
+)
+
+# Fixed RndA for every authentication, RndB is fixed by the seeded simulator
+CHALLENGE = {8: '01 02 03 04 05 06 07 08', 16: '01 02 03 04 05 06 07 08 09 0A 0B 0C 0D 0E 0F 10'}
+
+VALUE_FILE = 0x1F
+VALUE_START = 1_000_000_000
+
+
+class TimedDevice:
+    """Device wrapper accumulating the time spent in ``transceive`` of the wrapped device."""
+
+    def __init__(self, device):
+        self.device = device
+        self.elapsed = 0.0
+
+    def transceive(self, bytes):
+        start = time.perf_counter()
+        try:
+            return self.device.transceive(bytes)
+        finally:
+            self.elapsed += time.perf_counter() - start
+
+    def clock(self):
+        return self.elapsed
+
+
+class Card:
+    """Simulated card personalized with one application per key type.
+
+    Every application has key 1 set to the application key of :py:data:`KEYS`,
+    a standard data file per entry of :py:data:`FILE_SIZES` (file number is the index)
+    and a value file :py:data:`VALUE_FILE`.
+    """
+
+    def __init__(self, seed=0, frameSize=60):
+        self.simulator = DESFireSimulator(frameSize=frameSize, seed=seed, capacity=64 * 1024)
+        self.device = TimedDevice(self.simulator)
+        self.desfire = DESFire(self.device)
+        negotiateFrameSize(self.desfire, ats=self.simulator.ats, cache=None)
+        self.keys = {}
+        desfire = self.desfire
+        picc_key = desfire.getKeySetting()
+        desfire.authenticate(0, picc_key)
+        for name, aid, keyType, key in KEYS:
+            desfire.selectApplication('00 00 00')
+            desfire.authenticate(0, picc_key)
+            desfire.createApplication(aid, KEY_SETTINGS, 2, keyType)
+            desfire.selectApplication(aid)
+            default_key = desfire.createKeySetting('00' * (8 if keyType == DESFireKeyType.DF_KEY_2K3DES else len(key.split())), 0, keyType, [])
+            app_key = desfire.createKeySetting(key, 0, keyType, [])
+            desfire.authenticate(0, default_key)
+            if len(key.split()) == 8:
+                # the card stores single DES keys as 2K3DES key with two equal halves
+                desfire.changeKey(1, desfire.createKeySetting(key + ' ' + key, 0, keyType, []), default_key)
+            else:
+                desfire.changeKey(1, app_key, default_key)
+            filePerm = DESFireFilePermissions()
+            filePerm.setPerm(0x01, 0x01, 0x01, 0x00)
+            for fileId, size in enumerate(FILE_SIZES):
+                desfire.createStdDataFile(fileId, filePerm, size)
+            desfire.createValueFile(VALUE_FILE, filePerm, lowerLimit=0, upperLimit=VALUE_START, value=VALUE_START)
+            self.keys[name] = (aid, app_key)
+
+    def login(self, name):
+        aid, key = self.keys[name]
+        self.desfire.selectApplication(aid)
+        self.desfire.authenticate(1, key, CHALLENGE[self.rndSize(name)])
+        return key
+
+    @staticmethod
+    def rndSize(name):
+        return 8 if name in ('DES', '2K3DES') else 16
+
+
+def benchmarks(card):
+    """Yields (name, op) pairs of all benchmarks, ``op`` runs one operation against ``card``."""
+    desfire = card.desfire
+
+    for name, aid, keyType, key in KEYS:
+        app_key = card.keys[name][1]
+        challenge = CHALLENGE[card.rndSize(name)]
+
+        def authenticate(app_key=app_key, challenge=challenge):
+            desfire.authenticate(1, app_key, challenge)
+
+        desfire.selectApplication(aid)
+        yield 'authenticate[%s]' % name, authenticate
+
+    desfire.selectApplication('00 00 00')
+    yield 'getApplicationIDs', desfire.getApplicationIDs
+
+    card.login('AES')
+    yield 'getFileSettings', lambda: desfire.getFileSettings(0)
+
+    for fileId, size in enumerate(FILE_SIZES):
+        data = bytes(i & 0xFF for i in range(size))
+        yield 'writeFileData[%d]' % size, lambda fileId=fileId, size=size, data=data: desfire.writeFileData(fileId, 0, size, data)
+        yield 'writeFileData[chained,%d]' % size, lambda fileId=fileId, size=size, data=data: desfire.writeFileData(fileId, 0, size, data, chained=True)
+        yield 'readFileData[%d]' % size, lambda fileId=fileId, size=size: desfire.readFileBytes(fileId, 0, size)
+        yield 'readFileData[chained,%d]' % size, lambda fileId=fileId, size=size: desfire.readFileBytes(fileId, 0, size, chained=True)
+
+    # nightly update pattern: a few bytes of a large file change, the previous contents are known
+    fileId, size = len(FILE_SIZES) - 1, FILE_SIZES[-1]
+    versions = [bytes(i & 0xFF for i in range(size)), bytearray(i & 0xFF for i in range(size))]
+    versions[1][size // 2:size // 2 + 4] = b'\xff' * 4
+    desfire.writeFileData(fileId, 0, size, versions[0], chained=True)
+
+    # the file alternates between both versions, run n writes version n % 2
+    runs = itertools.count(1)
+
+    def update():
+        current = next(runs) % 2
+        desfire.updateFileData(fileId, versions[current], versions[1 - current], chained=True)
+
+    yield 'updateFileData[%d]' % size, update
+
+    def debitCommit():
+        desfire.debit(VALUE_FILE, 1)
+        desfire.commitTransaction()
+
+    yield 'debit+commitTransaction', debitCommit
+
+
+def run(seed=0, number=100, repeat=5, select=None, frameSize=60):
+    """Runs the suite and returns a list of :py:class:`benchmarks.runner.Result`.
+
+    Args:
+        seed (int)      : Seed of the simulated card, the same seed gives the same card traffic
+        number (int)    : Operations per repeat
+        repeat (int)    : Number of timed repeats
+        select (str)    : Only run benchmarks whose name contains this string
+    """
+    card = Card(seed=seed, frameSize=frameSize)
+    results = []
+    for name, op in benchmarks(card):
+        if select and select not in name:
+            continue
+        results.append(measure(name, op, number, repeat, card.device.clock))
+    return results
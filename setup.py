@@ -3,11 +3,11 @@ from setuptools import setup, find_packages
 setup(
 	name='DESFfire',
 	version='0.11',
-	packages=find_packages(exclude=['tests*','examples*']),
+	packages=find_packages(exclude=['tests*','examples*','benchmarks*']),
 	license='MIT',
 	description='DESFire library for python',
 	long_description=open('README.md').read(),
-	install_requires=['pycrypto','enum34','pyscard','pydes','scapy','crcmod'],
+	install_requires=['pycrypto','enum34','pyscard','pydes','scapy'],
 	url='https://github.com/patsys/desfire-python',
 	author='Patrick Weber',
 	author_email='pat.weber91@gmail.com'
@@ -1,6 +1,28 @@
 import logging
 from Desfire.DESFire import *
-from Desfire.pcsc import DummyPCSCDevice
+from Desfire.pcsc import DummyPCSCDevice, PCSCDevice
+from smartcard.Exceptions import CardConnectionException
+from Desfire.simulator import DESFireSimulator
+from Desfire.trace import APDUTrace
+from Desfire.aio import AsyncDESFire
+from Desfire.pool import ReaderPool
+from Desfire.provision import compilePlan, Provisioner
+from Desfire.cache import MetadataCache
+from Desfire.dump import dump, iterDump, CardInfo, SKIP_DENIED
+import json
+from Desfire.image import CardImage, ImageFormatError, save, toBytes, diff, DIFF_FILE_ADDED, DIFF_DATA
+import os
+import tempfile
+from Desfire.frames import frameSizeFromATS, frameSizeFromReader, FrameSizeCache, negotiateFrameSize
+from Desfire.metrics import Metrics
+from Desfire.compact import CompactCardVersion, CompactFilePermissions, CompactFileSettings, CompactKey
+from Desfire.parsers import parseApplicationIDs, parseFileSettings, parseValue
+from Desfire.replay import RecordingDevice, ReplayDevice, ReplayError, SessionWriter, readSessions
+from urllib.request import urlopen
+import threading
+from concurrent.futures import TimeoutError
+from Desfire.device import AsyncDevice
+import asyncio
 
 
 
@@ -168,6 +190,818 @@ def File():
         desfire.readFileData(5,0,80)
         desfire.deleteFile(5)
 
+def Simulator():
+        print('Simulator')
+        card=DESFireSimulator(seed=1)
+        desfire = DESFire(card)
+        key_setting=desfire.getKeySetting()
+        desfire.authenticate(0,key_setting)
+        desfire.getCardVersion()
+        desfire.formatCard()
+        for appId,keyType,defaultLength,keyLength in (('00 DE 16',DESFireKeyType.DF_KEY_2K3DES,8,16),('00 DE 24',DESFireKeyType.DF_KEY_3K3DES,24,24),('00 AE 16',DESFireKeyType.DF_KEY_AES,16,16)):
+                desfire.selectApplication('00 00 00')
+                desfire.authenticate(0,key_setting)
+                desfire.createApplication(appId,[DESFireKeySettings.KS_ALLOW_CHANGE_MK,DESFireKeySettings.KS_LISTING_WITHOUT_MK,DESFireKeySettings.KS_CONFIGURATION_CHANGEABLE],2,keyType)
+                desfire.selectApplication(appId)
+                default_key=desfire.createKeySetting('00' * defaultLength,0,keyType,[])
+                app_key=desfire.createKeySetting(bytes(range(1,keyLength+1)),0,keyType,[])
+                desfire.authenticate(0,default_key)
+                desfire.changeKey(1,app_key,default_key)
+                filePerm=DESFireFilePermissions()
+                filePerm.setPerm(0x01,0x01,0x01,0x00)
+                desfire.createStdDataFile(1,filePerm,100)
+                desfire.createValueFile(2,filePerm,value=1_000)
+                assert desfire.getFileIDs() == [1,2]
+                assert desfire.getFileSettings(1).FileSize == 100
+                desfire.authenticate(1,app_key)
+                data=list(range(100))
+                desfire.writeFileData(1,0,100,data)
+                assert desfire.readFileData(1,0,100) == data
+                assert desfire.readFileData(1,0,100,chained=True) == data
+                assert desfire.readFileData(1,10,0,chained=True) == data[10:]
+                assert desfire.readFileBytes(1,0,100) == bytes(data)
+                data=list(reversed(data))
+                desfire.writeFileData(1,0,100,data,chained=True)
+                assert desfire.readFileData(1,0,100) == data
+                assert desfire.getKeyVersion(1) == [0]
+                desfire.debit(2,100)
+                assert desfire.getValue(2) == 1_000
+                desfire.commitTransaction()
+                assert desfire.getValue(2) == 900
+        desfire.selectApplication('00 00 00')
+        assert len(desfire.getApplicationIDs()) == 3
+        desfire.authenticate(0,key_setting)
+        for i in range(25):
+                desfire.createApplication([0x10,0x00,i],[DESFireKeySettings.KS_ALLOW_CHANGE_MK],1,DESFireKeyType.DF_KEY_AES)
+        try:
+                desfire.createApplication('10 01 00',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],1,DESFireKeyType.DF_KEY_AES)
+        except DESFireCommunicationError as e:
+                assert e.status_code == DESFire_STATUS.ST_CountError.value == DESFire_STATUS.ST_InvalidApp.value
+                assert str(e) == 'ST_CountError'
+        else:
+                assert False
+        card.reset()
+        assert card.selected is card.picc and card.session is None
+        print('[+] Simulator Succsess')
+
+def Trace():
+        print('Trace')
+        desfire = DESFire(DESFireSimulator(seed=1), trace=APDUTrace(2))
+        desfire.getKeySetting()
+        desfire.getApplicationIDs()
+        try:
+                desfire.selectApplication('11 22 33')
+        except DESFireCommunicationError:
+                pass
+        assert len(desfire.trace) == 2
+        assert [(r.command, r.status) for r in desfire.trace] == [(0x6A, 0x00), (0x5A, 0xA0)]
+        assert desfire.trace[-1].tx == bytes.fromhex('5A 33 22 11') and desfire.trace[-1].rx == b'\xa0'
+        assert desfire.trace[-1].duration >= 0
+        print('[+] Trace Succsess')
+
+def Cache():
+        print('Cache')
+        cache=CipherCache(2)
+        k1,k2,k3=bytes(range(16)),bytes(range(1,17)),bytes(range(2,18))
+        first=cache.get(DESFireKeyType.DF_KEY_AES,k1,AES)
+        assert cache.get(DESFireKeyType.DF_KEY_AES,bytearray(k1),AES) is first and cache.hits == 1
+        cache.get(DESFireKeyType.DF_KEY_AES,k2,AES)
+        cache.get(DESFireKeyType.DF_KEY_AES,k1,AES)
+        cache.get(DESFireKeyType.DF_KEY_AES,k3,AES)
+        assert (DESFireKeyType.DF_KEY_AES,k1) in cache and (DESFireKeyType.DF_KEY_AES,k2) not in cache
+        assert cache.evict(DESFireKeyType.DF_KEY_AES,k1) and first.ecb is None
+        cipher=CBC(cache.get(DESFireKeyType.DF_KEY_AES,k2,AES),bytes(16))
+        assert cipher.encrypt(bytes(32)) == AES.new(k2,AES.MODE_ECB).encrypt(bytes(16)) + AES.new(k2,AES.MODE_ECB).encrypt(AES.new(k2,AES.MODE_ECB).encrypt(bytes(16)))
+        assert all(k2 not in index[1] for index in cache._entries)
+        mac=CMAC(k2,ciphermod=AES)
+        copy=mac.copy()
+        assert mac.update(b'ab').update(memoryview(b'c'*40)).digest() == copy.CalculateCmac(b'ab'+b'c'*40)
+        cache.clear()
+        assert len(cache) == 0
+        print('[+] Cache Succsess')
+
+def Async():
+        print('Async')
+
+        class AsyncSimulator(AsyncDevice):
+                def __init__(self,card):
+                        self.card=card
+                async def transceive(self,bytes):
+                        await asyncio.sleep(0)
+                        return self.card.transceive(bytes)
+
+        async def personalize(desfire,appId):
+                key_setting=await desfire.getKeySetting()
+                await desfire.authenticate(0,key_setting)
+                await desfire.createApplication(appId,[DESFireKeySettings.KS_ALLOW_CHANGE_MK,DESFireKeySettings.KS_LISTING_WITHOUT_MK],1,DESFireKeyType.DF_KEY_AES)
+                await desfire.selectApplication(appId)
+                await desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+                filePerm=DESFireFilePermissions()
+                filePerm.setPerm(0x00,0x00,0x00,0x00)
+                await desfire.createStdDataFile(1,filePerm,64)
+                await desfire.writeFileData(1,0,64,bytes(range(64)))
+                assert desfire.isAuthenticated
+                return await desfire.readFileBytes(1,0,64)
+
+        async def main():
+                readers=[AsyncDESFire(DESFireSimulator(seed=1)),AsyncDESFire(AsyncSimulator(DESFireSimulator(seed=2))),
+                         AsyncDESFire(DESFireSimulator(seed=3,frameSize=1024),wrapped=True,extendedLength=True)]
+                results=await asyncio.gather(*(personalize(desfire,'00 AE 0%d' % i) for i,desfire in enumerate(readers)))
+                assert results == [bytes(range(64))] * 3
+                assert readers[2].desfire.wrapped and readers[2].desfire.extendedLength
+                try:
+                        await readers[0].selectApplication('11 22 33')
+                        assert False
+                except DESFireCommunicationError as e:
+                        assert e.status_code == DESFire_STATUS.ST_AppNotFound.value
+
+        asyncio.run(main())
+        print('[+] Async Succsess')
+
+def Pool():
+        print('Pool')
+        with ReaderPool(dict(('reader%d' % i,DESFireSimulator(seed=i)) for i in range(3))) as pool:
+                futures=pool.map([[('getKeySetting',),('getApplicationIDs',)]] * 6)
+                assert all(f.result(5)[1] == [] for f in futures)
+                assert pool.submit(lambda desfire: desfire.getCardVersion().UID,reader='reader1').result(5)
+                gate=threading.Event()
+                blocked=pool.submit(lambda desfire: gate.wait(5),reader='reader2')
+                late=pool.submit([('getApplicationIDs',)],reader='reader2',timeout=0)
+                assert pool.queueDepth('reader2') >= 1
+                gate.set()
+                assert blocked.result(5)
+                try:
+                        late.result(5)
+                        assert False
+                except TimeoutError:
+                        pass
+                failed=pool.submit([('selectApplication','11 22 33')],reader='reader0')
+                try:
+                        failed.result(5)
+                        assert False
+                except DESFireCommunicationError:
+                        pass
+                stats=pool.stats()
+                assert stats['total']['submitted'] == 10 and stats['total']['completed'] == 8
+                assert stats['reader2']['timedOut'] == 1 and stats['reader0']['failed'] == 1
+        with ReaderPool({'reader':DESFireSimulator(seed=1,frameSize=1024)},wrapped=True,extendedLength=True) as pool:
+                assert pool.submit(lambda desfire: (desfire.extendedLength,desfire.MaxFrameSize)).result(5) == (True,60)
+        # devices made per job are closed after the job, also when it fails
+        reader=FakeReader()
+        with ReaderPool.fromPCSC(readerList=[reader]) as pool:
+                futures=[pool.submit(lambda desfire: None) for _ in range(5)]
+                for future in futures:
+                        try:
+                                future.result(5)
+                        except Exception:
+                                pass
+        assert reader.connects == 5 and reader.disconnects == 5
+        print('[+] Pool Succsess')
+
+class FakeReader(object):
+        """pyscard reader whose connections count connect and disconnect, the card handle is never valid"""
+        def __init__(self):
+                self.connects=0
+                self.disconnects=0
+
+        def createConnection(self):
+                reader=self
+                class Connection(object):
+                        hcard=0
+                        def connect(self):
+                                reader.connects+=1
+                        def disconnect(self):
+                                reader.disconnects+=1
+                        @property
+                        def component(self):
+                                return self
+                return Connection()
+
+        def __str__(self):
+                return 'Fake reader'
+
+def Provision():
+        print('Provision')
+        manifest={'picc':{'keyType':'2K3DES','key':'00' * 8,'format':True},
+                  'applications':[{'aid':'00 AE 16','keyType':'AES','keyCount':3,'keySettings':['KS_ALLOW_CHANGE_MK','KS_CONFIGURATION_CHANGEABLE'],
+                                   'keys':{'0':'01' * 16,'2':'22' * 16},
+                                   'files':[{'id':1,'size':100,'permissions':{'read':2,'write':2,'readWrite':2,'change':0},'data':'A5' * 100},
+                                            {'id':2,'type':'value','permissions':{'read':2,'write':2,'readWrite':2,'change':0},'value':1000}],
+                                   'newKeySettings':['KS_ALLOW_CHANGE_MK']},
+                                  {'aid':'00 DE 16','keyType':'DES','keyCount':2,'keySettings':['KS_ALLOW_CHANGE_MK'],
+                                   'keys':{'0':'01 02 03 04 05 06 07 08','1':'11' * 8},
+                                   'files':[{'id':1,'size':16,'permissions':{'read':'free','write':1,'readWrite':1,'change':0},'data':'5A' * 16}]}]}
+        plan=compilePlan(manifest)
+        assert plan.contextSwitches() == (3,7)
+        # enum key settings and bytes keys compile to the same plan as their names and hex strings
+        same=json.loads(json.dumps(manifest))
+        same['applications'][0]['keySettings']=[DESFireKeySettings.KS_ALLOW_CHANGE_MK,DESFireKeySettings.KS_CONFIGURATION_CHANGEABLE]
+        same['applications'][0]['keys']['0']=b'\x01' * 16
+        same['applications'][1]['files'][0]['data']=bytearray(b'\x5a' * 16)
+        assert compilePlan(same).digest == plan.digest
+        same['applications'][0]['keys']['2']=b'\x23' * 16
+        assert compilePlan(same).digest != plan.digest
+
+        class Removed(Exception):
+                pass
+
+        class RemovedAfter(Device):
+                def __init__(self,card,frames):
+                        self.card=card
+                        self.frames=frames
+                def transceive(self,bytes):
+                        self.frames-=1
+                        if self.frames < 0:
+                                raise Removed()
+                        return self.card.transceive(bytes)
+
+        for frames in (None,7,15,23,31):
+                card=DESFireSimulator(seed=3)
+                provisioner=Provisioner(plan)
+                if frames:
+                        try:
+                                provisioner.provision(DESFire(RemovedAfter(card,frames)))
+                                assert False
+                        except Removed:
+                                card.reset()
+                result=provisioner.provision(DESFire(card))
+                assert (result.resumedAt is not None) == bool(frames)
+                desfire=DESFire(card)
+                desfire.selectApplication('00 AE 16')
+                desfire.authenticate(2,desfire.createKeySetting('22' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+                assert desfire.readFileBytes(1,0,100) == b'\xa5' * 100 and desfire.getValue(2) == 1000
+                desfire.selectApplication('00 DE 16')
+                desfire.authenticate(0,desfire.createKeySetting('01 02 03 04 05 06 07 08',0,DESFireKeyType.DF_KEY_2K3DES,[]))
+                desfire.selectApplication('00 DE 16')
+                desfire.authenticate(1,desfire.createKeySetting('11' * 8,0,DESFireKeyType.DF_KEY_2K3DES,[]))
+                assert desfire.readFileBytes(1,0,16) == b'\x5a' * 16
+
+        # the answer to changing the PICC master key from DES to AES is lost, the resume authenticates with the AES key
+        class AnswerLost(Device):
+                def __init__(self,card,command):
+                        self.card=card
+                        self.command=command
+                def transceive(self,bytes):
+                        resp=self.card.transceive(bytes)
+                        if bytes[0] == self.command:
+                                raise Removed()
+                        return resp
+
+        aesKey=bytes(range(16))
+        piccPlan=compilePlan({'picc':{'keyType':'DES','key':'00' * 8,'newKey':aesKey.hex(),'newKeyType':'AES'},
+                              'applications':[{'aid':'00 AE 17','keyType':'AES'}]})
+        card=DESFireSimulator(seed=5)
+        provisioner=Provisioner(piccPlan)
+        try:
+                provisioner.provision(DESFire(AnswerLost(card,DF_INS_CHANGE_KEY)))
+                assert False
+        except Removed:
+                card.reset()
+        result=provisioner.provision(DESFire(card))
+        assert result.resumedAt == 1 and result.steps == 1
+        desfire=DESFire(card)
+        desfire.authenticate(0,desfire.createKeySetting(aesKey,0,DESFireKeyType.DF_KEY_AES,[]))
+
+        with ReaderPool(dict(('reader%d' % i,lambda i=i: DESFireSimulator(seed=i)) for i in range(2))) as pool:
+                report=Provisioner(plan).run(pool,4)
+        assert report.cards == 4 and not report.errors and report.cardsPerMinute > 0
+        print('[+] Provision Succsess')
+
+def Session():
+        print('Session')
+        card=DESFireSimulator(seed=4)
+        desfire=DESFire(card,trace=APDUTrace())
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],2,DESFireKeyType.DF_KEY_AES)
+        default_key=desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[])
+        assert desfire.ensureApplication('00 AE 16') and not desfire.ensureApplication('00 AE 16')
+        assert desfire.ensureAuthenticated(0,default_key) and not desfire.ensureAuthenticated(0,default_key)
+        filePerm=DESFireFilePermissions()
+        filePerm.setPerm(0x01,0x01,0x01,0x00)
+        desfire.createStdDataFile(1,filePerm,16)
+        app_key=desfire.createKeySetting('01' * 16,0,DESFireKeyType.DF_KEY_AES,[])
+        desfire.changeKey(1,app_key,default_key)
+        # changing the active key ends the session
+        desfire.changeKey(0,app_key,default_key)
+        assert not desfire.state.isAuthenticated and desfire.state.isSelected(b'\x00\xae\x16')
+        desfire.trace.clear()
+        for i in range(3):
+                desfire.withSession('00 AE 16',1,app_key,desfire.writeFileData,1,0,16,bytes(16))
+        assert [r.command for r in desfire.trace].count(0xAA) == 1
+        assert len([r for r in desfire.trace if r.command == 0x5A]) == 0
+        # the card lost the session, withSession selects and authenticates again
+        card.session=None
+        assert desfire.withSession('00 AE 16',1,app_key,desfire.readFileBytes,1,0,16) == bytes(16)
+        try:
+                desfire.getValue(1)
+        except DESFireCommunicationError:
+                assert not desfire.isAuthenticated and not desfire.state.isAuthenticated
+        print('[+] Session Succsess')
+
+def Metadata():
+        print('Metadata')
+        now=[0.0]
+        cache=MetadataCache(maxsize=2,ttl=10,clock=lambda: now[0])
+        card=DESFireSimulator(seed=5)
+        desfire=DESFire(card,trace=APDUTrace(),metadataCache=cache)
+        desfire.getCardVersion()
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK,DESFireKeySettings.KS_LISTING_WITHOUT_MK],2,DESFireKeyType.DF_KEY_AES)
+        desfire.selectApplication('00 AE 16')
+        desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+        filePerm=DESFireFilePermissions()
+        filePerm.setPerm(0x01,0x01,0x01,0x00)
+        desfire.createStdDataFile(1,filePerm,16)
+        desfire.trace.clear()
+        for i in range(3):
+                assert desfire.getFileIDs() == [1]
+                assert desfire.getFileSettings(1).FileSize == 16
+        assert len(desfire.trace) == 2
+        # creating a file invalidates the file list of the application
+        desfire.createStdDataFile(2,filePerm,32)
+        assert desfire.getFileIDs() == [1,2]
+        desfire.selectApplication('00 00 00')
+        assert desfire.getApplicationIDs() == [[0x00,0xAE,0x16]]
+        desfire.trace.clear()
+        desfire.getApplicationIDs()
+        assert len(desfire.trace) == 0
+        now[0]=11
+        desfire.getApplicationIDs()
+        assert len(desfire.trace) == 1
+        # only two (UID, AID) entries are kept
+        desfire.getKeySetting()
+        assert len(cache) == 2
+        print('[+] Metadata Succsess')
+
+def Dump():
+        print('Dump')
+        card=DESFireSimulator(seed=6,uid=bytes(range(7)))
+        desfire=DESFire(card,trace=APDUTrace())
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK,DESFireKeySettings.KS_LISTING_WITHOUT_MK],2,DESFireKeyType.DF_KEY_AES)
+        desfire.createApplication('00 AE 17',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],1,DESFireKeyType.DF_KEY_AES)
+        desfire.selectApplication('00 AE 16')
+        app_key=desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[])
+        desfire.authenticate(0,app_key)
+        free=DESFireFilePermissions()
+        free.setPerm(0x0E,0x00,0x00,0x00)
+        keyOne=DESFireFilePermissions()
+        keyOne.setPerm(0x01,0x01,0x01,0x00)
+        desfire.createStdDataFile(1,free,200)
+        desfire.writeFileData(1,0,200,bytes(range(200)),chained=True)
+        desfire.createStdDataFile(2,keyOne,16)
+        desfire.createValueFile(3,free,value=42)
+        desfire.trace.clear()
+        snapshot=dump(desfire)
+        assert snapshot.uid == bytes(range(7))
+        assert [app.aid for app in snapshot.applications] == [b'\x00\xae\x16',b'\x00\xae\x17']
+        files=snapshot.application('00 AE 16').files
+        assert files[0].data == bytes(range(200)) and files[0].fileSettings.FileSize == 200
+        assert files[1].skipped == SKIP_DENIED and files[1].data is None
+        assert files[2].value == 42
+        assert snapshot.application('00 AE 17').error == 'ST_AuthentError'
+        # one ReadData for 200 bytes, nothing sent for the unreadable file
+        assert [r.command for r in desfire.trace].count(0xBD) == 1
+        assert [r.command for r in desfire.trace].count(0xAF) == 2 + 3
+        # with key 1 the second file is readable, records are streamed one by one
+        records=list(iterDump(desfire,keys={'00 AE 16':(1,app_key)}))
+        assert isinstance(records[0],CardInfo) and len(records) == 1 + 2 + 3
+        assert records[3].data == bytes(16)
+        json.dumps(snapshot.toDict())
+        print('[+] Dump Succsess')
+
+def Image():
+        print('Image')
+        card=DESFireSimulator(seed=7,uid=bytes(range(7)))
+        desfire=DESFire(card)
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK,DESFireKeySettings.KS_LISTING_WITHOUT_MK],2,DESFireKeyType.DF_KEY_AES)
+        desfire.selectApplication('00 AE 16')
+        app_key=desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[])
+        desfire.authenticate(0,app_key)
+        free=DESFireFilePermissions()
+        free.setPerm(0x0E,0x00,0x00,0x00)
+        desfire.createStdDataFile(1,free,100)
+        desfire.writeFileData(1,0,100,bytes(range(100)),chained=True)
+        desfire.createValueFile(2,free,value=7)
+        before=dump(desfire,keys={'00 AE 16':(0,app_key)})
+        desfire.writeFileData(1,10,2,b'ab')
+        desfire.writeFileData(1,50,1,b'c')
+        desfire.createStdDataFile(3,free,8)
+        after=dump(desfire,keys={'00 AE 16':(0,app_key)})
+        path=os.path.join(tempfile.mkdtemp(),'card.dfi')
+        save(before,path)
+        with CardImage.load(path) as old:
+                new=CardImage(toBytes(after))
+                assert old.uid == bytes(range(7))
+                data=old.file('00 AE 16',1).data
+                assert isinstance(data,memoryview) and data == bytes(range(100))
+                del data
+                assert old.file('00 AE 16',2).value == 7 and old.file('00 AE 16',3) is None
+                differences=list(diff(old,new))
+                assert [(d.kind,d.fileId) for d in differences] == [(DIFF_DATA,1),(DIFF_FILE_ADDED,3)]
+                assert differences[0].ranges == [(10,12),(50,51)]
+                assert old.toDump().toDict() == before.toDict()
+        try:
+                CardImage(b'JSON' + bytes(40))
+        except ImageFormatError:
+                pass
+        else:
+                assert False
+        print('[+] Image Succsess')
+
+def Update():
+        print('Update')
+        card=DESFireSimulator(seed=8)
+        desfire=DESFire(card,trace=APDUTrace())
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],2,DESFireKeyType.DF_KEY_AES)
+        desfire.selectApplication('00 AE 16')
+        desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+        filePerm=DESFireFilePermissions()
+        filePerm.setPerm(0x00,0x00,0x00,0x00)
+        desfire.createStdDataFile(1,filePerm,2048)
+        old=bytes(i & 0xFF for i in range(2048))
+        desfire.writeFileData(1,0,2048,old,chained=True)
+        new=bytearray(old)
+        new[100:104]=b'abcd'
+        new[110]=0
+        new[1500]=0
+        desfire.trace.clear()
+        stats=desfire.updateFileData(1,new,previous=old)
+        assert stats.ranges == [(100,111),(1500,1501)] and stats.bytesWritten == 12
+        assert stats.apdus == 2 and [r.command for r in desfire.trace].count(0x3D) == 2
+        assert stats.apdusSaved == stats.fullApdus - 2 and stats.bytesSaved == 2036 and not stats.read
+        assert desfire.readFileBytes(1,0,0,chained=True) == new
+        # without a previous image the contents are read first, nothing differs
+        stats=desfire.updateFileData(1,new,chained=True)
+        assert stats.read and stats.ranges == [] and stats.apdus == 0
+        stats=desfire.updateFileData(1,b'xyz',offset=2045,chained=True)
+        assert stats.ranges == [(0,3)] and desfire.readFileBytes(1,2040,8) == new[2040:2045] + b'xyz'
+        desfire.trace.clear()
+        stats=desfire.updateFileData(1,b'',offset=10)
+        assert stats.apdus == 0 and not stats.read and len(desfire.trace) == 0
+        stats=desfire.updateFileData(1,b'xyz',offset=2045)
+        assert stats.read and stats.ranges == [] and [r.command for r in desfire.trace] == [0xBD]
+        print('[+] Update Succsess')
+
+def Wrapped():
+        print('Wrapped')
+        for frameSize, extended in ((60, False), (1024, True)):
+                card=DESFireSimulator(seed=9,frameSize=frameSize)
+                desfire=DESFire(card,trace=APDUTrace(),wrapped=True,extendedLength=extended)
+                # extended length support of the reader tells nothing about the card
+                assert desfire.MaxFrameSize == 60
+                version=desfire.getCardVersion()
+                assert bytes(version.UID) == card.uid
+                assert desfire.trace[0].tx == bytes.fromhex('90 60 00 00 00') and desfire.trace[0].rx[-2] == 0x91
+                # the trace carries the INS, not the CLA 0x90 of every wrapped APDU
+                assert [r.command for r in desfire.trace] == [0x60, 0xAF, 0xAF]
+                master=desfire.getKeySetting()
+                desfire.authenticate(0,master)
+                desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],2,DESFireKeyType.DF_KEY_AES)
+                desfire.selectApplication('00 AE 16')
+                desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+                filePerm=DESFireFilePermissions()
+                filePerm.setPerm(0x00,0x00,0x00,0x00)
+                desfire.createStdDataFile(1,filePerm,600)
+                data=bytes(i & 0xFF for i in range(600))
+                if extended:
+                        # not negotiated yet: chunks of 52 bytes in short APDUs
+                        desfire.trace.clear()
+                        desfire.writeFileData(1,0,600,data)
+                        assert [r.command for r in desfire.trace] == [0x3D] * 12
+                        assert max(len(r.tx) for r in desfire.trace) == 60 + 5
+                        assert negotiateFrameSize(desfire,ats=card.ats,cache=None) > 600
+                desfire.trace.clear()
+                desfire.writeFileData(1,0,600,data,chained=True)
+                assert desfire.readFileBytes(1,0,600,chained=True) == data
+                if extended:
+                        # one extended length APDU each way
+                        assert len(desfire.trace) == 2 and desfire.trace[0].tx[4:7] == bytes.fromhex('00 02 5F')
+                assert desfire.readFileBytes(1,0,100) == data[:100]
+                try:
+                        desfire.getValue(1)
+                except DESFireCommunicationError as e:
+                        assert e.status_code == DESFire_STATUS.ST_IncorrectParam.value and not desfire.isAuthenticated
+                else:
+                        assert False
+        # an ISO status word other than 91 xx
+        try:
+                desfire.communicate(bytes.fromhex('90 60 01 00 00'),'bad P1',nativ=False)
+        except DESFireCommunicationError as e:
+                assert e.status_code == 0x6A86
+        else:
+                assert False
+        assert DESFire.wrap_command(0x60) == bytes.fromhex('90 60 00 00 00')
+        assert DESFire.wrap_command(0xBD,[1,2],extended=True) == bytes.fromhex('90 BD 00 00 00 00 02 01 02 00 00')
+        print('[+] Wrapped Succsess')
+
+def Frames():
+        print('Frames')
+        assert frameSizeFromATS(bytes.fromhex('06 75 77 81 02 80')) == 60
+        assert frameSizeFromATS(bytes.fromhex('05 78 80 70 00')) == 253
+        assert frameSizeFromReader(261,wrapped=True) == 256 and frameSizeFromReader(65544,True,True) == 65536
+        cache=FrameSizeCache()
+        card=DESFireSimulator(seed=10,frameSize=256)
+        desfire=DESFire(card,trace=APDUTrace())
+        assert negotiateFrameSize(desfire,'reader 0',ats=card.ats,cache=cache) == 252
+        assert negotiateFrameSize(desfire,'reader 0',ats=card.ats,readerMax=128,cache=cache) == 252
+        assert negotiateFrameSize(desfire,'reader 1',ats=card.ats,readerMax=128,cache=cache) == 128
+        assert len(desfire.trace) == 0 and len(cache) == 2
+        desfire.MaxFrameSize=252
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],2,DESFireKeyType.DF_KEY_AES)
+        desfire.selectApplication('00 AE 16')
+        desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+        filePerm=DESFireFilePermissions()
+        filePerm.setPerm(0x00,0x00,0x00,0x00)
+        desfire.createStdDataFile(1,filePerm,1024)
+        data=bytes(i & 0xFF for i in range(1024))
+        desfire.trace.clear()
+        desfire.writeFileData(1,0,1024,data)
+        assert desfire.readFileBytes(1,0,1024) == data
+        # 244 bytes per write, 240 bytes per read instead of 52 and 48
+        assert [r.command for r in desfire.trace] == [0x3D] * 5 + [0xBD] * 5
+        # without ATS the card type comes from GetVersion
+        desfire.trace.clear()
+        assert negotiateFrameSize(desfire,'reader 0',cache=cache) == 60
+        assert [r.command for r in desfire.trace] == [0x60, 0xAF, 0xAF]
+        print('[+] Frames Succsess')
+
+class FakeSCard(object):
+        """Stand-in for smartcard.scard forwarding SCardTransmit to a simulator"""
+        SCARD_PROTOCOL_T0, SCARD_PROTOCOL_T1, SCARD_PROTOCOL_RAW = 1, 2, 0x10000
+        SCARD_PCI_T0, SCARD_PCI_T1, SCARD_PCI_RAW = 'T0', 'T1', 'RAW'
+        SCARD_LEAVE_CARD, SCARD_RESET_CARD = 0, 1
+        SCARD_ATTR_MAXINPUT = 0x7A007
+
+        def __init__(self, card):
+                self.card=card
+                self.calls=[]
+
+        def SCardTransmit(self, hcard, header, apdu):
+                assert header == 'T1' and isinstance(apdu,list)
+                self.calls.append('transmit')
+                return 0, list(self.card.transceive(apdu))
+
+        def SCardBeginTransaction(self, hcard):
+                self.calls.append('begin')
+                return 0
+
+        def SCardEndTransaction(self, hcard, disposition):
+                self.calls.append('end')
+                return 0
+
+        def SCardGetAttrib(self, hcard, attr):
+                return 0, [0x06, 0x01, 0x00, 0x00]
+
+        def SCardGetErrorMessage(self, hresult):
+                return 'error %X' % hresult
+
+class FakeConnection(object):
+        def __init__(self):
+                self.hcard=1
+                self.protocolLookups=0
+
+        def getProtocol(self):
+                self.protocolLookups+=1
+                return 2
+
+def PCSC():
+        print('PCSC')
+        card=DESFireSimulator(seed=11)
+        scard=FakeSCard(card)
+        connection=FakeConnection()
+        device=PCSCDevice(connection,scard=scard)
+        timings=[]
+        device.onTransmit=lambda tx,rx,seconds: timings.append(seconds)
+        desfire=DESFire(device)
+        with device.transaction():
+                with device.transaction():
+                        desfire.getCardVersion()
+                master=desfire.getKeySetting()
+                desfire.authenticate(0,master)
+        assert scard.calls == ['begin'] + ['transmit'] * 6 + ['end']
+        assert connection.protocolLookups == 1 and device.transmits == 6 and len(timings) == 6
+        assert device.transmitTime >= device.lastTransmitTime >= 0
+        # a new handle after reconnecting resolves the protocol again
+        connection.hcard=2
+        desfire.getKeySetting()
+        assert connection.protocolLookups == 2
+        assert device.maxInput() == 262
+        assert desfire.isAuthenticated
+        scard.SCardTransmit=lambda hcard,header,apdu: (0x80100016, [])
+        try:
+                desfire.getKeySetting()
+        except CardConnectionException:
+                assert desfire.state.aid is None and not desfire.isAuthenticated and desfire.cmac is None
+        else:
+                assert False
+        # a failing end of the transaction does not hide the error of the block
+        scard.SCardEndTransaction=lambda hcard,disposition: 0x80100011
+        try:
+                with device.transaction():
+                        raise KeyError('block')
+        except KeyError:
+                assert device.transactionDepth == 0
+        else:
+                assert False
+        # the transaction ends with a lost card handle
+        scard.calls=[]
+        del scard.SCardEndTransaction
+        with device.transaction():
+                connection.hcard=0
+        assert scard.calls == ['begin'] and device.transactionDepth == 0
+        print('[+] PCSC Succsess')
+
+def MetricsTest():
+        print('Metrics')
+        card=DESFireSimulator(seed=12)
+        metrics=Metrics()
+        desfire=DESFire(card,metrics=metrics)
+        desfire.getCardVersion()
+        master=desfire.getKeySetting()
+        desfire.authenticate(0,master)
+        try:
+                desfire.selectApplication('00 DE AD')
+        except DESFireCommunicationError:
+                pass
+        data=metrics.toDict()
+        version=data['DF_INS_GET_VERSION']
+        # three frames, answered with 0xAF twice
+        assert version['calls'] == 1 and version['bytesOut'] == 3 and version['bytesIn'] == 28 + 3
+        assert version['statuses'] == {'ST_Success': 1} and version['transceive']['count'] == 1
+        auth=data['DFEV1_INS_AUTHENTICATE_ISO']
+        assert auth['calls'] == 1 and auth['statuses'] == {'ST_Success': 1} and 'DF_INS_ADDITIONAL_FRAME' not in data
+        assert auth['crypto']['sum'] > 0 and auth['crypto']['buckets'][-1][1] == 1
+        assert data['DF_INS_SELECT_APPLICATION']['statuses'] == {'ST_AppNotFound': 1}
+        text=metrics.toPrometheus()
+        assert 'desfire_commands_total{command="DF_INS_GET_VERSION"} 1' in text
+        assert 'desfire_status_total{command="DF_INS_SELECT_APPLICATION",status="ST_AppNotFound"} 1' in text
+        assert 'desfire_transceive_seconds_bucket{command="DF_INS_GET_VERSION",le="+Inf"} 1' in text
+        path=os.path.join(tempfile.mkdtemp(),'desfire.prom')
+        metrics.writePrometheus(path)
+        assert open(path).read() == text
+        server=metrics.serve(0)
+        try:
+                assert urlopen('http://127.0.0.1:%d/metrics' % server.server_address[1]).read().decode() == text
+        finally:
+                server.shutdown()
+                server.server_close()
+        print('[+] Metrics Succsess')
+
+def Replay():
+        print('Replay')
+        def session(device):
+                desfire=DESFire(device)
+                uid=desfire.getCardVersion().UID
+                master=desfire.getKeySetting()
+                desfire.authenticate(0,master)
+                desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],2,DESFireKeyType.DF_KEY_AES)
+                desfire.selectApplication('00 AE 16')
+                desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+                filePerm=DESFireFilePermissions()
+                filePerm.setPerm(0x00,0x00,0x00,0x00)
+                desfire.createStdDataFile(1,filePerm,300)
+                desfire.writeFileData(1,0,300,bytes(range(100))*3,chained=True)
+                return bytes(uid),bytes(desfire.readFileBytes(1,0,0,chained=True)),desfire.sessionKey.getKey()
+        path=os.path.join(tempfile.mkdtemp(),'sessions.dfr.gz')
+        writer=SessionWriter(path)
+        recorder=RecordingDevice(DESFireSimulator(seed=13),writer)
+        recorded=session(recorder)
+        recorder.newSession()
+        # the next card
+        recorder.device=DESFireSimulator(seed=14)
+        DESFire(recorder).getCardVersion()
+        recorder.close()
+        writer.close()
+        assert writer.sessions == 2
+        sessions=list(readSessions(path))
+        assert len(sessions) == 2 and len(sessions[0].challenges) == 2 and len(sessions[1]) == 3
+        # the random challenges are pinned, so the session keys match
+        device=ReplayDevice(sessions[0])
+        assert session(device) == recorded and device.finished
+        slept=[]
+        device=ReplayDevice(sessions[0],timing=True,sleep=slept.append)
+        session(device)
+        assert len(slept) == len([f for f in sessions[0].frames if f.duration > 0])
+        device.rewind()
+        desfire=DESFire(device)
+        desfire.getCardVersion()
+        try:
+                desfire.getApplicationIDs()
+        except ReplayError:
+                pass
+        else:
+                assert False
+        print('[+] Replay Succsess')
+
+def Compact():
+        print('Compact')
+        card=DESFireSimulator(seed=15)
+        desfire=DESFire(card)
+        version=desfire.getCardVersion()
+        compact=CompactCardVersion(version.rawBytes)
+        assert compact.toDict() == version.toDict() and repr(compact) == repr(version)
+        assert compact.uid == bytes(version.UID) and compact == bytes(version.rawBytes)
+        try:
+                compact.cwProd=1
+        except AttributeError:
+                pass
+        else:
+                assert False
+        master=desfire.getKeySetting()
+        key=CompactKey.fromKey(master)
+        assert repr(key) == repr(master) and key.getKey() is None and key.GetKeyType() == master.GetKeyType()
+        desfire.authenticate(0,master)
+        aesKey=desfire.createKeySetting('00 11 22 33 44 55 66 77 88 99 AA BB CC DD EE FF',2,DESFireKeyType.DF_KEY_AES,[DESFireKeySettings.KS_ALLOW_CHANGE_MK])
+        key=CompactKey.fromKey(aesKey)
+        assert repr(key) == repr(aesKey) and key.keySize == 16 and bytes(key.toKey().getKey()) == bytes(aesKey.getKey())
+        desfire.createApplication('00 AE 16',[DESFireKeySettings.KS_ALLOW_CHANGE_MK],2,DESFireKeyType.DF_KEY_AES)
+        desfire.selectApplication('00 AE 16')
+        desfire.authenticate(0,desfire.createKeySetting('00' * 16,0,DESFireKeyType.DF_KEY_AES,[]))
+        filePerm=DESFireFilePermissions()
+        filePerm.setPerm(0x01,0x02,0x03,0x04)
+        desfire.createStdDataFile(1,filePerm,300)
+        desfire.createValueFile(2,filePerm,lowerLimit=5,upperLimit=500,value=50)
+        settings=desfire.getFileSettings(1)
+        compact=CompactFileSettings(desfire.getFileSettingsRaw(1))
+        assert compact.toDict() == settings.toDict() and repr(compact) == repr(settings) and compact.FileSize == 300
+        permissions=CompactFilePermissions.fromPerm(0x01,0x02,0x03,0x04)
+        assert permissions == compact.Permissions and permissions.pack() == filePerm.pack()
+        assert (permissions.read, permissions.write, permissions.readWrite, permissions.change) == (1,2,3,4)
+        assert CompactFilePermissions.fromPermissions(filePerm) == permissions
+        value=CompactFileSettings(desfire.getFileSettingsRaw(2))
+        assert (value.LowerLimit, value.UpperLimit, value.FileSize) == (5, 500, None)
+        assert value.FileType == DESFireFileType.MDFT_VALUE_FILE_WITH_BACKUP
+        print('[+] Compact Succsess')
+
+def Parsers():
+        print('Parsers')
+        answer=bytearray.fromhex('01 02 03 16 AE 00 FF FF FF')
+        assert parseApplicationIDs(memoryview(answer)) == [[3,2,1],[0,0xAE,0x16],[0xFF,0xFF,0xFF]]
+        assert parseApplicationIDs(b'') == []
+        assert parseValue(bytes.fromhex('FE FF FF FF')) == -2
+        answers={
+                'standard': ('00 03 12 34 00 01 02', {'FileSize': 0x020100}),
+                'backup':   ('01 00 12 34 2C 01 00', {'FileSize': 300}),
+                'value':    ('02 01 12 34 05 00 00 00 F4 01 00 00 0A 00 00 00 01', {'LowerLimit': 5, 'UpperLimit': 500, 'LimitedCreditValue': 10, 'LimitedCreditEnabled': True}),
+                'linear':   ('03 00 12 34 10 00 00 20 00 00 05 00 00', {'RecordSize': 16, 'MaxNumberRecords': 32, 'CurrentNumberRecords': 5}),
+                'cyclic':   ('04 00 12 34 00 01 00 03 00 00 02 00 00', {'RecordSize': 256, 'MaxNumberRecords': 3, 'CurrentNumberRecords': 2}),
+        }
+        for name,(raw,fields) in answers.items():
+                raw=bytes.fromhex(raw)
+                settings=DESFireFileSettings()
+                settings.parse(list(raw))
+                compact=CompactFileSettings(raw)
+                for field,value in fields.items():
+                        assert getattr(settings,field) == value and getattr(compact,field) == value, (name,field)
+                assert settings.toDict() == compact.toDict() and repr(settings) == repr(compact)
+                assert settings.Permissions.toDict() == {'ReadAccess': True, 'WriteAccess': True, 'ReadAndWriteAccess': True, 'ChangeAccess': True}
+                assert parseFileSettings(memoryview(raw))[2] == 0x1234
+        print('[+] Parsers Succsess')
+
+def Tables():
+        print('Tables')
+        assert DF_INS_GET_VERSION == DESFireCommand.DF_INS_GET_VERSION.value and ST_AuthentError == DESFire_STATUS.ST_AuthentError.value
+        assert STATUS_NAMES[0xA0] == 'ST_AppNotFound' and STATUS_NAMES[0x42] == '0x42'
+        assert STATUS_NAMES[0xCE] == 'ST_CountError' and ST_CountError == ST_InvalidApp == 0xCE
+        assert COMMAND_NAMES[0xAA] == 'DFEV1_INS_AUTHENTICATE_AES' and COMMAND_NAMES[MAX_FRAME_SIZE] == '0x3C'
+        assert KEY_TYPE_TABLE[0x80] is DESFireKeyType.DF_KEY_AES and KEY_TYPE_TABLE[0xC0] is None
+        for mask in range(256):
+                legacy=[DESFireKeySettings(1 << bit) for bit in range(30,-1,-1) if mask & (1 << bit)]
+                assert calc_key_settings(mask) == legacy
+                assert calc_key_settings(legacy) == mask
+        key=DESFireKey()
+        key.setKeySettings(2,DESFireKeyType.DF_KEY_AES,0x10B)
+        assert key.listHumanKeySettings() == ['KS_ALLOW_CHANGE_MK','KS_LISTING_WITHOUT_MK','KS_CONFIGURATION_CHANGEABLE','0x0100']
+        card=DESFireSimulator(seed=16)
+        desfire=DESFire(card)
+        try:
+                desfire.selectApplication('00 DE AD')
+        except DESFireCommunicationError as e:
+                assert str(e) == 'ST_AppNotFound' and e.status_code == ST_AppNotFound
+        else:
+                assert False
+        print('[+] Tables Succsess')
+
+def CRC():
+        print('CRC')
+        data=b'123456789'
+        assert CRC32(data) == 0x340BC6D9
+        assert CRC32(list(data)) == 0x340BC6D9
+        crc=Crc32(data[:4])
+        assert crc.copy().update(memoryview(data)[4:]).digest() == bytes.fromhex('D9 C6 0B 34')
+        assert crc.value == CRC32(data[:4])
+        print('[+] CRC Succsess')
+
 if __name__ == '__main__':
         logging.basicConfig(level=logging.DEBUG)
         logger = logging.getLogger(__name__)
@@ -182,3 +1016,23 @@ if __name__ == '__main__':
                 AuthTest_AES()
                 Test_DES()
                 Test_2k3DES()
+                Simulator()
+                CRC()
+                Trace()
+                Cache()
+                Async()
+                Pool()
+                Provision()
+                Session()
+                Metadata()
+                Dump()
+                Image()
+                Update()
+                Wrapped()
+                Frames()
+                PCSC()
+                MetricsTest()
+                Replay()
+                Compact()
+                Parsers()
+                Tables()